@@ -0,0 +1,308 @@
+"""
+Processador Assíncrono do Kermartin 3.0
+Caminho asyncio (AsyncOpenAI) para muitas chamadas concorrentes sem uma thread por requisição
+"""
+
+import time
+import asyncio
+import logging
+import weakref
+import itertools
+from typing import Dict, Iterator, List, Optional
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from openai import AsyncOpenAI
+from .prompts import get_prompt_parts
+from .security import SecurityValidator
+from .extraction_store import ExtractionStore
+from .cache_manager import KermartinCacheManager
+from .processor import KermartinProcessor, SecurityError
+from core.models import SessaoAnalise, Documento
+from core.tracing import current_span, span, traced
+from core.profiling import profiled
+
+logger = logging.getLogger('ai_engine')
+
+# Um cliente (pool HTTP compartilhado) e um semáforo por event loop do processo
+_clients = weakref.WeakKeyDictionary()
+_limiters = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> AsyncOpenAI:
+    """Retorna o AsyncOpenAI compartilhado do event loop atual"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        # Retry fica a cargo do processador (backoff assíncrono)
+        client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
+        _clients[loop] = client
+    return client
+
+
+def get_concurrency_limiter() -> asyncio.Semaphore:
+    """Semáforo que limita chamadas simultâneas à OpenAI no event loop atual"""
+    loop = asyncio.get_running_loop()
+    limiter = _limiters.get(loop)
+    if limiter is None:
+        limit = settings.KERMARTIN_SETTINGS.get('OPENAI_ASYNC_MAX_CONCURRENCY', 64)
+        limiter = asyncio.Semaphore(limit)
+        _limiters[loop] = limiter
+    return limiter
+
+
+class AsyncKermartinProcessor(KermartinProcessor):
+    """Versão asyncio do KermartinProcessor"""
+
+    def __init__(self):
+        # Cliente é obtido por event loop em get_async_client()
+        self.client = None
+        self.model = settings.OPENAI_MODEL
+        self.max_tokens = settings.OPENAI_MAX_TOKENS
+        self.security = SecurityValidator()
+        self.extraction_store = ExtractionStore()
+        self.cache_manager = KermartinCacheManager()
+
+    @traced('analysis.document')
+    async def aanalyze_document(
+        self,
+        documento: Documento,
+        bloco: int,
+        subetapa: int,
+        sessao: SessaoAnalise
+    ) -> Dict:
+        """
+        Analisa um documento com os chunks enviados em paralelo
+
+        Args:
+            documento: Instância do modelo Documento
+            bloco: Número do bloco (1-4)
+            subetapa: Número da subetapa (1-6)
+            sessao: Sessão de análise atual
+
+        Returns:
+            Dict com resultado da análise
+        """
+
+        current_span().set_attributes(documento=str(documento.id), bloco=bloco, subetapa=subetapa)
+
+        try:
+            # Validação de segurança (uma vez por conteúdo e versão das regras); hash,
+            # cache e leitura das páginas em disco rodam fora do event loop
+            content_hash = await sync_to_async(self._content_hash, thread_sensitive=False)(documento)
+            valido = await sync_to_async(self._validate_document, thread_sensitive=False)(documento, content_hash)
+            if not valido:
+                raise SecurityError("Documento contém conteúdo suspeito")
+
+            # Verificar cache (tags exigem o dono do processo: consulta síncrona)
+            cache_tags = await sync_to_async(self._cache_tags)(documento)
+            if settings.KERMARTIN_SETTINGS['CACHE_ANALYSIS_RESULTS']:
+                with span('analysis.cache_lookup') as lookup:
+                    cached_result = await sync_to_async(self.cache_manager.get_cached_analysis)(
+                        str(documento.id), bloco, subetapa, content_hash, tags=cache_tags
+                    )
+                    lookup.set_attribute('hit', bool(cached_result))
+                if cached_result:
+                    return cached_result
+
+            text_chunks, chunk_size, overlap = await sync_to_async(
+                self._iter_text_chunks, thread_sensitive=False
+            )(documento)
+
+            # Chunks em paralelo, em lotes para não manter todos os prompts de
+            # um documento grande em memória; o semáforo global limita a concorrência real
+            batch_size = max(1, settings.KERMARTIN_SETTINGS.get('OPENAI_ASYNC_MAX_CONCURRENCY', 64))
+            respostas_api = []
+            start_time = time.time()
+            prompt_before, prompt_after = get_prompt_parts(bloco, subetapa)
+            next_prompts = sync_to_async(self._next_prompts, thread_sensitive=False)
+            # Tarefas do gather herdam o escopo da razão de tokens
+            with self._usage_scope(documento, sessao):
+                while True:
+                    prompts = await next_prompts(text_chunks, prompt_before, prompt_after, batch_size)
+                    if not prompts:
+                        break
+                    respostas_api.extend(await self._agather_prompts(prompts))
+            processing_time = time.time() - start_time
+
+            result = self._build_result(
+                bloco, subetapa, self._label_parts([r['content'] for r in respostas_api]),
+                sum(r['tokens_prompt'] for r in respostas_api),
+                sum(r['tokens_response'] for r in respostas_api),
+                sum(r['tokens_total'] for r in respostas_api),
+                processing_time, len(respostas_api), chunk_size, overlap
+            )
+
+            await sync_to_async(self._save_analysis_result)(documento, sessao, result)
+
+            if settings.KERMARTIN_SETTINGS['CACHE_ANALYSIS_RESULTS']:
+                await sync_to_async(self.cache_manager.cache_analysis_result)(
+                    str(documento.id), bloco, subetapa, result,
+                    content_hash=content_hash,
+                    timeout=settings.KERMARTIN_SETTINGS['CACHE_TIMEOUT'],
+                    tags=cache_tags
+                )
+
+            logger.info(f"Análise assíncrona concluída: Bloco {bloco}.{subetapa} - {processing_time:.2f}s")
+            return result
+
+        except Exception as e:
+            logger.error(f"Erro na análise assíncrona: {e}")
+            raise
+
+    @profiled('analysis.process')
+    @traced('analysis.process')
+    async def aanalyze_complete_process(
+        self,
+        documentos: List[Documento],
+        sessao: SessaoAnalise,
+        blocos_selecionados: Optional[List[int]] = None
+    ) -> Dict:
+        """
+        Executa todas as subetapas de todos os documentos concorrentemente
+
+        Args:
+            documentos: Lista de documentos do processo
+            sessao: Sessão de análise
+            blocos_selecionados: Blocos a analisar (default: todos)
+
+        Returns:
+            Dict com resultados consolidados
+        """
+
+        if not blocos_selecionados:
+            blocos_selecionados = [1, 2, 3, 4]
+
+        etapas = [
+            (bloco, subetapa, documento)
+            for bloco in blocos_selecionados
+            for subetapa in range(1, self._get_max_subetapas(bloco) + 1)
+            for documento in documentos
+        ]
+
+        progress = self._session_progress(sessao)
+
+        # Tarefas do gather herdam o contexto: todos os resultados vão para o mesmo buffer
+        with self._buffered_results() as buffer:
+            try:
+                sessao.status = 'em_progresso'
+                await sessao.asave(update_fields=['status', 'updated_at'])
+
+                async def executar(bloco, subetapa, documento):
+                    resultado = await self.aanalyze_document(documento, bloco, subetapa, sessao)
+                    # Progresso aproximado: última subetapa concluída (gravado com intervalo mínimo)
+                    if progress.set(bloco_atual=bloco, subetapa_atual=subetapa):
+                        await progress.asave()
+                    return resultado
+
+                saidas = await asyncio.gather(
+                    *(executar(b, s, d) for b, s, d in etapas),
+                    return_exceptions=True
+                )
+
+                resultados = {f'bloco_{bloco}': {} for bloco in blocos_selecionados}
+                total_tokens = 0
+                total_time = 0
+
+                for (bloco, subetapa, documento), saida in zip(etapas, saidas):
+                    if isinstance(saida, BaseException):
+                        logger.error(f"Erro na análise do documento {documento.id}: {saida}")
+                        continue
+                    doc_key = f"documento_{documento.id}"
+                    resultados[f'bloco_{bloco}'].setdefault(doc_key, {})[f'subetapa_{subetapa}'] = saida
+                    total_tokens += saida['tokens_total']
+                    total_time += saida['tempo_processamento']
+
+                # Resultados ainda no buffer vão ao banco antes de concluir a sessão
+                await sync_to_async(self._flush_results)(buffer)
+                await sync_to_async(sessao.finalizar_sessao)()
+
+                consolidado = {
+                    'sessao_id': str(sessao.id),
+                    'status': 'concluida',
+                    'resultados': resultados,
+                    'estatisticas': {
+                        'total_tokens': total_tokens,
+                        'total_tempo': total_time,
+                        'documentos_analisados': len(documentos),
+                        'blocos_processados': len(blocos_selecionados)
+                    }
+                }
+
+                logger.info(f"Análise completa assíncrona finalizada: {total_time:.2f}s, {total_tokens} tokens")
+                return consolidado
+
+            except Exception as e:
+                # Resultados já obtidos não se perdem com a falha da sessão
+                try:
+                    await sync_to_async(self._flush_results)(buffer)
+                except Exception as flush_error:
+                    logger.error(f"Erro ao gravar resultados pendentes: {flush_error}")
+                sessao.status = 'erro'
+                await sessao.asave(update_fields=['status', 'bloco_atual', 'subetapa_atual', 'updated_at'])
+                logger.error(f"Erro na análise completa assíncrona: {e}")
+                raise
+
+    def _next_prompts(
+        self, text_chunks: Iterator[str], prompt_before: str, prompt_after: str, limit: int
+    ) -> List[str]:
+        """Próximo lote de prompts: lê, valida e monta até `limit` chunks (roda em thread)"""
+        prompts = []
+        for piece in itertools.islice(text_chunks, limit):
+            if not self.security.validate_prompt_parts(prompt_before, piece, prompt_after):
+                raise SecurityError("Tentativa de prompt injection detectada")
+            with span('prompt.render', chars=len(piece)):
+                prompts.append(prompt_before + piece + prompt_after)
+        return prompts
+
+    async def _agather_prompts(self, prompts: List[str]) -> List[Dict]:
+        """Envia um lote de prompts em paralelo, mantendo a ordem das respostas"""
+        return await asyncio.gather(
+            *(self._acall_openai_with_retry(prompt) for prompt in prompts)
+        )
+
+    async def _acall_openai(self, prompt: str) -> Dict:
+        """Chama a API da OpenAI (uma tentativa, assíncrona)"""
+        started = time.perf_counter()
+        try:
+            with span('llm.generate', model=self.model):
+                response = await get_async_client().chat.completions.create(
+                    model=self.model,
+                    messages=self._build_messages(prompt),
+                    max_tokens=self.max_tokens,
+                    temperature=0.1,
+                    top_p=0.9
+                )
+        except Exception as e:
+            self._observe_call(started, error=e)
+            raise
+        result = self._parse_completion(response)
+        self._observe_call(started, result=result)
+        return result
+
+    async def _acall_openai_with_retry(self, prompt: str) -> Dict:
+        """Chamada assíncrona com backoff em 429; o semáforo não é retido durante a espera"""
+        max_attempts = settings.KERMARTIN_SETTINGS.get('OPENAI_RETRY_MAX_ATTEMPTS', 6)
+        limiter = get_concurrency_limiter()
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                # Espera por uma vaga no semáforo global (fila local antes da OpenAI)
+                with span('llm.queue', motivo='concorrencia', tentativa=attempt):
+                    await limiter.acquire()
+                try:
+                    return await self._acall_openai(prompt)
+                finally:
+                    limiter.release()
+            except Exception as e:
+                if self._is_rate_limit_error(e):
+                    if attempt >= max_attempts:
+                        logger.error(f"OpenAI rate limit após {attempt} tentativas: {e}")
+                        raise
+                    delay = self._retry_delay(attempt)
+                    logger.warning(f"Rate limit: tentativa {attempt}/{max_attempts}, aguardando {delay:.2f}s")
+                    with span('llm.queue', motivo='rate_limit', tentativa=attempt):
+                        await asyncio.sleep(delay)
+                    continue
+                raise
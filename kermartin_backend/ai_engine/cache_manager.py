@@ -3,23 +3,133 @@ Sistema de Cache Avançado para Kermartin 3.0
 Otimização de performance para análises de IA
 """
 
+import time
 import hashlib
 import json
 import logging
-from typing import Dict, Optional, Any
-from django.core.cache import cache
+from typing import Callable, Dict, Iterable, List, Optional, Any
 from django.conf import settings
+from .tiered_cache import get_tiered_cache
+from .cache_stats import get_cache_stats
 from datetime import datetime, timedelta
 
 logger = logging.getLogger('ai_engine')
 
 
 class KermartinCacheManager:
-    """Gerenciador de cache especializado para o Kermartin"""
+    """
+    Gerenciador de cache especializado para o Kermartin
+    
+    Invalidação por tags: cada entrada carrega as gerações das suas tags
+    (documento, processo, usuário) na chave. Invalidar uma tag incrementa a
+    sua geração, e todas as entradas antigas deixam de ser encontradas e
+    expiram pelo TTL.
+    """
     
     def __init__(self):
         self.default_timeout = getattr(settings, 'KERMARTIN_CACHE_TIMEOUT', 3600)  # 1 hora
         self.prefix = 'kermartin_3_0'
+        # L1 em memória + Redis; gerações de tags também passam pelo L1 (TTL curto)
+        self.cache = get_tiered_cache()
+    
+    # Tags
+    
+    @staticmethod
+    def tags_for(
+        documento_id: Any = None,
+        processo_id: Any = None,
+        user_id: Any = None
+    ) -> List[str]:
+        """Monta a lista de tags de uma entrada (user_id é o id do User do Django)"""
+        
+        tags = []
+        if documento_id is not None:
+            tags.append(f"documento:{documento_id}")
+        if processo_id is not None:
+            tags.append(f"processo:{processo_id}")
+        if user_id is not None:
+            tags.append(f"user:{user_id}")
+        return tags
+    
+    def _generation_key(self, tag: str) -> str:
+        return f"{self.prefix}_gen_{tag}"
+    
+    def get_tag_generations(self, tags: Iterable[str]) -> List[int]:
+        """Gerações atuais das tags, numa única ida ao cache"""
+        
+        keys = [self._generation_key(tag) for tag in tags]
+        if not keys:
+            return []
+        
+        generations = self.cache.get_many(keys)
+        for key in keys:
+            if key not in generations:
+                # Semente pelo relógio: se a geração for despejada do cache, a nova
+                # é maior que as anteriores e entradas antigas não "ressuscitam"
+                self.cache.add(key, time.time_ns() // 1000, timeout=None)
+                generations[key] = self.cache.get(key, 0)
+        
+        return [generations[key] for key in keys]
+    
+    def tagged_key(self, key: str, tags: Iterable[str]) -> str:
+        """Chave final de uma entrada: chave base + gerações das tags"""
+        
+        generations = self.get_tag_generations(tags)
+        if not generations:
+            return key
+        return f"{key}_g{'.'.join(str(g) for g in generations)}"
+    
+    def invalidate_tags(self, *tags: str) -> bool:
+        """Invalida todas as entradas das tags em O(1) por tag"""
+        
+        try:
+            for tag in tags:
+                key = self._generation_key(tag)
+                try:
+                    self.cache.incr(key)
+                except ValueError:
+                    # Sem geração registrada: nenhuma entrada pode usá-la ainda
+                    self.cache.add(key, time.time_ns() // 1000, timeout=None)
+            
+            logger.info(f"Tags de cache invalidadas: {', '.join(tags)}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Erro ao invalidar tags de cache: {e}")
+            return False
+    
+    def get_tagged(self, key: str, tags: Iterable[str], default: Any = None) -> Any:
+        """Lê uma entrada com tags"""
+        
+        try:
+            return self.cache.get(self.tagged_key(key, tags), default)
+        except Exception as e:
+            logger.error(f"Erro ao recuperar cache: {e}")
+            return default
+    
+    def set_tagged(self, key: str, value: Any, tags: Iterable[str], timeout: int = None) -> bool:
+        """Grava uma entrada com tags"""
+        
+        try:
+            self.cache.set(self.tagged_key(key, tags), value, timeout=timeout or self.default_timeout)
+            return True
+        except Exception as e:
+            logger.error(f"Erro ao gravar cache: {e}")
+            return False
+    
+    def get_or_set_tagged(
+        self,
+        key: str,
+        tags: Iterable[str],
+        compute: Callable[[], Any],
+        timeout: int = None
+    ) -> Any:
+        """Lê uma entrada com tags ou a calcula uma única vez entre processos concorrentes"""
+        return self.cache.get_or_set(
+            self.tagged_key(key, tags), compute, timeout=timeout or self.default_timeout
+        )
+    
+    # Chaves
     
     def get_analysis_cache_key(self, documento_id: str, bloco: int, subetapa: int, content_hash: str = None) -> str:
         """Gera chave de cache para análise"""
@@ -48,12 +158,16 @@ class KermartinCacheManager:
         subetapa: int, 
         result: Dict,
         content_hash: str = None,
-        timeout: int = None
+        timeout: int = None,
+        tags: Optional[List[str]] = None
     ) -> bool:
         """Armazena resultado de análise no cache"""
         
         try:
-            cache_key = self.get_analysis_cache_key(documento_id, bloco, subetapa, content_hash)
+            cache_key = self.tagged_key(
+                self.get_analysis_cache_key(documento_id, bloco, subetapa, content_hash),
+                tags or self.tags_for(documento_id=documento_id)
+            )
             
             # Preparar dados para cache
             cache_data = {
@@ -65,7 +179,7 @@ class KermartinCacheManager:
             }
             
             timeout = timeout or self.default_timeout
-            success = cache.set(cache_key, cache_data, timeout=timeout)
+            success = self.cache.set(cache_key, cache_data, timeout=timeout)
             
             if success:
                 logger.info(f"Resultado de análise cacheado: {cache_key}")
@@ -83,13 +197,17 @@ class KermartinCacheManager:
         documento_id: str, 
         bloco: int, 
         subetapa: int,
-        content_hash: str = None
+        content_hash: str = None,
+        tags: Optional[List[str]] = None
     ) -> Optional[Dict]:
         """Recupera resultado de análise do cache"""
         
         try:
-            cache_key = self.get_analysis_cache_key(documento_id, bloco, subetapa, content_hash)
-            cached_data = cache.get(cache_key)
+            cache_key = self.tagged_key(
+                self.get_analysis_cache_key(documento_id, bloco, subetapa, content_hash),
+                tags or self.tags_for(documento_id=documento_id)
+            )
+            cached_data = self.cache.get(cache_key)
             
             if cached_data:
                 logger.info(f"Resultado encontrado em cache: {cache_key}")
@@ -105,7 +223,10 @@ class KermartinCacheManager:
         """Cache de análise completa de documento"""
         
         try:
-            cache_key = self.get_document_cache_key(documento_id, 'full_analysis')
+            cache_key = self.tagged_key(
+                self.get_document_cache_key(documento_id, 'full_analysis'),
+                self.tags_for(documento_id=documento_id)
+            )
             
             cache_data = {
                 'analysis': analysis_data,
@@ -114,7 +235,7 @@ class KermartinCacheManager:
             }
             
             timeout = timeout or (self.default_timeout * 2)  # 2 horas para análise completa
-            return cache.set(cache_key, cache_data, timeout=timeout)
+            return self.cache.set(cache_key, cache_data, timeout=timeout)
             
         except Exception as e:
             logger.error(f"Erro ao cachear análise de documento: {e}")
@@ -124,8 +245,11 @@ class KermartinCacheManager:
         """Recupera análise completa de documento do cache"""
         
         try:
-            cache_key = self.get_document_cache_key(documento_id, 'full_analysis')
-            cached_data = cache.get(cache_key)
+            cache_key = self.tagged_key(
+                self.get_document_cache_key(documento_id, 'full_analysis'),
+                self.tags_for(documento_id=documento_id)
+            )
+            cached_data = self.cache.get(cache_key)
             
             if cached_data:
                 return cached_data['analysis']
@@ -140,7 +264,10 @@ class KermartinCacheManager:
         """Cache de estatísticas do usuário"""
         
         try:
-            cache_key = self.get_user_cache_key(user_id, 'statistics')
+            cache_key = self.tagged_key(
+                self.get_user_cache_key(user_id, 'statistics'),
+                self.tags_for(user_id=user_id)
+            )
             
             cache_data = {
                 'stats': stats,
@@ -149,7 +276,7 @@ class KermartinCacheManager:
             }
             
             timeout = timeout or 1800  # 30 minutos para estatísticas
-            return cache.set(cache_key, cache_data, timeout=timeout)
+            return self.cache.set(cache_key, cache_data, timeout=timeout)
             
         except Exception as e:
             logger.error(f"Erro ao cachear estatísticas: {e}")
@@ -159,8 +286,11 @@ class KermartinCacheManager:
         """Recupera estatísticas do usuário do cache"""
         
         try:
-            cache_key = self.get_user_cache_key(user_id, 'statistics')
-            cached_data = cache.get(cache_key)
+            cache_key = self.tagged_key(
+                self.get_user_cache_key(user_id, 'statistics'),
+                self.tags_for(user_id=user_id)
+            )
+            cached_data = self.cache.get(cache_key)
             
             if cached_data:
                 return cached_data['stats']
@@ -171,73 +301,33 @@ class KermartinCacheManager:
             logger.error(f"Erro ao recuperar cache de estatísticas: {e}")
             return None
     
-    def invalidate_analysis_cache(self, documento_id: str, bloco: int = None, subetapa: int = None) -> bool:
-        """Invalida cache de análise específica ou todas de um documento"""
-        
-        try:
-            if bloco and subetapa:
-                # Invalidar análise específica
-                cache_key = self.get_analysis_cache_key(documento_id, bloco, subetapa)
-                cache.delete(cache_key)
-                logger.info(f"Cache invalidado: {cache_key}")
-            else:
-                # Invalidar todas as análises do documento
-                # Isso requer uma implementação mais complexa com padrões
-                self.invalidate_document_cache(documento_id)
-            
-            return True
-            
-        except Exception as e:
-            logger.error(f"Erro ao invalidar cache: {e}")
-            return False
+    def invalidate_analysis_cache(self, documento_id: str) -> bool:
+        """Invalida todas as análises de um documento"""
+        return self.invalidate_document_cache(documento_id)
     
     def invalidate_document_cache(self, documento_id: str) -> bool:
         """Invalida todo o cache relacionado a um documento"""
-        
-        try:
-            # Invalidar análise completa
-            cache_key = self.get_document_cache_key(documento_id, 'full_analysis')
-            cache.delete(cache_key)
-            
-            # Invalidar análises individuais (implementação simplificada)
-            for bloco in range(1, 5):
-                max_subetapas = 6 if bloco == 1 else 5
-                for subetapa in range(1, max_subetapas + 1):
-                    cache_key = self.get_analysis_cache_key(documento_id, bloco, subetapa)
-                    cache.delete(cache_key)
-            
-            logger.info(f"Cache de documento invalidado: {documento_id}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Erro ao invalidar cache de documento: {e}")
-            return False
+        return self.invalidate_tags(*self.tags_for(documento_id=documento_id))
+    
+    def invalidate_processo_cache(self, processo_id: str) -> bool:
+        """Invalida todo o cache dos documentos e análises de um processo"""
+        return self.invalidate_tags(*self.tags_for(processo_id=processo_id))
     
     def invalidate_user_cache(self, user_id: str) -> bool:
-        """Invalida cache do usuário"""
-        
-        try:
-            cache_key = self.get_user_cache_key(user_id, 'statistics')
-            cache.delete(cache_key)
-            
-            logger.info(f"Cache de usuário invalidado: {user_id}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Erro ao invalidar cache de usuário: {e}")
-            return False
+        """Invalida todo o cache do usuário (estatísticas, métricas e análises)"""
+        return self.invalidate_tags(*self.tags_for(user_id=user_id))
     
     def get_cache_statistics(self) -> Dict:
         """Retorna estatísticas do cache"""
         
         try:
-            # Esta implementação depende do backend de cache usado
-            # Para Redis, seria possível obter estatísticas mais detalhadas
-            
+            cache_stats = get_cache_stats()
             stats = {
-                'cache_backend': str(cache.__class__),
+                'cache_backend': settings.CACHES['default']['BACKEND'],
                 'default_timeout': self.default_timeout,
                 'prefix': self.prefix,
+                'hit_rate': cache_stats.overall_hit_rate(),
+                'namespaces': cache_stats.snapshot(),
                 'timestamp': datetime.now().isoformat()
             }
             
@@ -262,7 +352,7 @@ class KermartinCacheManager:
             }
             
             cache_key = self.get_document_cache_key(documento_id, 'metadata')
-            cache.set(cache_key, metadata, timeout=self.default_timeout * 4)  # 4 horas
+            self.cache.set(cache_key, metadata, timeout=self.default_timeout * 4)  # 4 horas
             
             logger.info(f"Cache pré-aquecido para documento: {documento_id}")
             return True
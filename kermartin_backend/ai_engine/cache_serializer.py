@@ -0,0 +1,162 @@
+"""
+Serializador de Cache do Kermartin 3.0
+Envelope versionado com codificação compacta (msgpack/orjson) e compressão
+(zstd/zlib) acima de um tamanho mínimo, no lugar do pickle puro dos backends Redis
+"""
+
+import zlib
+import pickle
+import logging
+import threading
+from typing import Any, Dict, Optional
+from django.conf import settings
+
+logger = logging.getLogger('ai_engine')
+
+try:
+    import msgpack
+except ImportError:  # opcional: sem msgpack, orjson ou pickle
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # opcional: sem zstd, zlib
+    zstandard = None
+
+
+# Envelope: MAGIC + versão + codec + compressão + payload
+MAGIC = b'\xabK'
+ENVELOPE_VERSION = 1
+
+CODEC_PICKLE = b'p'
+CODEC_MSGPACK = b'm'
+CODEC_ORJSON = b'j'
+
+COMPRESSION_NONE = b'0'
+COMPRESSION_ZLIB = b'z'
+COMPRESSION_ZSTD = b's'
+
+_HEADER_SIZE = len(MAGIC) + 3
+
+# Bytes do último valor serializado nesta thread (lido pelo InstrumentedCache sem serializar de novo)
+_last_dumps = threading.local()
+
+
+def pop_last_dumps_size() -> Optional[int]:
+    """Tamanho gravado pelo último dumps() desta thread, ou None; zera a leitura"""
+    size = getattr(_last_dumps, 'size', None)
+    _last_dumps.size = None
+    return size
+
+
+_JSON_SCALARS = (str, int, float, bool, type(None))
+
+
+def _json_native(obj: Any) -> bool:
+    """
+    Valor que o JSON devolve com os mesmos tipos; o orjson converteria
+    datetime, UUID, dataclasses, tuplas e subclasses em outros tipos sem erro
+    """
+    kind = type(obj)
+    if kind in _JSON_SCALARS:
+        return True
+    if kind is list:
+        return all(_json_native(value) for value in obj)
+    if kind is dict:
+        return all(type(key) is str and _json_native(value) for key, value in obj.items())
+    return False
+
+
+class KermartinCacheSerializer:
+    """
+    Serializador plugável para os backends Redis
+
+    Compatível com o backend nativo do Django (OPTIONS['serializer']) e com o
+    django-redis (OPTIONS['SERIALIZER']). Inteiros são gravados sem envelope
+    para que INCR continue funcionando; valores que o codec compacto não
+    representa (sets, datetimes, UUIDs, dataclasses, chaves não-string) caem
+    para pickle, assim como tuplas e subclasses (SafeString, OrderedDict,
+    defaultdict...), que voltariam como list/str/dict: o valor lido tem os
+    mesmos tipos do gravado.
+    Entradas antigas, gravadas só com pickle, continuam legíveis.
+    """
+
+    def __init__(self, options: Optional[Dict] = None):
+        kermartin_settings = settings.KERMARTIN_SETTINGS
+        self.compress_min_bytes = kermartin_settings.get('CACHE_COMPRESS_MIN_BYTES', 1024)
+        self.zlib_level = kermartin_settings.get('CACHE_ZLIB_LEVEL', 6)
+        self.zstd_level = kermartin_settings.get('CACHE_ZSTD_LEVEL', 3)
+
+    # Escrita
+
+    def dumps(self, obj: Any) -> Any:
+        if type(obj) is int:
+            _last_dumps.size = len(str(obj))
+            return obj
+
+        codec, payload = self._encode(obj)
+        compression = COMPRESSION_NONE
+        if len(payload) >= self.compress_min_bytes:
+            compression, payload = self._compress(payload)
+
+        data = MAGIC + bytes([ENVELOPE_VERSION]) + codec + compression + payload
+        _last_dumps.size = len(data)
+        return data
+
+    def _encode(self, obj: Any):
+        if msgpack is not None:
+            try:
+                return CODEC_MSGPACK, msgpack.packb(obj, use_bin_type=True, strict_types=True)
+            except (TypeError, ValueError, OverflowError):
+                pass
+        elif orjson is not None and _json_native(obj):
+            try:
+                return CODEC_ORJSON, orjson.dumps(obj)
+            except TypeError:
+                pass
+        return CODEC_PICKLE, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def _compress(self, payload: bytes):
+        if zstandard is not None:
+            return COMPRESSION_ZSTD, zstandard.ZstdCompressor(level=self.zstd_level).compress(payload)
+        return COMPRESSION_ZLIB, zlib.compress(payload, self.zlib_level)
+
+    # Leitura
+
+    def loads(self, data: Any) -> Any:
+        if isinstance(data, int):
+            return data
+
+        if not data.startswith(MAGIC):
+            try:
+                return int(data)
+            except ValueError:
+                # Entrada anterior ao envelope (pickle do backend)
+                return pickle.loads(data)
+
+        version = data[len(MAGIC)]
+        if version != ENVELOPE_VERSION:
+            logger.warning(f"Envelope de cache com versão desconhecida: {version}")
+            return None
+
+        codec = data[len(MAGIC) + 1:len(MAGIC) + 2]
+        compression = data[len(MAGIC) + 2:_HEADER_SIZE]
+        payload = self._decompress(compression, data[_HEADER_SIZE:])
+
+        if codec == CODEC_MSGPACK:
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        if codec == CODEC_ORJSON:
+            return orjson.loads(payload)
+        return pickle.loads(payload)
+
+    def _decompress(self, compression: bytes, payload: bytes) -> bytes:
+        if compression == COMPRESSION_ZSTD:
+            return zstandard.ZstdDecompressor().decompress(payload)
+        if compression == COMPRESSION_ZLIB:
+            return zlib.decompress(payload)
+        return payload
@@ -0,0 +1,320 @@
+"""
+Instrumentação do Cache do Kermartin 3.0
+Acertos, faltas, escritas, despejos, bytes e latência por namespace de chave,
+acumulados em memória e somados no Redis em lote
+"""
+
+import time
+import atexit
+import pickle
+import logging
+import itertools
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Optional
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from .cache_serializer import pop_last_dumps_size
+from core.redis_utils import get_redis_client, make_redis_key
+
+logger = logging.getLogger('ai_engine')
+
+_MISSING = object()
+
+NAMESPACES = ('analysis', 'doc', 'user', 'metrics', 'rate_limit', 'tags', 'other')
+
+# Limites superiores (ms) dos buckets do histograma de latência
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+_BUCKET_LABELS = tuple(str(b) for b in LATENCY_BUCKETS_MS) + ('inf',)
+
+COUNTERS = ('hits_l1', 'hits', 'misses', 'sets', 'deletes', 'evictions', 'bytes_written')
+FIELDS = COUNTERS + tuple(
+    f"lat_{op}_{label}" for op in ('get', 'set') for label in _BUCKET_LABELS
+)
+
+# Ordem importa: o primeiro padrão encontrado na chave define o namespace
+_NAMESPACE_PATTERNS = (
+    ('_gen_', 'tags'),
+    ('rate_limit', 'rate_limit'),
+    ('blocked_ip', 'rate_limit'),
+    ('blocked_networks', 'rate_limit'),
+    ('_analysis_', 'analysis'),
+    ('kermartin_analysis_', 'analysis'),
+    ('_metrics', 'metrics'),
+    ('kermartin_system_overview', 'metrics'),
+    ('_doc_', 'doc'),
+    ('_user_', 'user'),
+)
+
+
+def namespace_for(key: str) -> str:
+    """Namespace de uma chave de cache"""
+    for pattern, namespace in _NAMESPACE_PATTERNS:
+        if pattern in key:
+            return namespace
+    return 'other'
+
+
+class CacheStats:
+    """
+    Contadores por namespace
+
+    Cada processo acumula as contagens localmente e as soma no Redis a cada
+    CACHE_STATS_FLUSH_SEC (HINCRBY em pipeline, uma ida ao Redis por flush).
+    Sem Redis (testes/desenvolvimento), usa cache.incr no backend configurado.
+    """
+
+    HASH_PREFIX = 'kermartin_cache_stats'
+
+    def __init__(self, backend=None, flush_interval: Optional[float] = None):
+        self.backend = backend or default_cache
+        self.flush_interval = (
+            flush_interval if flush_interval is not None
+            else settings.KERMARTIN_SETTINGS.get('CACHE_STATS_FLUSH_SEC', 10.0)
+        )
+        self._pending = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    # Registro
+
+    def record(
+        self,
+        namespace: str,
+        event: str,
+        latency: Optional[float] = None,
+        nbytes: int = 0,
+        count: int = 1
+    ) -> None:
+        """Registra um evento (hits, misses, sets...) com latência em segundos"""
+
+        with self._lock:
+            counters = self._pending[namespace]
+            counters[event] += count
+            if nbytes:
+                counters['bytes_written'] += nbytes
+            if latency is not None:
+                op = 'set' if event in ('sets', 'deletes') else 'get'
+                label = _BUCKET_LABELS[bisect_left(LATENCY_BUCKETS_MS, latency * 1000)]
+                counters[f"lat_{op}_{label}"] += 1
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        """Soma as contagens pendentes no armazenamento compartilhado"""
+
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(lambda: defaultdict(int))
+            self._last_flush = time.monotonic()
+
+        if not pending:
+            return
+
+        try:
+            client = get_redis_client()
+            if client is not None:
+                pipe = client.pipeline(transaction=False)
+                for namespace, counters in pending.items():
+                    redis_key = make_redis_key(self._hash_key(namespace))
+                    for field, value in counters.items():
+                        pipe.hincrby(redis_key, field, value)
+                pipe.execute()
+            else:
+                for namespace, counters in pending.items():
+                    for field, value in counters.items():
+                        key = self._field_key(namespace, field)
+                        if not self.backend.add(key, value, timeout=None):
+                            self.backend.incr(key, value)
+        except Exception as e:
+            logger.error(f"Erro ao gravar estatísticas de cache: {e}")
+
+    # Leitura
+
+    def snapshot(self, namespaces: Iterable[str] = NAMESPACES) -> Dict[str, Dict]:
+        """Totais agregados de todos os processos (inclui o pendente deste processo)"""
+
+        self.flush()
+        namespaces = list(namespaces)
+        raw = {namespace: {} for namespace in namespaces}
+
+        try:
+            client = get_redis_client(write=False)
+            if client is not None:
+                pipe = client.pipeline(transaction=False)
+                for namespace in namespaces:
+                    pipe.hgetall(make_redis_key(self._hash_key(namespace)))
+                for namespace, values in zip(namespaces, pipe.execute()):
+                    raw[namespace] = {
+                        (k.decode() if isinstance(k, bytes) else k): int(v)
+                        for k, v in values.items()
+                    }
+            else:
+                keys = {
+                    self._field_key(namespace, field): (namespace, field)
+                    for namespace in namespaces for field in FIELDS
+                }
+                for key, value in self.backend.get_many(list(keys)).items():
+                    namespace, field = keys[key]
+                    raw[namespace][field] = value
+        except Exception as e:
+            logger.error(f"Erro ao ler estatísticas de cache: {e}")
+
+        return {namespace: self._summarize(values) for namespace, values in raw.items()}
+
+    def overall_hit_rate(self) -> float:
+        """Taxa de acerto global (%) considerando L1 e Redis"""
+        totals = defaultdict(int)
+        for summary in self.snapshot().values():
+            for field in ('hits_l1', 'hits', 'misses'):
+                totals[field] += summary[field]
+        lookups = totals['hits_l1'] + totals['hits'] + totals['misses']
+        if not lookups:
+            return 0.0
+        return round((totals['hits_l1'] + totals['hits']) / lookups * 100, 2)
+
+    def reset(self) -> None:
+        """Zera contadores locais e compartilhados"""
+
+        with self._lock:
+            self._pending = defaultdict(lambda: defaultdict(int))
+        client = get_redis_client()
+        if client is not None:
+            client.delete(*[make_redis_key(self._hash_key(ns)) for ns in NAMESPACES])
+        else:
+            self.backend.delete_many([
+                self._field_key(ns, field) for ns in NAMESPACES for field in FIELDS
+            ])
+
+    def _summarize(self, values: Dict[str, int]) -> Dict[str, Any]:
+        summary = {field: values.get(field, 0) for field in COUNTERS}
+        lookups = summary['hits_l1'] + summary['hits'] + summary['misses']
+        summary['hit_rate'] = (
+            round((summary['hits_l1'] + summary['hits']) / lookups * 100, 2) if lookups else 0.0
+        )
+        summary['latency_ms'] = {
+            op: {label: values.get(f"lat_{op}_{label}", 0) for label in _BUCKET_LABELS}
+            for op in ('get', 'set')
+        }
+        return summary
+
+    def _hash_key(self, namespace: str) -> str:
+        return f"{self.HASH_PREFIX}:{namespace}"
+
+    def _field_key(self, namespace: str, field: str) -> str:
+        return f"{self.HASH_PREFIX}_{namespace}_{field}"
+
+
+class InstrumentedCache:
+    """Envoltório do cache do Django que registra cada operação em CacheStats"""
+
+    def __init__(self, backend=None, stats: Optional[CacheStats] = None):
+        self.backend = backend or default_cache
+        self.stats = stats or get_cache_stats()
+        self.size_sample_every = max(1, settings.KERMARTIN_SETTINGS.get('CACHE_STATS_SIZE_SAMPLE_EVERY', 20))
+        self._writes = itertools.count()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        started = time.perf_counter()
+        value = self.backend.get(key, _MISSING)
+        elapsed = time.perf_counter() - started
+        if value is _MISSING:
+            self.stats.record(namespace_for(key), 'misses', elapsed)
+            return default
+        self.stats.record(namespace_for(key), 'hits', elapsed)
+        return value
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        started = time.perf_counter()
+        found = self.backend.get_many(keys)
+        elapsed = time.perf_counter() - started
+        for key in keys:
+            self.stats.record(namespace_for(key), 'hits' if key in found else 'misses', elapsed)
+        return found
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = None) -> None:
+        pop_last_dumps_size()
+        started = time.perf_counter()
+        self.backend.set(key, value, timeout=timeout)
+        elapsed = time.perf_counter() - started
+        self.stats.record(namespace_for(key), 'sets', elapsed, self._written_size(value))
+
+    def add(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        pop_last_dumps_size()
+        started = time.perf_counter()
+        added = self.backend.add(key, value, timeout=timeout)
+        elapsed = time.perf_counter() - started
+        if added:
+            self.stats.record(namespace_for(key), 'sets', elapsed, self._written_size(value))
+        return added
+
+    def incr(self, key: str, delta: int = 1) -> int:
+        started = time.perf_counter()
+        value = self.backend.incr(key, delta)
+        self.stats.record(namespace_for(key), 'sets', time.perf_counter() - started)
+        return value
+
+    def delete(self, key: str) -> None:
+        started = time.perf_counter()
+        self.backend.delete(key)
+        self.stats.record(namespace_for(key), 'deletes', time.perf_counter() - started)
+
+    def _written_size(self, value: Any) -> int:
+        """
+        Bytes gravados: os produzidos pelo KermartinCacheSerializer nesta escrita;
+        sem ele (backend com pickle próprio), pickle de 1 a cada
+        CACHE_STATS_SIZE_SAMPLE_EVERY escritas, multiplicado para estimar o total
+        """
+        size = pop_last_dumps_size()
+        if size is not None:
+            return size
+        if next(self._writes) % self.size_sample_every:
+            return 0
+        try:
+            return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) * self.size_sample_every
+        except Exception:
+            return 0
+
+    def __getattr__(self, name):
+        # Demais operações (clear, touch...) vão direto ao backend
+        return getattr(self.backend, name)
+
+
+_stats = None
+_instrumented = None
+_singleton_lock = threading.RLock()
+
+
+def get_cache_stats() -> CacheStats:
+    """CacheStats compartilhado do processo"""
+    global _stats
+    if _stats is None:
+        with _singleton_lock:
+            if _stats is None:
+                _stats = CacheStats()
+                atexit.register(_stats.flush)
+    return _stats
+
+
+def get_instrumented_cache() -> InstrumentedCache:
+    """Cache do Django instrumentado, compartilhado do processo"""
+    global _instrumented
+    if _instrumented is None:
+        with _singleton_lock:
+            if _instrumented is None:
+                _instrumented = InstrumentedCache(stats=get_cache_stats())
+    return _instrumented
+
+
+@receiver(setting_changed)
+def _reset_cache_stats(setting, **kwargs):
+    """Descarta as instâncias quando CACHES/KERMARTIN_SETTINGS mudam (testes)"""
+    global _stats, _instrumented
+    if setting in ('CACHES', 'KERMARTIN_SETTINGS'):
+        _stats = None
+        _instrumented = None
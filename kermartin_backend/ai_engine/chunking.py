@@ -0,0 +1,50 @@
+"""
+Divisão de textos em partes (chunks) para o Kermartin 3.0
+Aceita o texto inteiro ou um fluxo de páginas, cortando preferencialmente em parágrafos
+"""
+
+from typing import Iterable, Iterator, List
+
+# Separadores preferidos para o corte, do mais forte ao mais fraco
+BOUNDARIES = ('\n\n', '\n', '. ')
+
+
+def _cut_position(buffer: str, size: int) -> int:
+    """Posição de corte em buffer[:size], sem recuar mais que metade do chunk"""
+    min_cut = size // 2
+    for sep in BOUNDARIES:
+        pos = buffer.rfind(sep, min_cut, size)
+        if pos != -1:
+            return pos + len(sep)
+    return size
+
+
+def iter_chunks(pieces: Iterable[str], size: int, overlap: int) -> Iterator[str]:
+    """
+    Gera chunks de até ``size`` caracteres com ``overlap`` de sobreposição,
+    consumindo ``pieces`` (ex.: páginas) sob demanda
+
+    Args:
+        pieces: Partes do texto na ordem (páginas, linhas ou o texto inteiro)
+        size: Tamanho máximo de cada chunk
+        overlap: Caracteres repetidos no início do chunk seguinte
+    """
+
+    buffer = ''
+    emitted = False
+
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) > size:
+            cut = _cut_position(buffer, size)
+            yield buffer[:cut]
+            emitted = True
+            buffer = buffer[max(cut - overlap, 1):]
+
+    if buffer or not emitted:
+        yield buffer
+
+
+def make_chunks(text: str, size: int, overlap: int) -> List[str]:
+    """Versão em lista de iter_chunks para um texto já em memória"""
+    return list(iter_chunks([text], size, overlap))
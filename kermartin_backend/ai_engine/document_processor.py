@@ -4,12 +4,20 @@ Extração de texto de PDFs e processamento de documentos jurídicos
 """
 
 import os
+import math
 import hashlib
 import logging
-from typing import Optional, Dict, List
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Dict, Iterable, Iterator, List, Tuple
 import fitz  # PyMuPDF
-import pdfplumber
 from django.conf import settings
+from core.tracing import traced
+from .extraction_store import ExtractionStore
+from .pdf_workers import (
+    clean_page_text, format_page, extract_page_range,
+    extract_pages_with_pdfplumber, extract_page_range_to_dir,
+)
 
 logger = logging.getLogger('ai_engine')
 
@@ -18,9 +26,134 @@ class DocumentProcessor:
     """Processador de documentos PDF"""
     
     def __init__(self):
-        self.max_file_size = 10 * 1024 * 1024  # 10MB
+        self.max_file_size = settings.KERMARTIN_SETTINGS.get('MAX_DOCUMENT_SIZE', 10 * 1024 * 1024)
+        self.large_document_threshold = settings.KERMARTIN_SETTINGS.get(
+            'LARGE_DOCUMENT_THRESHOLD', 10 * 1024 * 1024
+        )
         self.supported_formats = ['.pdf']
+        self.store = ExtractionStore()
     
+    @traced('document.process')
+    def process_document(self, file_path: str, file_hash: Optional[str] = None) -> Dict:
+        """
+        Extrai texto, estrutura e informações-chave, reaproveitando extrações
+        anteriores do mesmo arquivo (SHA-256) sem reabrir o PDF
+        
+        Args:
+            file_path: Caminho para o arquivo PDF
+            file_hash: SHA-256 já calculado do arquivo (opcional)
+            
+        Returns:
+            Dict com hash, texto, estrutura, informacoes_chave e cache_hit.
+            Em modo documento grande, ``texto`` é apenas uma prévia e as
+            páginas ficam no armazenamento em disco (ver iter_document_pages).
+        """
+        
+        file_hash = file_hash or self.generate_file_hash(file_path)
+        
+        stored = self.store.get(file_hash)
+        if stored:
+            logger.info(f"Extração reaproveitada: {file_hash[:16]}")
+            return {**stored, 'hash': file_hash, 'cache_hit': True}
+        
+        if os.path.getsize(file_path) > self.large_document_threshold:
+            data = self.extract_large_document(file_path, file_hash)
+        else:
+            texto = self.extract_text_from_pdf(file_path)
+            data = {
+                'texto': texto,
+                'estrutura': self.analyze_document_structure(texto),
+                'informacoes_chave': self.extract_key_information(texto),
+            }
+        self.store.put(file_hash, data)
+        
+        return {**data, 'hash': file_hash, 'cache_hit': False}
+    
+    @traced('pdf.extract_large')
+    def extract_large_document(self, file_path: str, file_hash: str) -> Dict:
+        """
+        Modo documento grande: páginas extraídas e gravadas uma a uma em disco,
+        com memória constante independentemente do tamanho do PDF
+        
+        Args:
+            file_path: Caminho para o arquivo PDF
+            file_hash: SHA-256 do arquivo (chave do armazenamento)
+            
+        Returns:
+            Dict com prévia do texto, estrutura, informações-chave e contagens
+        """
+        
+        file_size = os.path.getsize(file_path)
+        if file_size > self.max_file_size:
+            raise ValueError(f"Arquivo muito grande: {file_size} bytes")
+        
+        with fitz.open(file_path) as doc:
+            page_count = len(doc)
+        
+        ranges = self._page_ranges(page_count)
+        min_chars = settings.KERMARTIN_SETTINGS.get('PDF_MIN_PAGE_CHARS', 20)
+        
+        def extract_pages(out_dir: str) -> Dict[str, int]:
+            if len(ranges) <= 1:
+                return extract_page_range_to_dir(file_path, 0, page_count, out_dir, min_chars)
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as pool:
+                futures = [
+                    pool.submit(extract_page_range_to_dir, file_path, start, end, out_dir, min_chars)
+                    for start, end in ranges
+                ]
+                totals = [future.result() for future in futures]
+            return {
+                'pages': sum(t['pages'] for t in totals),
+                'chars': sum(t['chars'] for t in totals),
+            }
+        
+        def write_pages(out_dir: str) -> Dict[str, int]:
+            # Conferido antes da publicação: extração falha não deixa páginas em disco
+            totals = extract_pages(out_dir)
+            if totals['chars'] < 50:
+                raise ValueError("Não foi possível extrair texto suficiente do PDF")
+            return totals
+        
+        totals = self.store.write_pages(file_hash, write_pages)
+        
+        # Informações-chave acumuladas página a página; estrutura pelo início do documento
+        preview_limit = settings.KERMARTIN_SETTINGS.get('LARGE_DOCUMENT_PREVIEW_CHARS', 20000)
+        structure_limit = max(preview_limit, 100000)
+        info = None
+        head = []
+        head_len = 0
+        for page in self.store.iter_pages(file_hash):
+            page_info = self.extract_key_information(page)
+            if info is None:
+                info = page_info
+            else:
+                for key, values in page_info.items():
+                    info[key].extend(values)
+            if head_len < structure_limit:
+                head.append(page)
+                head_len += len(page)
+        
+        head_text = "".join(head)
+        logger.info(
+            f"Documento grande extraído: {totals['pages']} páginas, {totals['chars']} caracteres"
+        )
+        return {
+            'texto': head_text[:preview_limit],
+            'estrutura': self.analyze_document_structure(head_text),
+            'informacoes_chave': info or self.extract_key_information(''),
+            'paginas_em_disco': True,
+            'paginas': totals['pages'],
+            'caracteres': totals['chars'],
+        }
+    
+    def iter_document_pages(self, texto: str, file_hash: Optional[str] = None) -> Iterator[str]:
+        """Páginas do documento: do disco (modo grande) ou o texto já em memória"""
+        if file_hash and self.store.has_pages(file_hash):
+            return self.store.iter_pages(file_hash)
+        return iter([texto or ''])
+    
+    @traced('pdf.extract')
     def extract_text_from_pdf(self, file_path: str) -> str:
         """
         Extrai texto de arquivo PDF
@@ -41,16 +174,12 @@ class DocumentProcessor:
             raise ValueError(f"Arquivo muito grande: {file_size} bytes")
         
         try:
-            # Tentar com PyMuPDF primeiro (mais rápido)
-            text = self._extract_with_pymupdf(file_path)
-            
-            # Se não conseguir texto suficiente, tentar com pdfplumber
-            if len(text.strip()) < 100:
-                logger.info("Tentando extração com pdfplumber...")
-                text = self._extract_with_pdfplumber(file_path)
+            # PyMuPDF por página (em paralelo para PDFs grandes) e pdfplumber
+            # apenas nas páginas com pouco texto
+            pages = self._extract_pages(file_path)
             
-            # Limpar e formatar texto
-            text = self._clean_text(text)
+            # Limpeza página a página, preservando marcadores e parágrafos
+            text = "".join(self.iter_clean_pages(pages)).strip()
             
             if len(text.strip()) < 50:
                 raise ValueError("Não foi possível extrair texto suficiente do PDF")
@@ -62,104 +191,81 @@ class DocumentProcessor:
             logger.error(f"Erro na extração de texto: {e}")
             raise
     
-    def _extract_with_pymupdf(self, file_path: str) -> str:
-        """Extrai texto usando PyMuPDF"""
-        
-        text = ""
+    def _extract_pages(self, file_path: str) -> List[str]:
+        """Extrai o texto de cada página, na ordem do documento"""
         
         try:
-            doc = fitz.open(file_path)
-            
-            for page_num in range(len(doc)):
-                page = doc.load_page(page_num)
-                page_text = page.get_text()
-                
-                if page_text.strip():
-                    text += f"\n--- PÁGINA {page_num + 1} ---\n"
-                    text += page_text
-                    text += "\n"
-            
-            doc.close()
-            
+            with fitz.open(file_path) as doc:
+                page_count = len(doc)
         except Exception as e:
             logger.error(f"Erro no PyMuPDF: {e}")
             raise
         
-        return text
+        ranges = self._page_ranges(page_count)
+        min_chars = settings.KERMARTIN_SETTINGS.get('PDF_MIN_PAGE_CHARS', 20)
+        
+        if len(ranges) <= 1:
+            pages = extract_page_range(file_path, 0, page_count)
+            weak = [n for n, t in enumerate(pages) if len(t.strip()) < min_chars]
+            if weak:
+                logger.info(f"Tentando extração com pdfplumber em {len(weak)} página(s)...")
+                self._merge_fallback(pages, extract_pages_with_pdfplumber(file_path, weak))
+            return pages
+        
+        # spawn: fork de um processo com threads (gunicorn) pode travar
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as pool:
+            futures = [pool.submit(extract_page_range, file_path, start, end) for start, end in ranges]
+            pages = [text for future in futures for text in future.result()]
+            
+            weak = [n for n, t in enumerate(pages) if len(t.strip()) < min_chars]
+            if weak:
+                logger.info(f"Tentando extração com pdfplumber em {len(weak)} página(s)...")
+                size = math.ceil(len(weak) / len(ranges))
+                futures = [
+                    pool.submit(extract_pages_with_pdfplumber, file_path, weak[i:i + size])
+                    for i in range(0, len(weak), size)
+                ]
+                for future in futures:
+                    self._merge_fallback(pages, future.result())
+        
+        return pages
     
-    def _extract_with_pdfplumber(self, file_path: str) -> str:
-        """Extrai texto usando pdfplumber (melhor para tabelas)"""
+    def _page_ranges(self, page_count: int) -> List[Tuple[int, int]]:
+        """Divide as páginas em faixas contíguas, uma por worker"""
         
-        text = ""
+        workers = settings.KERMARTIN_SETTINGS.get('PDF_EXTRACTION_WORKERS', 1)
+        min_pages = settings.KERMARTIN_SETTINGS.get('PDF_PARALLEL_MIN_PAGES', 24)
         
-        try:
-            with pdfplumber.open(file_path) as pdf:
-                for page_num, page in enumerate(pdf.pages):
-                    page_text = page.extract_text()
-                    
-                    if page_text and page_text.strip():
-                        text += f"\n--- PÁGINA {page_num + 1} ---\n"
-                        text += page_text
-                        text += "\n"
-                    
-                    # Extrair tabelas se houver
-                    tables = page.extract_tables()
-                    if tables:
-                        text += "\n--- TABELAS ---\n"
-                        for table in tables:
-                            for row in table:
-                                if row:
-                                    text += " | ".join(str(cell) if cell else "" for cell in row)
-                                    text += "\n"
-                        text += "\n"
+        if workers <= 1 or page_count < min_pages:
+            return [(0, page_count)]
         
-        except Exception as e:
-            logger.error(f"Erro no pdfplumber: {e}")
-            raise
+        size = math.ceil(page_count / workers)
+        return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+    
+    def _merge_fallback(self, pages: List[str], fallback: Dict[int, str]):
+        """Substitui páginas fracas quando o pdfplumber obtém mais texto"""
+        for page_num, text in fallback.items():
+            if len(text.strip()) > len(pages[page_num].strip()):
+                pages[page_num] = text
+    
+    def iter_clean_pages(self, pages: Iterable[str]) -> Iterator[str]:
+        """
+        Limpa as páginas uma a uma, gerando cada página com seu marcador
         
-        return text
+        Pode alimentar diretamente o chunker (ai_engine.chunking.iter_chunks)
+        sem montar o texto completo em memória.
+        """
+        for page_num, page_text in enumerate(pages, start=1):
+            cleaned = self._clean_text(page_text)
+            if cleaned:
+                yield format_page(page_num, cleaned)
     
     def _clean_text(self, text: str) -> str:
-        """Limpa e formata o texto extraído"""
-        
-        if not text:
-            return ""
-        
-        # Remover caracteres de controle
-        text = ''.join(char for char in text if ord(char) >= 32 or char in '\n\t')
-        
-        # Normalizar quebras de linha
-        text = text.replace('\r\n', '\n').replace('\r', '\n')
-        
-        # Remover linhas vazias excessivas
-        lines = text.split('\n')
-        cleaned_lines = []
-        empty_count = 0
-        
-        for line in lines:
-            line = line.strip()
-            
-            if line:
-                cleaned_lines.append(line)
-                empty_count = 0
-            else:
-                empty_count += 1
-                if empty_count <= 2:  # Máximo 2 linhas vazias consecutivas
-                    cleaned_lines.append('')
-        
-        # Juntar linhas
-        text = '\n'.join(cleaned_lines)
-        
-        # Remover espaços excessivos
-        text = ' '.join(text.split())
-        
-        # Adicionar quebras de linha em pontos apropriados
-        text = text.replace('. ', '.\n')
-        text = text.replace('? ', '?\n')
-        text = text.replace('! ', '!\n')
-        
-        return text.strip()
+        """Remove caracteres de controle e normaliza espaços, mantendo linhas e parágrafos"""
+        return clean_page_text(text)
     
+    @traced('document.hash')
     def generate_file_hash(self, file_path: str) -> str:
         """Gera hash SHA-256 do arquivo"""
         
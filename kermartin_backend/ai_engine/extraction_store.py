@@ -0,0 +1,114 @@
+"""
+Armazenamento de Extrações do Kermartin 3.0
+Resultados de extração endereçados pelo SHA-256 do PDF, compartilhados entre processos
+"""
+
+import os
+import gzip
+import json
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional
+from django.conf import settings
+
+logger = logging.getLogger('ai_engine')
+
+# Incrementar quando a extração/limpeza mudar o texto produzido
+EXTRACTION_VERSION = 4
+
+
+class ExtractionStore:
+    """Texto extraído, estrutura e informações-chave por hash do arquivo"""
+
+    def __init__(self, root: Optional[str] = None):
+        root = root or settings.KERMARTIN_SETTINGS.get('EXTRACTION_STORE_DIR')
+        self.root = Path(root or Path(settings.MEDIA_ROOT) / 'extracoes')
+
+    def _path(self, file_hash: str) -> Path:
+        # Dois níveis para não concentrar milhares de arquivos num diretório
+        return self.root / file_hash[:2] / f"{file_hash}.json.gz"
+
+    def _pages_dir(self, file_hash: str) -> Path:
+        # Modo documento grande: um arquivo de texto por página
+        return self.root / file_hash[:2] / file_hash
+
+    def get(self, file_hash: str) -> Optional[Dict]:
+        """Retorna a extração armazenada ou None (ausente ou de versão antiga)"""
+
+        if not file_hash:
+            return None
+
+        path = self._path(file_hash)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Extração armazenada ilegível ({file_hash}): {e}")
+            return None
+
+        if data.get('versao') != EXTRACTION_VERSION:
+            return None
+        return data
+
+    def put(self, file_hash: str, data: Dict) -> bool:
+        """Grava a extração de forma atômica (arquivo temporário + rename)"""
+
+        path = self._path(file_hash)
+        payload = {**data, 'versao': EXTRACTION_VERSION}
+
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                    f.write(json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+                os.replace(tmp_path, path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+            return True
+
+        except Exception as e:
+            logger.error(f"Erro ao gravar extração {file_hash}: {e}")
+            return False
+
+    def write_pages(self, file_hash: str, writer: Callable[[str], Dict]) -> Dict:
+        """
+        Preenche o diretório de páginas via ``writer(diretorio)`` num diretório
+        temporário, publicado por rename só depois de completo
+        """
+
+        pages_dir = self._pages_dir(file_hash)
+        pages_dir.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=pages_dir.parent, suffix='.tmp')
+        try:
+            result = writer(tmp_dir)
+            shutil.rmtree(pages_dir, ignore_errors=True)
+            os.replace(tmp_dir, pages_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return result
+
+    def has_pages(self, file_hash: str) -> bool:
+        """Indica se o documento tem páginas gravadas em disco"""
+        return bool(file_hash) and self._pages_dir(file_hash).is_dir()
+
+    def iter_pages(self, file_hash: str) -> Iterator[str]:
+        """Lê as páginas sob demanda, na ordem do documento"""
+        pages_dir = self._pages_dir(file_hash)
+        for name in sorted(os.listdir(pages_dir)):
+            with open(pages_dir / name, encoding='utf-8') as f:
+                yield f.read()
+
+    def delete(self, file_hash: str) -> None:
+        """Remove a extração armazenada"""
+        try:
+            self._path(file_hash).unlink()
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(self._pages_dir(file_hash), ignore_errors=True)
@@ -0,0 +1 @@
+# Management package for Kermartin 3.0
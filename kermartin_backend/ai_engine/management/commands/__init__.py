@@ -0,0 +1 @@
+# Management commands for Kermartin 3.0
@@ -0,0 +1,140 @@
+"""
+Comando Django: worker assíncrono de análises do Kermartin 3.0
+Executa sessões enfileiradas (configuracoes.execucao = 'worker') com AsyncOpenAI.
+Sessões reservadas mantêm updated_at como heartbeat; as que ficam sem
+heartbeat por ANALYSIS_WORKER_LEASE_SEC (worker caído) são retomadas
+"""
+
+import asyncio
+import logging
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from ai_engine.async_processor import AsyncKermartinProcessor
+from core.models import SessaoAnalise
+from core.tracing import trace
+
+logger = logging.getLogger('ai_engine')
+
+
+class Command(BaseCommand):
+    """Worker que consome sessões de análise pendentes"""
+
+    help = 'Executa sessões de análise enfileiradas usando o processador assíncrono'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-sessions',
+            type=int,
+            default=4,
+            help='Sessões processadas simultaneamente'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=settings.KERMARTIN_SETTINGS.get('ANALYSIS_WORKER_POLL_SEC', 2.0),
+            help='Intervalo (s) entre buscas por novas sessões'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Processa as sessões pendentes e encerra'
+        )
+
+    def handle(self, *args, **options):
+        """Executa o loop do worker"""
+
+        self.stdout.write(self.style.NOTICE(
+            f"Worker de análises iniciado (max_sessions={options['max_sessions']})"
+        ))
+        asyncio.run(self._run(
+            options['max_sessions'],
+            options['poll_interval'],
+            options['once']
+        ))
+
+    async def _run(self, max_sessions: int, poll_interval: float, once: bool):
+        processor = AsyncKermartinProcessor()
+        running = set()
+
+        while True:
+            livres = max_sessions - len(running)
+            if livres > 0:
+                sessoes = await sync_to_async(self._claim_sessions)(livres)
+                for sessao in sessoes:
+                    task = asyncio.create_task(self._process(processor, sessao))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+
+            if once and not running:
+                break
+
+            if running:
+                await asyncio.wait(running, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(poll_interval)
+
+    def _lease(self) -> float:
+        return settings.KERMARTIN_SETTINGS.get('ANALYSIS_WORKER_LEASE_SEC', 300)
+
+    def _claim_sessions(self, limit: int):
+        """
+        Reserva sessões pendentes ou abandonadas (em_progresso sem heartbeat
+        dentro do lease); o UPDATE condicional evita dupla execução entre workers
+        """
+
+        expiradas = Q(status='em_progresso', updated_at__lt=timezone.now() - timedelta(seconds=self._lease()))
+        candidatas = SessaoAnalise.objects.filter(
+            Q(status='iniciada') | expiradas,
+            configuracoes__execucao='worker'
+        ).order_by('created_at').values_list('id', 'status')[:limit]
+
+        reservadas = []
+        for sessao_id, status in list(candidatas):
+            pendente = Q(status='iniciada') if status == 'iniciada' else expiradas
+            reservou = SessaoAnalise.objects.filter(pendente, id=sessao_id).update(
+                status='em_progresso', updated_at=timezone.now()
+            )
+            if reservou:
+                if status != 'iniciada':
+                    logger.warning(f"Sessão {sessao_id} sem heartbeat dentro do lease: retomada pelo worker")
+                reservadas.append(
+                    SessaoAnalise.objects.select_related('processo').get(id=sessao_id)
+                )
+        return reservadas
+
+    def _heartbeat(self, sessao_id) -> int:
+        return SessaoAnalise.objects.filter(id=sessao_id, status='em_progresso').update(updated_at=timezone.now())
+
+    async def _keep_alive(self, sessao_id):
+        """Renova o lease da sessão enquanto ela é processada"""
+        while True:
+            await asyncio.sleep(self._lease() / 3)
+            try:
+                await sync_to_async(self._heartbeat)(sessao_id)
+            except Exception as e:
+                logger.error(f"Erro ao renovar lease da sessão {sessao_id}: {e}")
+
+    async def _process(self, processor: AsyncKermartinProcessor, sessao: SessaoAnalise):
+        heartbeat = asyncio.create_task(self._keep_alive(sessao.id))
+        try:
+            documentos = [
+                doc async for doc in sessao.processo.documentos.processados().with_text()
+            ]
+            # Continua o trace da requisição que enfileirou a sessão
+            trace_id = (sessao.configuracoes or {}).get('trace_id')
+            with trace('worker.session', trace_id=trace_id, sessao=str(sessao.id)):
+                await processor.aanalyze_complete_process(
+                    documentos,
+                    sessao,
+                    sessao.blocos_selecionados or None
+                )
+            self.stdout.write(self.style.SUCCESS(f"Sessão concluída: {sessao.id}"))
+        except Exception as e:
+            logger.error(f"Erro no worker ao processar sessão {sessao.id}: {e}")
+            self.stdout.write(self.style.ERROR(f"Sessão com erro: {sessao.id} - {e}"))
+        finally:
+            heartbeat.cancel()
@@ -0,0 +1,71 @@
+"""
+Varredura de Padrões do Kermartin 3.0
+Todas as regras de um conjunto combinadas numa única regex compilada:
+uma passada pelo texto, informando qual regra casou
+"""
+
+import re
+import hashlib
+from typing import Iterable, List, Optional, Tuple
+
+
+class ScanMatch:
+    """Ocorrência encontrada na varredura (posições no texto em minúsculas)"""
+
+    __slots__ = ('rule', 'pattern', 'start', 'end', 'text')
+
+    def __init__(self, rule: str, pattern: str, start: int, end: int, text: str):
+        self.rule = rule
+        self.pattern = pattern
+        self.start = start
+        self.end = end
+        self.text = text
+
+    def __repr__(self):
+        return f"ScanMatch(rule={self.rule!r}, start={self.start})"
+
+
+class PatternScanner:
+    """
+    Conjunto de regras compilado numa alternância única
+
+    Cada regra é (nome, regex), escrita em minúsculas; termos literais entram
+    escapados via literal(). O texto é passado para minúsculas uma vez e
+    percorrido uma vez pela alternância. Ela não tem grupos, o que preserva a
+    busca rápida pelo primeiro caractere do motor de regex (grupos nomeados
+    por regra a desligam). Só quando há ocorrência, a regra é identificada
+    testando cada uma na posição encontrada. É reportada a ocorrência mais à
+    esquerda no texto, não a primeira regra da lista.
+    """
+
+    def __init__(self, rules: Iterable[Tuple[str, str]]):
+        self.rules: List[Tuple[str, str]] = list(rules)
+        self._compiled = [(name, pattern, re.compile(pattern)) for name, pattern in self.rules]
+        self._regex = re.compile('|'.join(f"(?:{pattern})" for _, pattern in self.rules))
+        # Muda com qualquer alteração nas regras (chave de resultados em cache)
+        self.version = hashlib.sha256(repr(self.rules).encode('utf-8')).hexdigest()[:12]
+
+    @staticmethod
+    def literal(terms: Iterable[str]) -> List[str]:
+        """Termos de busca literal como padrões escapados"""
+        return [re.escape(term.lower()) for term in terms]
+
+    def scan(self, text: str) -> Optional[ScanMatch]:
+        """Primeira ocorrência de qualquer regra, ou None"""
+        text = text.lower()
+        match = self._regex.search(text)
+        if match is None:
+            return None
+        return self._identify(text, match)
+
+    def scan_all(self, text: str) -> List[ScanMatch]:
+        """Todas as ocorrências (sem sobreposição), em ordem no texto"""
+        text = text.lower()
+        return [self._identify(text, match) for match in self._regex.finditer(text)]
+
+    def _identify(self, text: str, match) -> ScanMatch:
+        # Mesma ordem da alternância: a primeira regra que casa na posição é a que venceu
+        for name, pattern, regex in self._compiled:
+            if regex.match(text, match.start()):
+                break
+        return ScanMatch(name, pattern, match.start(), match.end(), match.group())
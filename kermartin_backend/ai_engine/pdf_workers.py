@@ -0,0 +1,122 @@
+"""
+Funções de extração de PDF executadas nos processos do ProcessPoolExecutor
+Sem dependência do Django para que o spawn dos workers seja leve
+"""
+
+import os
+import re
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# Normalização de texto: tabelas/regex compiladas uma vez por processo
+_CONTROL_CHARS = {code: None for code in range(32) if chr(code) not in '\n\t'}
+_CONTROL_CHARS[ord('\t')] = ' '
+_LINE_BREAKS = re.compile(r'\r\n?')
+_WHITESPACE_RUNS = re.compile(r' *\n[ \n]*| {2,}')
+
+
+def _normalize_whitespace(match) -> str:
+    """Espaços repetidos viram um; quebras viram linha ou parágrafo"""
+    run = match.group()
+    if '\n' not in run:
+        return ' '
+    return '\n\n' if run.count('\n') > 1 else '\n'
+
+
+def clean_page_text(text: str) -> str:
+    """Remove caracteres de controle e normaliza espaços, mantendo linhas e parágrafos"""
+    if not text:
+        return ""
+    if '\r' in text:
+        text = _LINE_BREAKS.sub('\n', text)
+    text = text.translate(_CONTROL_CHARS)
+    text = _WHITESPACE_RUNS.sub(_normalize_whitespace, text)
+    return text.strip()
+
+
+def format_page(page_num: int, cleaned: str) -> str:
+    """Página limpa com o seu marcador (numeração a partir de 1)"""
+    return f"--- PÁGINA {page_num} ---\n{cleaned}\n\n"
+
+
+def extract_page_range(file_path: str, start: int, end: int) -> List[str]:
+    """Texto (PyMuPDF) das páginas [start, end), na ordem"""
+    import fitz  # PyMuPDF
+
+    with fitz.open(file_path) as doc:
+        return [doc.load_page(page_num).get_text() for page_num in range(start, end)]
+
+
+def extract_pages_with_pdfplumber(file_path: str, page_numbers: Sequence[int]) -> Dict[int, str]:
+    """Texto e tabelas (pdfplumber) apenas das páginas indicadas"""
+    return dict(iter_pages_with_pdfplumber(file_path, page_numbers))
+
+
+def iter_pages_with_pdfplumber(file_path: str, page_numbers: Sequence[int]) -> Iterator[Tuple[int, str]]:
+    """Como extract_pages_with_pdfplumber, uma página por vez (o PDF é aberto uma só vez)"""
+    import pdfplumber
+
+    with pdfplumber.open(file_path) as pdf:
+        for page_num in page_numbers:
+            page = pdf.pages[page_num]
+            parts = [page.extract_text() or '']
+
+            # Extrair tabelas se houver
+            tables = page.extract_tables()
+            if tables:
+                parts.append("\n--- TABELAS ---\n")
+                for table in tables:
+                    for row in table:
+                        if row:
+                            parts.append(" | ".join(str(cell) if cell else "" for cell in row))
+                            parts.append("\n")
+
+            yield page_num, "".join(parts)
+
+
+def extract_page_range_to_dir(
+    file_path: str,
+    start: int,
+    end: int,
+    out_dir: str,
+    min_chars: int
+) -> Dict[str, int]:
+    """
+    Extrai, limpa e grava as páginas [start, end) em out_dir (um arquivo por
+    página), mantendo em memória apenas a página corrente
+
+    Páginas fracas no PyMuPDF (escaneadas) guardam só o texto curto obtido e
+    passam depois por uma única abertura do pdfplumber para todo o intervalo.
+    """
+    import fitz  # PyMuPDF
+
+    written = []
+    weak = {}
+    with fitz.open(file_path) as doc:
+        for page_num in range(start, end):
+            text = doc.load_page(page_num).get_text()
+            if len(text.strip()) < min_chars:
+                weak[page_num] = text
+                continue
+            written.append(_write_page(out_dir, page_num, text))
+
+    if weak:
+        for page_num, fallback in iter_pages_with_pdfplumber(file_path, sorted(weak)):
+            text = weak.pop(page_num)
+            if len(fallback.strip()) > len(text.strip()):
+                text = fallback
+            written.append(_write_page(out_dir, page_num, text))
+
+    written = [chars for chars in written if chars]
+    return {'pages': len(written), 'chars': sum(written)}
+
+
+def _write_page(out_dir: str, page_num: int, text: str) -> int:
+    """Grava a página limpa com o seu marcador; devolve os caracteres (0 = página vazia, não gravada)"""
+    cleaned = clean_page_text(text)
+    if not cleaned:
+        return 0
+
+    page_path = os.path.join(out_dir, f"{page_num + 1:06d}.txt")
+    with open(page_path, 'w', encoding='utf-8') as f:
+        f.write(format_page(page_num + 1, cleaned))
+    return len(cleaned)
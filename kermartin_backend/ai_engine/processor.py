@@ -6,16 +6,36 @@ Engine de IA para análise jurídica especializada em Tribunal do Júri
 import time
 import hashlib
 import logging
-from typing import Dict, List, Optional, Tuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
 from django.conf import settings
-from django.core.cache import cache
 from openai import OpenAI
-from .prompts import get_prompt, get_prompt_title, KERMARTIN_PERSONA
+from .prompts import get_prompt_parts, get_prompt_title, KERMARTIN_PERSONA
 from .security import SecurityValidator
+from .chunking import iter_chunks
+from .extraction_store import ExtractionStore
+from .cache_manager import KermartinCacheManager
+from .tiered_cache import get_tiered_cache
 from core.models import ResultadoAnalise, SessaoAnalise, Documento
+from core.metrics_registry import observe_llm_call
+from core.buffered_writer import BulkUpsertBuffer, ThrottledSave
+from core.tracing import current_span, span, traced
+from core.profiling import profiled
+from core.token_ledger import record_usage, usage_from_response, usage_scope
 
 logger = logging.getLogger('ai_engine')
 
+# Chave única e colunas atualizadas no upsert de ResultadoAnalise
+RESULT_UNIQUE_FIELDS = ['sessao', 'documento', 'bloco', 'subetapa']
+RESULT_UPDATE_FIELDS = [
+    'prompt_usado', 'resposta_ia', 'tokens_prompt', 'tokens_resposta',
+    'tokens_total', 'tempo_processamento', 'modelo_usado', 'updated_at',
+]
+
+# Buffer de resultados da análise completa em curso (por fluxo: o worker roda várias sessões no mesmo processador)
+_result_buffer: ContextVar[Optional[BulkUpsertBuffer]] = ContextVar('kermartin_result_buffer', default=None)
+
 
 class KermartinProcessor:
     """Processador principal do agente Kermartin"""
@@ -25,7 +45,10 @@ class KermartinProcessor:
         self.model = settings.OPENAI_MODEL
         self.max_tokens = settings.OPENAI_MAX_TOKENS
         self.security = SecurityValidator()
+        self.extraction_store = ExtractionStore()
+        self.cache_manager = KermartinCacheManager()
         
+    @traced('analysis.document')
     def analyze_document(
         self, 
         documento: Documento, 
@@ -46,40 +69,27 @@ class KermartinProcessor:
             Dict com resultado da análise
         """
         
+        current_span().set_attributes(documento=str(documento.id), bloco=bloco, subetapa=subetapa)
+        
         try:
-            # Validação de segurança
-            if not self.security.validate_document_content(documento.texto_extraido):
+            # Validação de segurança (uma vez por conteúdo e versão das regras)
+            content_hash = self._content_hash(documento)
+            if not self._validate_document(documento, content_hash):
                 raise SecurityError("Documento contém conteúdo suspeito")
             
-            # Verificar cache
-            cache_key = self._generate_cache_key(documento, bloco, subetapa)
-            cached_result = cache.get(cache_key)
-            
-            if cached_result and settings.KERMARTIN_SETTINGS['CACHE_ANALYSIS_RESULTS']:
-                logger.info(f"Resultado encontrado em cache: {cache_key}")
-                return cached_result
+            # Verificar cache (entradas marcadas por documento, processo e usuário)
+            cache_tags = self._cache_tags(documento)
+            if settings.KERMARTIN_SETTINGS['CACHE_ANALYSIS_RESULTS']:
+                with span('analysis.cache_lookup') as lookup:
+                    cached_result = self.cache_manager.get_cached_analysis(
+                        str(documento.id), bloco, subetapa, content_hash, tags=cache_tags
+                    )
+                    lookup.set_attribute('hit', bool(cached_result))
+                if cached_result:
+                    return cached_result
             
-            # Preparar chunking para documentos longos
-            from django.conf import settings as djsettings
-            full_text = documento.texto_extraido or ''
-            chunk_size = djsettings.KERMARTIN_SETTINGS.get('CHUNK_SIZE_CHARS', 12000)
-            overlap = djsettings.KERMARTIN_SETTINGS.get('CHUNK_OVERLAP_CHARS', 800)
-
-            def make_chunks(text, size, ov):
-                chunks = []
-                i = 0
-                n = len(text)
-                if n == 0:
-                    return [""]
-                while i < n:
-                    end = min(i + size, n)
-                    chunks.append(text[i:end])
-                    if end >= n:
-                        break
-                    i = max(end - ov, i + 1)
-                return chunks
-
-            text_chunks = make_chunks(full_text, chunk_size, overlap)
+            # Chunks gerados sob demanda (documentos grandes são lidos página a página)
+            text_chunks, chunk_size, overlap = self._iter_text_chunks(documento)
 
             # Agregar respostas e tokens de todos os chunks
             total_prompt_tokens = 0
@@ -87,54 +97,48 @@ class KermartinProcessor:
             total_tokens = 0
             respostas = []
             start_time = time.time()
+            prompt_before, prompt_after = get_prompt_parts(bloco, subetapa)
 
-            for idx, piece in enumerate(text_chunks, start=1):
-                # Gerar prompt específico por chunk
-                prompt = get_prompt(bloco, subetapa, piece)
+            # Chamadas atribuídas ao usuário/processo/sessão na razão de tokens
+            with self._usage_scope(documento, sessao):
+                for piece in text_chunks:
+                    # Validar prompt contra injection (modelo e chunk já vistos não são varridos de novo)
+                    if not self.security.validate_prompt_parts(prompt_before, piece, prompt_after):
+                        raise SecurityError("Tentativa de prompt injection detectada")
 
-                # Validar prompt contra injection
-                if not self.security.validate_prompt_injection(prompt):
-                    raise SecurityError("Tentativa de prompt injection detectada")
+                    # Gerar prompt específico por chunk
+                    with span('prompt.render', chars=len(piece)):
+                        prompt = prompt_before + piece + prompt_after
 
-                # Retry com backoff para rate-limit 429
-                resp = self._call_openai_with_retry(prompt)
-                respostas.append(f"[Parte {idx}/{len(text_chunks)}]\n" + resp['content'])
-                total_prompt_tokens += resp['tokens_prompt']
-                total_response_tokens += resp['tokens_response']
-                total_tokens += resp['tokens_total']
+                    # Retry com backoff para rate-limit 429
+                    resp = self._call_openai_with_retry(prompt)
+                    respostas.append(resp['content'])
+                    total_prompt_tokens += resp['tokens_prompt']
+                    total_response_tokens += resp['tokens_response']
+                    total_tokens += resp['tokens_total']
 
-                # Pequena espera entre chunks para aliviar TPM
-                sleep_sec = djsettings.KERMARTIN_SETTINGS.get('OPENAI_CHUNK_SLEEP_SEC', 0.25)
-                if sleep_sec:
-                    time.sleep(sleep_sec)
+                    # Pequena espera entre chunks para aliviar TPM
+                    sleep_sec = settings.KERMARTIN_SETTINGS.get('OPENAI_CHUNK_SLEEP_SEC', 0.25)
+                    if sleep_sec:
+                        time.sleep(sleep_sec)
 
             processing_time = time.time() - start_time
-            resposta_final = "\n\n".join(respostas)
-            prompt_usado = f"Documento dividido em {len(text_chunks)} partes; chunk_size={chunk_size}, overlap={overlap}."
-
-            # Preparar resultado
-            result = {
-                'bloco': bloco,
-                'subetapa': subetapa,
-                'titulo': get_prompt_title(bloco, subetapa),
-                'resposta': resposta_final,
-                'tokens_prompt': total_prompt_tokens,
-                'tokens_resposta': total_response_tokens,
-                'tokens_total': total_tokens,
-                'tempo_processamento': processing_time,
-                'modelo_usado': self.model,
-                'prompt_usado': prompt_usado
-            }
+            result = self._build_result(
+                bloco, subetapa, self._label_parts(respostas),
+                total_prompt_tokens, total_response_tokens, total_tokens,
+                processing_time, len(respostas), chunk_size, overlap
+            )
             
             # Salvar no banco
             self._save_analysis_result(documento, sessao, result)
             
             # Salvar em cache
             if settings.KERMARTIN_SETTINGS['CACHE_ANALYSIS_RESULTS']:
-                cache.set(
-                    cache_key, 
-                    result, 
-                    timeout=settings.KERMARTIN_SETTINGS['CACHE_TIMEOUT']
+                self.cache_manager.cache_analysis_result(
+                    str(documento.id), bloco, subetapa, result,
+                    content_hash=content_hash,
+                    timeout=settings.KERMARTIN_SETTINGS['CACHE_TIMEOUT'],
+                    tags=cache_tags
                 )
             
             logger.info(f"Análise concluída: Bloco {bloco}.{subetapa} - {processing_time:.2f}s")
@@ -144,6 +148,8 @@ class KermartinProcessor:
             logger.error(f"Erro na análise: {e}")
             raise
     
+    @profiled('analysis.process')
+    @traced('analysis.process')
     def analyze_complete_process(
         self, 
         documentos: List[Documento], 
@@ -169,90 +175,233 @@ class KermartinProcessor:
         total_tokens = 0
         total_time = 0
         
-        try:
-            sessao.status = 'em_progresso'
-            sessao.save()
-            
-            for bloco in blocos_selecionados:
-                resultados[f'bloco_{bloco}'] = {}
-                
-                # Determinar número de subetapas por bloco
-                max_subetapas = self._get_max_subetapas(bloco)
-                
-                for subetapa in range(1, max_subetapas + 1):
-                    sessao.bloco_atual = bloco
-                    sessao.subetapa_atual = subetapa
-                    sessao.save()
-                    
-                    # Analisar cada documento
-                    for documento in documentos:
-                        try:
-                            resultado = self.analyze_document(
-                                documento, bloco, subetapa, sessao
-                            )
-                            
-                            doc_key = f"documento_{documento.id}"
-                            if doc_key not in resultados[f'bloco_{bloco}']:
-                                resultados[f'bloco_{bloco}'][doc_key] = {}
-                            
-                            resultados[f'bloco_{bloco}'][doc_key][f'subetapa_{subetapa}'] = resultado
-                            
-                            total_tokens += resultado['tokens_total']
-                            total_time += resultado['tempo_processamento']
-                            
-                        except Exception as e:
-                            logger.error(f"Erro na análise do documento {documento.id}: {e}")
-                            continue
-            
-            # Finalizar sessão
-            sessao.finalizar_sessao()
-            
-            # Consolidar resultados
-            consolidado = {
-                'sessao_id': str(sessao.id),
-                'status': 'concluida',
-                'resultados': resultados,
-                'estatisticas': {
-                    'total_tokens': total_tokens,
-                    'total_tempo': total_time,
-                    'documentos_analisados': len(documentos),
-                    'blocos_processados': len(blocos_selecionados)
+        progress = self._session_progress(sessao)
+        
+        with self._buffered_results() as buffer:
+            try:
+                sessao.status = 'em_progresso'
+                sessao.save(update_fields=['status', 'updated_at'])
+
+                for bloco in blocos_selecionados:
+                    resultados[f'bloco_{bloco}'] = {}
+
+                    # Determinar número de subetapas por bloco
+                    max_subetapas = self._get_max_subetapas(bloco)
+
+                    for subetapa in range(1, max_subetapas + 1):
+                        # Progresso gravado no máximo a cada SESSION_PROGRESS_SAVE_SEC
+                        if progress.set(bloco_atual=bloco, subetapa_atual=subetapa):
+                            progress.save()
+
+                        # Analisar cada documento
+                        for documento in documentos:
+                            try:
+                                resultado = self.analyze_document(
+                                    documento, bloco, subetapa, sessao
+                                )
+
+                                doc_key = f"documento_{documento.id}"
+                                if doc_key not in resultados[f'bloco_{bloco}']:
+                                    resultados[f'bloco_{bloco}'][doc_key] = {}
+
+                                resultados[f'bloco_{bloco}'][doc_key][f'subetapa_{subetapa}'] = resultado
+
+                                total_tokens += resultado['tokens_total']
+                                total_time += resultado['tempo_processamento']
+
+                            except Exception as e:
+                                logger.error(f"Erro na análise do documento {documento.id}: {e}")
+                                continue
+
+                # Resultados ainda no buffer vão ao banco antes de concluir a sessão
+                self._flush_results(buffer)
+
+                # Finalizar sessão (gravação completa: status, fim e progresso final)
+                sessao.finalizar_sessao()
+
+                # Consolidar resultados
+                consolidado = {
+                    'sessao_id': str(sessao.id),
+                    'status': 'concluida',
+                    'resultados': resultados,
+                    'estatisticas': {
+                        'total_tokens': total_tokens,
+                        'total_tempo': total_time,
+                        'documentos_analisados': len(documentos),
+                        'blocos_processados': len(blocos_selecionados)
+                    }
                 }
-            }
-            
-            logger.info(f"Análise completa finalizada: {total_time:.2f}s, {total_tokens} tokens")
-            return consolidado
-            
-        except Exception as e:
-            sessao.status = 'erro'
-            sessao.save()
-            logger.error(f"Erro na análise completa: {e}")
-            raise
-    
-    def _call_openai(self, prompt: str) -> Dict:
-        """Chama a API da OpenAI (uma tentativa)"""
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": KERMARTIN_PERSONA},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=self.max_tokens,
-            temperature=0.1,
-            top_p=0.9
-        )
+
+                logger.info(f"Análise completa finalizada: {total_time:.2f}s, {total_tokens} tokens")
+                return consolidado
+
+            except Exception as e:
+                # Resultados já obtidos não se perdem com a falha da sessão
+                try:
+                    self._flush_results(buffer)
+                except Exception as flush_error:
+                    logger.error(f"Erro ao gravar resultados pendentes: {flush_error}")
+                sessao.status = 'erro'
+                sessao.save(update_fields=['status', 'bloco_atual', 'subetapa_atual', 'updated_at'])
+                logger.error(f"Erro na análise completa: {e}")
+                raise
+
+    def _has_page_store(self, documento: Documento) -> bool:
+        """Documento extraído em modo grande (páginas no armazenamento em disco)"""
+        return bool(documento.hash_arquivo) and self.extraction_store.has_pages(documento.hash_arquivo)
+
+    def _iter_document_text(self, documento: Documento) -> Iterator[str]:
+        """Texto do documento em partes: páginas em disco ou o texto_extraido inteiro"""
+        if self._has_page_store(documento):
+            return self.extraction_store.iter_pages(documento.hash_arquivo)
+        return iter([documento.texto_extraido or ''])
+
+    @traced('analysis.validate_document')
+    def _validate_document(self, documento: Documento, content_hash: Optional[str] = None) -> bool:
+        """
+        Validação de conteúdo; documentos grandes são validados página a página
+
+        Aprovações ficam em cache pelo hash do conteúdo e versão das regras,
+        então o texto é varrido uma vez, não a cada subetapa.
+        """
+        content_hash = content_hash or self._content_hash(documento)
+        cache_key = f"kermartin_doc_validation_{self.security.ruleset_version}_{content_hash}"
+        validations = get_tiered_cache()
+        if validations.get(cache_key):
+            return True
+
+        if self._has_page_store(documento):
+            valid = all(
+                self.security.validate_document_content(page)
+                for page in self._iter_document_text(documento)
+            )
+        else:
+            valid = self.security.validate_document_content(documento.texto_extraido)
+
+        # Só aprovações: conteúdo suspeito volta a ser registrado a cada tentativa
+        if valid:
+            validations.set(cache_key, True, timeout=settings.KERMARTIN_SETTINGS['CACHE_TIMEOUT'])
+        return valid
+
+    def _iter_text_chunks(self, documento: Documento) -> Tuple[Iterator[str], int, int]:
+        """Chunks com sobreposição conforme KERMARTIN_SETTINGS, gerados sob demanda"""
+        chunk_size = settings.KERMARTIN_SETTINGS.get('CHUNK_SIZE_CHARS', 12000)
+        overlap = settings.KERMARTIN_SETTINGS.get('CHUNK_OVERLAP_CHARS', 800)
+
+        chunks = iter_chunks(self._iter_document_text(documento), chunk_size, overlap)
+        return chunks, chunk_size, overlap
+
+    def _label_parts(self, respostas: List[str]) -> List[str]:
+        """Numera as respostas por parte (o total só é conhecido ao final do fluxo)"""
+        total = len(respostas)
+        return [
+            f"[Parte {idx}/{total}]\n" + content
+            for idx, content in enumerate(respostas, start=1)
+        ]
+
+    def _build_messages(self, prompt: str) -> List[Dict]:
+        """Monta as mensagens do chat (persona + prompt)"""
+        return [
+            {"role": "system", "content": KERMARTIN_PERSONA},
+            {"role": "user", "content": prompt}
+        ]
+
+    def _parse_completion(self, response) -> Dict:
+        """Converte a resposta da OpenAI no formato interno"""
         return {
             'content': response.choices[0].message.content,
             'tokens_prompt': response.usage.prompt_tokens,
+            'tokens_cache': usage_from_response(response.usage)['tokens_cache'],
             'tokens_response': response.usage.completion_tokens,
             'tokens_total': response.usage.total_tokens
         }
 
+    def _build_result(
+        self,
+        bloco: int,
+        subetapa: int,
+        respostas: List[str],
+        tokens_prompt: int,
+        tokens_resposta: int,
+        tokens_total: int,
+        processing_time: float,
+        total_chunks: int,
+        chunk_size: int,
+        overlap: int
+    ) -> Dict:
+        """Monta o dicionário de resultado de uma análise"""
+        return {
+            'bloco': bloco,
+            'subetapa': subetapa,
+            'titulo': get_prompt_title(bloco, subetapa),
+            'resposta': "\n\n".join(respostas),
+            'tokens_prompt': tokens_prompt,
+            'tokens_resposta': tokens_resposta,
+            'tokens_total': tokens_total,
+            'tempo_processamento': processing_time,
+            'modelo_usado': self.model,
+            'prompt_usado': (
+                f"Documento dividido em {total_chunks} partes; "
+                f"chunk_size={chunk_size}, overlap={overlap}."
+            )
+        }
+
+    def _is_rate_limit_error(self, error: Exception) -> bool:
+        """Indica se o erro da OpenAI é um 429/rate limit"""
+        msg = str(error)
+        return 'rate_limit' in msg or '429' in msg
+
+    def _retry_delay(self, attempt: int) -> float:
+        """Backoff exponencial a partir de OPENAI_RETRY_BASE_DELAY_SEC"""
+        base_delay = settings.KERMARTIN_SETTINGS.get('OPENAI_RETRY_BASE_DELAY_SEC', 1.5)
+        return base_delay * (2 ** (attempt - 1))
+
+    def _call_openai(self, prompt: str) -> Dict:
+        """Chama a API da OpenAI (uma tentativa)"""
+        started = time.perf_counter()
+        try:
+            with span('llm.generate', model=self.model):
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=self._build_messages(prompt),
+                    max_tokens=self.max_tokens,
+                    temperature=0.1,
+                    top_p=0.9
+                )
+        except Exception as e:
+            self._observe_call(started, error=e)
+            raise
+        result = self._parse_completion(response)
+        self._observe_call(started, result=result)
+        return result
+
+    def _observe_call(self, started: float, result: Optional[Dict] = None, error: Optional[Exception] = None):
+        """Latência, resultado e tokens da chamada no registro de métricas e na razão de tokens"""
+        elapsed = time.perf_counter() - started
+        if error is not None:
+            status = 'rate_limit' if self._is_rate_limit_error(error) else 'erro'
+        else:
+            status = 'ok'
+        result = result or {}
+        observe_llm_call(
+            self.model,
+            elapsed,
+            status=status,
+            tokens_prompt=result.get('tokens_prompt', 0),
+            tokens_response=result.get('tokens_response', 0)
+        )
+        if result:
+            record_usage(
+                'chat', self.model,
+                tokens_prompt=result.get('tokens_prompt', 0),
+                tokens_cache=result.get('tokens_cache', 0),
+                tokens_resposta=result.get('tokens_response', 0),
+                latencia=elapsed
+            )
+
     def _call_openai_with_retry(self, prompt: str) -> Dict:
         """Chama a API da OpenAI com retry e backoff progressivo em caso de 429"""
-        from django.conf import settings as djsettings
-        max_attempts = djsettings.KERMARTIN_SETTINGS.get('OPENAI_RETRY_MAX_ATTEMPTS', 6)
-        base_delay = djsettings.KERMARTIN_SETTINGS.get('OPENAI_RETRY_BASE_DELAY_SEC', 1.5)
+        max_attempts = settings.KERMARTIN_SETTINGS.get('OPENAI_RETRY_MAX_ATTEMPTS', 6)
 
         attempt = 0
         while True:
@@ -260,14 +409,14 @@ class KermartinProcessor:
             try:
                 return self._call_openai(prompt)
             except Exception as e:
-                msg = str(e)
-                if 'rate_limit' in msg or '429' in msg:
+                if self._is_rate_limit_error(e):
                     if attempt >= max_attempts:
                         logger.error(f"OpenAI rate limit após {attempt} tentativas: {e}")
                         raise
-                    delay = base_delay * (2 ** (attempt - 1))
+                    delay = self._retry_delay(attempt)
                     logger.warning(f"Rate limit: tentativa {attempt}/{max_attempts}, aguardando {delay:.2f}s")
-                    time.sleep(delay)
+                    with span('llm.queue', motivo='rate_limit', tentativa=attempt):
+                        time.sleep(delay)
                     continue
                 # Outros erros: propaga
                 raise
@@ -280,40 +429,93 @@ class KermartinProcessor:
     ):
         """Salva resultado da análise no banco"""
         
+        fields = {
+            'prompt_usado': result['prompt_usado'],
+            'resposta_ia': result['resposta'],
+            'tokens_prompt': result['tokens_prompt'],
+            'tokens_resposta': result['tokens_resposta'],
+            'tokens_total': result['tokens_total'],
+            'tempo_processamento': result['tempo_processamento'],
+            'modelo_usado': result['modelo_usado']
+        }
+        
         try:
-            ResultadoAnalise.objects.update_or_create(
-                sessao=sessao,
-                documento=documento,
-                bloco=result['bloco'],
-                subetapa=result['subetapa'],
-                defaults={
-                    'prompt_usado': result['prompt_usado'],
-                    'resposta_ia': result['resposta'],
-                    'tokens_prompt': result['tokens_prompt'],
-                    'tokens_resposta': result['tokens_resposta'],
-                    'tokens_total': result['tokens_total'],
-                    'tempo_processamento': result['tempo_processamento'],
-                    'modelo_usado': result['modelo_usado']
-                }
-            )
+            with span('db.save_result'):
+                buffer = _result_buffer.get()
+                if buffer is not None:
+                    # Análise completa: upsert em lote (flush ao encher ou no fim da sessão)
+                    buffer.add(
+                        sessao=sessao,
+                        documento=documento,
+                        bloco=result['bloco'],
+                        subetapa=result['subetapa'],
+                        **fields
+                    )
+                else:
+                    ResultadoAnalise.objects.update_or_create(
+                        sessao=sessao,
+                        documento=documento,
+                        bloco=result['bloco'],
+                        subetapa=result['subetapa'],
+                        defaults=fields
+                    )
             
         except Exception as e:
             logger.error(f"Erro ao salvar resultado: {e}")
             raise
     
-    def _generate_cache_key(
-        self, 
-        documento: Documento, 
-        bloco: int, 
-        subetapa: int
-    ) -> str:
-        """Gera chave de cache para análise"""
+    @contextmanager
+    def _buffered_results(self) -> Iterator[BulkUpsertBuffer]:
+        """Resultados salvos dentro do bloco vão para um buffer de upsert (flush explícito)"""
+        buffer = BulkUpsertBuffer(
+            ResultadoAnalise,
+            unique_fields=RESULT_UNIQUE_FIELDS,
+            update_fields=RESULT_UPDATE_FIELDS,
+            batch_size=settings.KERMARTIN_SETTINGS.get('RESULT_WRITE_BATCH_SIZE', 25),
+        )
+        token = _result_buffer.set(buffer)
+        try:
+            yield buffer
+        finally:
+            _result_buffer.reset(token)
+    
+    def _flush_results(self, buffer: BulkUpsertBuffer) -> int:
+        with span('db.flush_results', linhas=len(buffer)):
+            return buffer.flush()
+    
+    def _session_progress(self, sessao: SessaoAnalise) -> ThrottledSave:
+        """Bloco/subetapa atuais da sessão, gravados com intervalo mínimo entre gravações"""
+        return ThrottledSave(
+            sessao,
+            ['bloco_atual', 'subetapa_atual'],
+            settings.KERMARTIN_SETTINGS.get('SESSION_PROGRESS_SAVE_SEC', 2.0),
+        )
+    
+    def _content_hash(self, documento: Documento) -> str:
+        """Hash do conteúdo analisado, parte da chave de cache"""
         
-        content_hash = hashlib.sha256(
+        if self._has_page_store(documento):
+            # Modo grande: texto_extraido é só a prévia; o SHA-256 do PDF identifica o conteúdo
+            return documento.hash_arquivo[:16]
+        return hashlib.sha256(
             documento.texto_extraido.encode('utf-8')
         ).hexdigest()[:16]
-        
-        return f"kermartin_analysis_{documento.id}_{bloco}_{subetapa}_{content_hash}"
+    
+    def _cache_tags(self, documento: Documento) -> List[str]:
+        """Tags de cache do documento: documento, processo e usuário dono"""
+        return self.cache_manager.tags_for(
+            documento_id=documento.id,
+            processo_id=documento.processo_id,
+            user_id=documento.processo.usuario.user_id
+        )
+    
+    def _usage_scope(self, documento: Documento, sessao: SessaoAnalise):
+        """Escopo da razão de tokens (processo já carregado por _cache_tags)"""
+        return usage_scope(
+            usuario_id=documento.processo.usuario_id,
+            processo_id=documento.processo_id,
+            sessao_id=sessao.id
+        )
     
     def _get_max_subetapas(self, bloco: int) -> int:
         """Retorna número máximo de subetapas por bloco"""
@@ -3,6 +3,8 @@ Sistema de Prompts do Kermartin 3.0
 Baseado nas instruções detalhadas dos 4 blocos de análise jurídica
 """
 
+from typing import Tuple
+
 # Persona base do Kermartin 3.0
 KERMARTIN_PERSONA = """
 Você é Kermartin, um advogado criminalista experiente e especialista em Tribunal do Júri.
@@ -1103,6 +1105,19 @@ def get_prompt(bloco: int, subetapa: int, documento_texto: str) -> str:
     return prompt_template.format(documento_texto=documento_texto)
 
 
+def get_prompt_parts(bloco: int, subetapa: int) -> Tuple[str, str]:
+    """
+    Modelo do prompt dividido em (antes, depois) do texto do documento
+    
+    Cada modelo tem um único {documento_texto}, então
+    antes + texto + depois == get_prompt(bloco, subetapa, texto).
+    """
+    
+    marker = '\x00documento_texto\x00'
+    before, _, after = get_prompt(bloco, subetapa, marker).partition(marker)
+    return before, after
+
+
 def get_prompt_title(bloco: int, subetapa: int) -> str:
     """Retorna o título de um prompt específico"""
     prompts_map = {
@@ -7,8 +7,33 @@ from dataclasses import dataclass, asdict
 from typing import List, Dict, Any, Optional, Protocol
 from django.conf import settings
 from math import sqrt
+from functools import wraps
+import time
 import uuid
 
+from core.metrics_registry import observe_retrieval
+from core.tracing import current_trace_id, span
+from core.token_ledger import record_usage, usage_from_response
+
+
+def _observed(provider: str, operation: str):
+    """Records latency and outcome per provider (metrics registry and a tracing span)."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            with span(f'retrieval.{operation}', provider=provider) as current:
+                try:
+                    result = func(*args, **kwargs)
+                except Exception:
+                    observe_retrieval(provider, operation, time.perf_counter() - started, status='erro')
+                    raise
+                current.set_attribute('results', len(result))
+            observe_retrieval(provider, operation, time.perf_counter() - started)
+            return result
+        return wrapper
+    return decorator
+
 
 @dataclass
 class JurisItem:
@@ -113,6 +138,7 @@ class SimpleRAGRetrieval:
             pass
         return score
 
+    @_observed('simple', 'search')
     def search(self, q: Optional[str], filters: Dict[str, Any], topk: int = 8) -> List[JurisItem]:
         try:
             from juris.models import Jurisprudencia
@@ -145,14 +171,31 @@ class SimpleRAGRetrieval:
             from ai_engine.processor import OpenAI
             client = OpenAI(api_key=settings.OPENAI_API_KEY)
             model = getattr(settings, 'OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
+            started = time.perf_counter()
             resp = client.embeddings.create(model=model, input=[q_norm])
+            record_usage('embedding', model, latencia=time.perf_counter() - started, **usage_from_response(resp.usage))
             q_vec = resp.data[0].embedding
         except Exception:
             q_vec = None
 
+        def has_embedding(j) -> bool:
+            return hasattr(j, 'embedding') and bool(j.embedding and j.embedding.embedding)
+
+        # Ementa/fundamentação (adiadas no manager) só para o score textual, numa única consulta
+        textual = [j for j in candidates if not (q_vec and has_embedding(j))]
+        if textual:
+            texts = {
+                pk: (ementa, fundamentacao)
+                for pk, ementa, fundamentacao in Jurisprudencia.objects.filter(
+                    id__in=[j.id for j in textual]
+                ).values_list('id', 'ementa', 'fundamentacao')
+            }
+            for j in textual:
+                j.ementa, j.fundamentacao = texts.get(j.id, (None, None))
+
         scored = []
         for j in candidates:
-            if q_vec and hasattr(j, 'embedding') and j.embedding and j.embedding.embedding:
+            if q_vec and has_embedding(j):
                 sim = cosine(q_vec, j.embedding.embedding)
                 # bônus por recência
                 if getattr(j, 'data_julgamento', None):
@@ -175,6 +218,7 @@ class SimpleRAGRetrieval:
             items.append(item)
         return items
 
+    @_observed('simple', 'sugestoes')
     def sugestoes(self, filters: Dict[str, Any], topk: int = 8) -> List[JurisItem]:
         try:
             from juris.models import Jurisprudencia
@@ -210,6 +254,7 @@ class GraphRAGRetrieval:
         except Exception:
             return []
 
+    @_observed('graph', 'search')
     def search(self, q: Optional[str], filters: Dict[str, Any], topk: int = 8) -> List[JurisItem]:
         tema = (filters.get('tema') or '').strip() if filters else ''
         tribunal = (filters.get('tribunal') or '').strip() if filters else ''
@@ -262,7 +307,9 @@ class GraphRAGRetrieval:
             from ai_engine.processor import OpenAI
             client = OpenAI(api_key=settings.OPENAI_API_KEY)
             model = getattr(settings, 'OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
+            started = time.perf_counter()
             resp = client.embeddings.create(model=model, input=[q_norm])
+            record_usage('embedding', model, latencia=time.perf_counter() - started, **usage_from_response(resp.usage))
             q_vec = resp.data[0].embedding
         except Exception:
             q_vec = None
@@ -306,6 +353,7 @@ class GraphRAGRetrieval:
         scored.sort(key=lambda x: x[0], reverse=True)
         return [it for _, it in scored[:topk]]
 
+    @_observed('graph', 'sugestoes')
     def sugestoes(self, filters: Dict[str, Any], topk: int = 8) -> List[JurisItem]:
         return self.search(None, filters, topk)
 
@@ -321,10 +369,12 @@ class HybridRetrieval:
         # Optionally, check average score threshold when implemented
         return False
 
+    @_observed('hybrid', 'search')
     def search(self, q: Optional[str], filters: Dict[str, Any], topk: int = 8) -> List[JurisItem]:
         r = self.graph.search(q, filters, topk)
         return r if not self._fallback_needed(r) else self.simple.search(q, filters, topk)
 
+    @_observed('hybrid', 'sugestoes')
     def sugestoes(self, filters: Dict[str, Any], topk: int = 8) -> List[JurisItem]:
         r = self.graph.sugestoes(filters, topk)
         return r if not self._fallback_needed(r) else self.simple.sugestoes(filters, topk)
@@ -353,6 +403,7 @@ def make_response(items: List[JurisItem], provider_used: str) -> Dict[str, Any]:
     return {
         'items': [i.to_dict() for i in items],
         'provider_used': provider_used,
-        'trace_id': str(uuid.uuid4()),
+        # same id as the request trace (spans in TRACING_EXPORT_PATH) when there is one
+        'trace_id': current_trace_id() or str(uuid.uuid4()),
     }
 
@@ -3,15 +3,91 @@ Sistema de Segurança do Kermartin 3.0
 Proteção contra prompt injection e validações de segurança
 """
 
-import re
+import math
+import hashlib
 import logging
 from typing import List, Dict, Optional
-from django.core.cache import cache
+from django.conf import settings
+from .pattern_scanner import PatternScanner
+from .tiered_cache import LocalLRUCache
 from core.models import LogSeguranca
+from core.ratelimit import get_rate_limiter
+from core.buffered_writer import get_security_event_writer
+from core.ip_blocklist import get_ip_blocklist
+from core.tracing import traced
 
 logger = logging.getLogger('ai_engine')
 
 
+# Regras de prompt injection: (categoria, regex)
+PROMPT_INJECTION_RULES = [
+    # Comandos de bypass
+    ('bypass', r'ignore\s+previous\s+instructions'),
+    ('bypass', r'forget\s+everything\s+above'),
+    ('bypass', r'disregard\s+the\s+above'),
+    ('bypass', r'new\s+instructions?:'),
+    
+    # Tentativas de revelação
+    ('revelacao', r'show\s+me\s+your\s+prompts?'),
+    ('revelacao', r'reveal\s+your\s+system\s+message'),
+    ('revelacao', r'what\s+are\s+your\s+instructions'),
+    ('revelacao', r'translate\s+your\s+instructions'),
+    
+    # Comandos de sistema
+    ('codigo', r'system\s*\('),
+    ('codigo', r'exec\s*\('),
+    ('codigo', r'eval\s*\('),
+    ('codigo', r'import\s+os'),
+    ('codigo', r'subprocess\.'),
+    
+    # Tentativas de escape
+    ('escape', r'```\s*python'),
+    ('escape', r'```\s*bash'),
+    ('escape', r'```\s*shell'),
+    ('escape', r'<script'),
+    ('escape', r'javascript:'),
+    
+    # Manipulação de contexto
+    ('contexto', r'you\s+are\s+now'),
+    ('contexto', r'pretend\s+to\s+be'),
+    ('contexto', r'act\s+as\s+if'),
+    ('contexto', r'roleplay\s+as'),
+    
+    # Comandos de administração
+    ('administracao', r'admin\s+mode'),
+    ('administracao', r'developer\s+mode'),
+    ('administracao', r'debug\s+mode'),
+    ('administracao', r'maintenance\s+mode'),
+]
+
+SYSTEM_COMMANDS = [
+    'rm -rf', 'del ', 'format c:', 'sudo ', 'chmod ',
+    'passwd', 'useradd', 'userdel', 'kill ', 'killall'
+]
+
+MALICIOUS_CONTENT = [
+    '<script', 'javascript:', 'data:text/html',
+    'eval(', 'exec(', 'system(', 'shell_exec'
+]
+
+# Compilados uma vez por processo
+PROMPT_SCANNER = PatternScanner(
+    PROMPT_INJECTION_RULES
+    + [('comando_sistema', pattern) for pattern in PatternScanner.literal(SYSTEM_COMMANDS)]
+)
+CONTENT_SCANNER = PatternScanner(
+    ('conteudo_malicioso', pattern) for pattern in PatternScanner.literal(MALICIOUS_CONTENT)
+)
+RULESET_VERSION = f"{PROMPT_SCANNER.version}{CONTENT_SCANNER.version}"
+
+# Texto varrido dos dois lados de cada junção modelo/chunk do prompt
+PROMPT_JUNCTION_WINDOW = 256
+
+# Partes de prompt já aprovadas neste processo, pelo hash (modelos e chunks
+# se repetem em todas as subetapas de uma análise)
+_clean_prompt_parts = LocalLRUCache(max_entries=4096, ttl=3600)
+
+
 class SecurityValidator:
     """Validador de segurança para o sistema Kermartin"""
     
@@ -39,35 +115,69 @@ class SecurityValidator:
         if not prompt or len(prompt) > self.max_prompt_length:
             return False
         
-        prompt_lower = prompt.lower()
-        
-        # Verificar padrões perigosos
-        for pattern in self.dangerous_patterns:
-            if re.search(pattern, prompt_lower, re.IGNORECASE):
-                self._log_security_event(
-                    'prompt_injection',
-                    f"Padrão suspeito detectado: {pattern}",
-                    {'prompt_snippet': prompt[:200]}
-                )
-                return False
-        
-        # Verificar comandos de sistema
-        system_commands = [
-            'rm -rf', 'del ', 'format c:', 'sudo ', 'chmod ',
-            'passwd', 'useradd', 'userdel', 'kill ', 'killall'
-        ]
-        
-        for cmd in system_commands:
-            if cmd in prompt_lower:
-                self._log_security_event(
-                    'prompt_injection',
-                    f"Comando de sistema detectado: {cmd}",
-                    {'prompt_snippet': prompt[:200]}
-                )
-                return False
+        # Uma passada pelo texto com todas as regras (padrões e comandos de sistema)
+        return self._scan_prompt(prompt)
+    
+    @traced('security.validate_prompt')
+    def validate_prompt_parts(self, prefix: str, chunk: str, suffix: str) -> bool:
+        """
+        Equivalente a validate_prompt_injection(prefix + chunk + suffix)
+        
+        Modelo e chunk são varridos uma vez por processo e lembrados pelo hash;
+        a cada prompt, só as junções entre eles são varridas.
+        
+        Returns:
+            bool: True se seguro, False se suspeito
+        """
+        
+        if len(prefix) + len(chunk) + len(suffix) > self.max_prompt_length:
+            return False
+        
+        window = PROMPT_JUNCTION_WINDOW
+        if len(chunk) < 2 * window:
+            return self.validate_prompt_injection(prefix + chunk + suffix)
         
+        return (
+            self._scan_prompt_part(prefix)
+            and self._scan_prompt_part(chunk)
+            and self._scan_prompt_part(suffix)
+            and self._scan_prompt(prefix[-window:] + chunk[:window])
+            and self._scan_prompt(chunk[-window:] + suffix[:window])
+        )
+    
+    @property
+    def ruleset_version(self) -> str:
+        """Versão das regras e limites: parte da chave de validações em cache"""
+        return f"{RULESET_VERSION}_{self.max_content_length}"
+    
+    def _scan_prompt_part(self, part: str) -> bool:
+        """Varre uma parte do prompt, pulando as já aprovadas neste processo"""
+        
+        key = hashlib.blake2b(part.encode('utf-8'), digest_size=16).digest()
+        if _clean_prompt_parts.get(key, False):
+            return True
+        if not self._scan_prompt(part):
+            return False
+        _clean_prompt_parts.set(key, True)
         return True
     
+    def _scan_prompt(self, text: str) -> bool:
+        match = PROMPT_SCANNER.scan(text)
+        if match is None:
+            return True
+        
+        if match.rule == 'comando_sistema':
+            description = f"Comando de sistema detectado: {match.text}"
+        else:
+            description = f"Padrão suspeito detectado: {match.pattern}"
+        self._log_security_event(
+            'prompt_injection',
+            description,
+            {'prompt_snippet': text[:200], 'regra': match.rule}
+        )
+        return False
+    
+    @traced('security.validate_document')
     def validate_document_content(self, content: str) -> bool:
         """
         Valida conteúdo de documento
@@ -87,23 +197,18 @@ class SecurityValidator:
             return False
         
         # Verificar conteúdo malicioso
-        malicious_content = [
-            '<script', 'javascript:', 'data:text/html',
-            'eval(', 'exec(', 'system(', 'shell_exec'
-        ]
-        
-        content_lower = content.lower()
-        for pattern in malicious_content:
-            if pattern in content_lower:
-                self._log_security_event(
-                    'upload_suspeito',
-                    f"Conteúdo malicioso detectado: {pattern}",
-                    {'content_snippet': content[:200]}
-                )
-                return False
+        match = CONTENT_SCANNER.scan(content)
+        if match is not None:
+            self._log_security_event(
+                'upload_suspeito',
+                f"Conteúdo malicioso detectado: {match.text}",
+                {'content_snippet': content[:200]}
+            )
+            return False
         
         return True
     
+    @traced('security.validate_upload')
     def validate_file_upload(self, file_obj) -> Dict[str, bool]:
         """
         Valida upload de arquivo
@@ -126,7 +231,7 @@ class SecurityValidator:
             result['errors'].append('Apenas arquivos PDF são permitidos')
         
         # Verificar tamanho
-        max_size = 10 * 1024 * 1024  # 10MB
+        max_size = settings.KERMARTIN_SETTINGS['MAX_DOCUMENT_SIZE']
         if file_obj.size > max_size:
             result['valid'] = False
             result['errors'].append(f'Arquivo muito grande: {file_obj.size} bytes')
@@ -168,9 +273,6 @@ class SecurityValidator:
         except Exception:
             pass
 
-        cache_key = f"rate_limit_{user_id}_{action}"
-        current_count = cache.get(cache_key, 0)
-        
         # Limites por hora
         limits = {
             'analysis': 50,
@@ -179,17 +281,16 @@ class SecurityValidator:
         }
         
         limit = limits.get(action, 10)
+        result = get_rate_limiter().hit(f"{user_id}_{action}", limit, 3600)
         
-        if current_count >= limit:
+        if not result.allowed:
             self._log_security_event(
                 'rate_limit_exceeded',
-                f"Limite excedido para {action}: {current_count}/{limit}",
-                {'user_id': user_id, 'action': action}
+                f"Limite excedido para {action}: {limit}/{limit}",
+                {'user_id': user_id, 'action': action, 'retry_after': math.ceil(result.retry_after)}
             )
             return False
         
-        # Incrementar contador
-        cache.set(cache_key, current_count + 1, timeout=3600)  # 1 hora
         return True
     
     def validate_api_request(self, request) -> Dict[str, any]:
@@ -231,45 +332,7 @@ class SecurityValidator:
     def _load_dangerous_patterns(self) -> List[str]:
         """Carrega padrões perigosos para detecção de injection"""
         
-        return [
-            # Comandos de bypass
-            r'ignore\s+previous\s+instructions',
-            r'forget\s+everything\s+above',
-            r'disregard\s+the\s+above',
-            r'new\s+instructions?:',
-            
-            # Tentativas de revelação
-            r'show\s+me\s+your\s+prompts?',
-            r'reveal\s+your\s+system\s+message',
-            r'what\s+are\s+your\s+instructions',
-            r'translate\s+your\s+instructions',
-            
-            # Comandos de sistema
-            r'system\s*\(',
-            r'exec\s*\(',
-            r'eval\s*\(',
-            r'import\s+os',
-            r'subprocess\.',
-            
-            # Tentativas de escape
-            r'```\s*python',
-            r'```\s*bash',
-            r'```\s*shell',
-            r'<script',
-            r'javascript:',
-            
-            # Manipulação de contexto
-            r'you\s+are\s+now',
-            r'pretend\s+to\s+be',
-            r'act\s+as\s+if',
-            r'roleplay\s+as',
-            
-            # Comandos de administração
-            r'admin\s+mode',
-            r'developer\s+mode',
-            r'debug\s+mode',
-            r'maintenance\s+mode',
-        ]
+        return [pattern for _, pattern in PROMPT_INJECTION_RULES]
     
     def _log_security_event(
         self, 
@@ -280,7 +343,7 @@ class SecurityValidator:
         """Registra evento de segurança"""
         
         try:
-            LogSeguranca.objects.create(
+            get_security_event_writer().submit(
                 tipo_evento=event_type,
                 descricao=description,
                 ip_address='127.0.0.1',  # Será preenchido pela view
@@ -306,17 +369,12 @@ class SecurityValidator:
     def _is_blocked_ip(self, ip_address: str) -> bool:
         """Verifica se IP está bloqueado"""
         
-        # Lista de IPs bloqueados (pode vir do banco ou cache)
-        blocked_ips = cache.get('blocked_ips', set())
-        
-        return ip_address in blocked_ips
+        return get_ip_blocklist().is_blocked(ip_address)
     
     def block_ip(self, ip_address: str, duration: int = 3600):
-        """Bloqueia IP por tempo determinado"""
+        """Bloqueia IP (ou faixa CIDR) por tempo determinado"""
         
-        blocked_ips = cache.get('blocked_ips', set())
-        blocked_ips.add(ip_address)
-        cache.set('blocked_ips', blocked_ips, timeout=duration)
+        get_ip_blocklist().block(ip_address, duration)
         
         self._log_security_event(
             'ip_blocked',
@@ -337,7 +395,7 @@ class SecurityValidator:
         summary = {
             'total_events': events.count(),
             'events_by_type': {},
-            'blocked_ips': len(cache.get('blocked_ips', set())),
+            'blocked_ips': get_ip_blocklist().count(),
             'last_24h': {
                 'prompt_injections': events.filter(tipo_evento='prompt_injection').count(),
                 'suspicious_uploads': events.filter(tipo_evento='upload_suspeito').count(),
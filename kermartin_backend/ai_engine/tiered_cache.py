@@ -0,0 +1,237 @@
+"""
+Cache em Dois Níveis do Kermartin 3.0
+L1 em memória do processo (LRU com TTL) na frente do cache do Django (Redis),
+com recálculo único por chave (single-flight) e renovação antecipada probabilística
+"""
+
+import math
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional
+from django.conf import settings
+from .cache_stats import get_cache_stats, get_instrumented_cache, namespace_for
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger('ai_engine')
+
+_MISSING = object()
+
+
+class LocalLRUCache:
+    """Cache em memória limitado por número de entradas, com TTL por entrada"""
+
+    def __init__(self, max_entries: int, ttl: float, on_evict: Optional[Callable[[str], None]] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = _MISSING) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        evicted = []
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                evicted.append(self._data.popitem(last=False)[0])
+        if self.on_evict:
+            for evicted_key in evicted:
+                self.on_evict(evicted_key)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class TieredCache:
+    """
+    L1 local + L2 compartilhado (cache do Django)
+
+    O L1 tem TTL curto: escritas e remoções feitas neste processo o atualizam
+    na hora; as de outros processos são vistas após no máximo L1_CACHE_TTL_SEC.
+    """
+
+    # Locks locais distribuídos por hash da chave (sem crescer por chave)
+    _LOCK_STRIPES = 64
+
+    def __init__(self, backend=None, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        kermartin_settings = settings.KERMARTIN_SETTINGS
+        # Backend instrumentado: acertos/faltas/latência do Redis por namespace
+        self.backend = backend or get_instrumented_cache()
+        self.stats = get_cache_stats()
+        self.local = LocalLRUCache(
+            max_entries or kermartin_settings.get('L1_CACHE_MAX_ENTRIES', 1024),
+            ttl if ttl is not None else kermartin_settings.get('L1_CACHE_TTL_SEC', 5.0),
+            on_evict=lambda key: self.stats.record(namespace_for(key), 'evictions')
+        )
+        self.lock_timeout = kermartin_settings.get('CACHE_LOCK_TIMEOUT_SEC', 30)
+        self.early_refresh_beta = kermartin_settings.get('CACHE_EARLY_REFRESH_BETA', 1.0)
+        self._locks = [threading.Lock() for _ in range(self._LOCK_STRIPES)]
+
+    # Operações básicas
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.local.get(key)
+        if value is not _MISSING:
+            self.stats.record(namespace_for(key), 'hits_l1')
+            return value
+
+        value = self.backend.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self.local.set(key, value)
+        return value
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                self.stats.record(namespace_for(key), 'hits_l1')
+                found[key] = value
+
+        if missing:
+            remote = self.backend.get_many(missing)
+            for key, value in remote.items():
+                self.local.set(key, value)
+            found.update(remote)
+        return found
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        self.backend.set(key, value, timeout=timeout)
+        self.local.set(key, value, timeout)
+        return True
+
+    def add(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        added = self.backend.add(key, value, timeout=timeout)
+        self.local.delete(key)
+        return added
+
+    def incr(self, key: str, delta: int = 1) -> int:
+        self.local.delete(key)
+        return self.backend.incr(key, delta)
+
+    def delete(self, key: str) -> None:
+        self.local.delete(key)
+        self.backend.delete(key)
+
+    # Recálculo protegido contra stampede
+
+    def get_or_set(self, key: str, compute: Callable[[], Any], timeout: Optional[int] = None) -> Any:
+        """
+        Valor da chave, calculado por no máximo um chamador por vez
+
+        Entradas guardam o custo do cálculo; perto da expiração, um chamador é
+        sorteado para renovar antes do prazo (XFetch) enquanto os demais seguem
+        com o valor atual. Em falta total, quem não obtém o lock espera o valor.
+        """
+
+        entry = self._entry(key)
+        if entry is not None and not self._should_refresh(entry):
+            return entry['value']
+
+        stale = entry['value'] if entry is not None else _MISSING
+        with self._locks[hash(key) % self._LOCK_STRIPES]:
+            # Outro thread deste processo pode ter acabado de calcular
+            entry = self._entry(key)
+            if entry is not None and not self._should_refresh(entry):
+                return entry['value']
+
+            lock_key = f"{key}_lock"
+            if not self.backend.add(lock_key, 1, timeout=self.lock_timeout):
+                if stale is not _MISSING:
+                    return stale
+                value = self._wait_for(key)
+                if value is not _MISSING:
+                    return value
+                logger.warning(f"Espera pelo recálculo expirou, calculando localmente: {key}")
+
+            try:
+                return self._compute_and_store(key, compute, timeout)
+            finally:
+                self.backend.delete(lock_key)
+
+    def _entry(self, key: str) -> Optional[Dict]:
+        """Entrada gravada por get_or_set (valores em outro formato contam como falta)"""
+        entry = self.get(key)
+        if isinstance(entry, dict) and 'expires_at' in entry:
+            return entry
+        return None
+
+    def _compute_and_store(self, key: str, compute: Callable[[], Any], timeout: Optional[int]) -> Any:
+        started = time.monotonic()
+        value = compute()
+        delta = time.monotonic() - started
+
+        timeout = timeout or 300
+        self.set(key, {
+            'value': value,
+            'delta': delta,
+            'expires_at': time.time() + timeout,
+        }, timeout=timeout)
+        return value
+
+    def _should_refresh(self, entry: Dict) -> bool:
+        """XFetch: renova mais cedo quanto mais caro o cálculo e mais perto do vencimento"""
+        gap = entry['delta'] * self.early_refresh_beta * -math.log(1.0 - random.random())
+        return time.time() + gap >= entry['expires_at']
+
+    def _wait_for(self, key: str) -> Any:
+        """Aguarda outro processo publicar o valor (até o timeout do lock)"""
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.05
+        while time.monotonic() < deadline:
+            time.sleep(delay)
+            entry = self._entry(key)
+            if entry is not None:
+                return entry['value']
+            delay = min(delay * 2, 0.5)
+        return _MISSING
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_tiered_cache() -> TieredCache:
+    """Instância compartilhada do processo"""
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = TieredCache()
+    return _default
+
+
+@receiver(setting_changed)
+def _reset_tiered_cache(setting, **kwargs):
+    """Descarta a instância (e o L1) quando CACHES/KERMARTIN_SETTINGS mudam (testes)"""
+    global _default
+    if setting in ('CACHES', 'KERMARTIN_SETTINGS'):
+        _default = None
@@ -3,9 +3,10 @@ URLs do AI Engine - Kermartin 3.0
 """
 
 from django.urls import path
+from django.views.decorators.csrf import csrf_exempt
 from .views import (
     ProcessarDocumentoView, AnaliseIndividualView,
-    AnaliseCompletaView, StatusSegurancaView,
+    AnaliseCompletaView, AnaliseCompletaAsyncView, StatusSegurancaView,
     JurisprudenciaSearchView, JurisprudenciaSugestoesView, JurisprudenciaHealthView, InfraHealthView,
 )
 
@@ -15,6 +16,8 @@ urlpatterns = [
     path('processar-documento/', ProcessarDocumentoView.as_view(), name='processar_documento'),
     path('analise-individual/', AnaliseIndividualView.as_view(), name='analise_individual'),
     path('analise-completa/', AnaliseCompletaView.as_view(), name='analise_completa'),
+    # Requer servidor ASGI (kermartin_project.asgi); autenticação JWT própria
+    path('analise-completa-async/', csrf_exempt(AnaliseCompletaAsyncView.as_view()), name='analise_completa_async'),
     path('status-seguranca/', StatusSegurancaView.as_view(), name='status_seguranca'),
     # Jurisprudência (GraphRAG-ready): provider=? simple|graph|hybrid
     path('jurisprudencia/search/', JurisprudenciaSearchView.as_view(), name='jurisprudencia_search'),
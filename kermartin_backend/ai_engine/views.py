@@ -2,17 +2,26 @@
 Views do AI Engine - Kermartin 3.0
 """
 
+import json
 import logging
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views import View
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
+from rest_framework_simplejwt.authentication import JWTAuthentication
 from .processor import KermartinProcessor
+from .async_processor import AsyncKermartinProcessor
 from .security import SecurityValidator
 from django.conf import settings
 import time
 from .document_processor import DocumentProcessor
+from .cache_manager import KermartinCacheManager
 from .retrieval import get_service, make_response, GraphRAGRetrieval
+from core.tracing import current_trace_id
+from core.token_ledger import get_token_ledger, BudgetExceeded
 
 logger = logging.getLogger('ai_engine')
 
@@ -43,26 +52,28 @@ class ProcessarDocumentoView(APIView):
 
             processor = DocumentProcessor()
 
-            # Extrair texto
-            texto = processor.extract_text_from_pdf(documento.arquivo_original.path)
-
-            # Analisar estrutura
-            estrutura = processor.analyze_document_structure(texto)
-
-            # Extrair informações-chave
-            info_chave = processor.extract_key_information(texto)
+            # Extração endereçada pelo hash: reuploads não reabrem o PDF
+            extracao = processor.process_document(
+                documento.arquivo_original.path,
+                file_hash=documento.hash_arquivo or None
+            )
+            texto = extracao['texto']
 
             # Salvar texto extraído
             documento.texto_extraido = texto
+            documento.hash_arquivo = extracao['hash']
             documento.save()
+            KermartinCacheManager().invalidate_document_cache(documento.id)
 
             return Response({
                 'success': True,
                 'documento_id': str(documento.id),
                 'texto_extraido': len(texto) > 0,
-                'caracteres': len(texto),
-                'estrutura': estrutura,
-                'informacoes_chave': info_chave
+                'caracteres': extracao.get('caracteres', len(texto)),
+                'documento_grande': extracao.get('paginas_em_disco', False),
+                'estrutura': extracao['estrutura'],
+                'informacoes_chave': extracao['informacoes_chave'],
+                'extracao_reaproveitada': extracao['cache_hit']
             })
 
         except Exception as e:
@@ -95,7 +106,8 @@ class AnaliseIndividualView(APIView):
             from core.models import Documento, Usuario, SessaoAnalise
 
             usuario = Usuario.objects.get(user=request.user)
-            documento = Documento.objects.get(
+            get_token_ledger().check_budget(usuario)
+            documento = Documento.objects.with_text().get(
                 id=data['documento_id'],
                 processo__usuario=usuario
             )
@@ -120,6 +132,11 @@ class AnaliseIndividualView(APIView):
                 'resultado': resultado
             })
 
+        except BudgetExceeded as e:
+            return Response(
+                {'error': str(e), 'consumo': e.consumo},
+                status=status.HTTP_429_TOO_MANY_REQUESTS
+            )
         except Exception as e:
             logger.error(f"Erro na análise individual: {e}")
             return Response(
@@ -149,12 +166,13 @@ class AnaliseCompletaView(APIView):
             from core.models import Processo, Usuario, SessaoAnalise
 
             usuario = Usuario.objects.get(user=request.user)
+            get_token_ledger().check_budget(usuario)
             processo = Processo.objects.get(
                 id=processo_id,
                 usuario=usuario
             )
 
-            documentos = processo.documentos.filter(texto_extraido__isnull=False)
+            documentos = processo.documentos.processados()
             if not documentos.exists():
                 return Response(
                     {'error': 'Processo não possui documentos processados'},
@@ -171,7 +189,7 @@ class AnaliseCompletaView(APIView):
             # Executar análise
             processor = KermartinProcessor()
             resultado = processor.analyze_complete_process(
-                list(documentos),
+                list(documentos.with_text()),
                 sessao,
                 blocos
             )
@@ -181,6 +199,11 @@ class AnaliseCompletaView(APIView):
                 'resultado': resultado
             })
 
+        except BudgetExceeded as e:
+            return Response(
+                {'error': str(e), 'consumo': e.consumo},
+                status=status.HTTP_429_TOO_MANY_REQUESTS
+            )
         except Exception as e:
             logger.error(f"Erro na análise completa: {e}")
             return Response(
@@ -189,6 +212,84 @@ class AnaliseCompletaView(APIView):
             )
 
 
+class AnaliseCompletaAsyncView(View):
+    """View assíncrona (ASGI) para análise completa com AsyncOpenAI.
+
+    Com ``executar_em='worker'`` a sessão é apenas enfileirada para o
+    comando ``run_analysis_worker``; caso contrário a análise roda no
+    próprio event loop do servidor ASGI.
+    """
+
+    async def post(self, request):
+        """Executa ou enfileira análise completa"""
+
+        try:
+            user = await sync_to_async(self._authenticate)(request)
+        except Exception:
+            user = None
+        if user is None:
+            return JsonResponse({'error': 'Não autenticado'}, status=401)
+
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'error': 'JSON inválido'}, status=400)
+
+        processo_id = data.get('processo_id')
+        blocos = data.get('blocos', [1, 2, 3, 4])
+        executar_em = data.get('executar_em', 'servidor')
+
+        if not processo_id:
+            return JsonResponse({'error': 'processo_id é obrigatório'}, status=400)
+
+        try:
+            from core.models import Processo, Usuario, SessaoAnalise
+
+            usuario = await Usuario.objects.aget(user=user)
+            # Orçamento conferido antes de executar ou enfileirar para o worker
+            await sync_to_async(get_token_ledger().check_budget)(usuario)
+            processo = await Processo.objects.aget(id=processo_id, usuario=usuario)
+
+            documentos = [
+                doc async for doc in processo.documentos.processados().with_text()
+            ]
+            if not documentos:
+                return JsonResponse(
+                    {'error': 'Processo não possui documentos processados'},
+                    status=400
+                )
+
+            sessao = await SessaoAnalise.objects.acreate(
+                processo=processo,
+                modo_analise='completa',
+                blocos_selecionados=blocos,
+                configuracoes={'execucao': executar_em, 'trace_id': current_trace_id()}
+            )
+
+            if executar_em == 'worker':
+                return JsonResponse({
+                    'success': True,
+                    'sessao_id': str(sessao.id),
+                    'status': sessao.status
+                }, status=202)
+
+            processor = AsyncKermartinProcessor()
+            resultado = await processor.aanalyze_complete_process(documentos, sessao, blocos)
+
+            return JsonResponse({'success': True, 'resultado': resultado})
+
+        except BudgetExceeded as e:
+            return JsonResponse({'error': str(e), 'consumo': e.consumo}, status=429)
+        except Exception as e:
+            logger.error(f"Erro na análise completa assíncrona: {e}")
+            return JsonResponse({'error': str(e)}, status=500)
+
+    def _authenticate(self, request):
+        """Autentica via JWT (mesmo esquema das APIs DRF)"""
+        auth = JWTAuthentication().authenticate(request)
+        return auth[0] if auth else None
+
+
 class StatusSegurancaView(APIView):
     """View para status de segurança"""
 
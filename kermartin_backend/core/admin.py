@@ -6,7 +6,18 @@ from django.contrib import admin
 from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.safestring import mark_safe
-from .models import Usuario, Processo, Documento, SessaoAnalise, ResultadoAnalise, LogSeguranca
+from .models import Usuario, Processo, Documento, SessaoAnalise, ResultadoAnalise, LogSeguranca, MetricaRollup, ConsumoTokens
+
+
+class DeferredTextAdminMixin:
+    """Changelist sem os textos longos do modelo; a tela de edição os carrega"""
+    
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        match = request.resolver_match
+        if match and match.url_name and match.url_name.endswith('_change'):
+            return queryset.with_text()
+        return queryset
 
 
 @admin.register(Usuario)
@@ -25,6 +36,9 @@ class UsuarioAdmin(admin.ModelAdmin):
         ('Informações Profissionais', {
             'fields': ('oab_numero', 'oab_estado', 'escritorio', 'especialidades')
         }),
+        ('Orçamento Mensal', {
+            'fields': ('limite_tokens_mensal', 'limite_custo_mensal')
+        }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
@@ -73,7 +87,7 @@ class ProcessoAdmin(admin.ModelAdmin):
 
 
 @admin.register(Documento)
-class DocumentoAdmin(admin.ModelAdmin):
+class DocumentoAdmin(DeferredTextAdminMixin, admin.ModelAdmin):
     """Admin para modelo Documento"""
     
     list_display = ['nome_arquivo', 'tipo_documento', 'processo_titulo', 'tamanho_formatado', 'tem_texto', 'created_at']
@@ -110,10 +124,13 @@ class DocumentoAdmin(admin.ModelAdmin):
     tamanho_formatado.short_description = 'Tamanho'
     
     def tem_texto(self, obj):
-        if obj.texto_extraido:
+        if obj.tem_texto:
             return format_html('<span style="color: green;">✓ Sim</span>')
         return format_html('<span style="color: red;">✗ Não</span>')
     tem_texto.short_description = 'Texto Extraído'
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('processo').with_text_flag()
 
 
 @admin.register(SessaoAnalise)
@@ -161,7 +178,7 @@ class SessaoAnaliseAdmin(admin.ModelAdmin):
 
 
 @admin.register(ResultadoAnalise)
-class ResultadoAnaliseAdmin(admin.ModelAdmin):
+class ResultadoAnaliseAdmin(DeferredTextAdminMixin, admin.ModelAdmin):
     """Admin para modelo ResultadoAnalise"""
     
     list_display = ['sessao_processo', 'bloco', 'subetapa', 'documento_nome', 'tokens_total', 'tempo_processamento', 'modelo_usado', 'created_at']
@@ -192,6 +209,13 @@ class ResultadoAnaliseAdmin(admin.ModelAdmin):
     def documento_nome(self, obj):
         return obj.documento.nome_arquivo
     documento_nome.short_description = 'Documento'
+    
+    def get_queryset(self, request):
+        return (
+            super().get_queryset(request)
+            .select_related('sessao__processo', 'documento')
+            .defer('documento__texto_extraido')
+        )
 
 
 @admin.register(LogSeguranca)
@@ -233,6 +257,37 @@ class LogSegurancaAdmin(admin.ModelAdmin):
     descricao_resumida.short_description = 'Descrição'
 
 
+
+@admin.register(MetricaRollup)
+class MetricaRollupAdmin(admin.ModelAdmin):
+    """Admin para modelo MetricaRollup (somente leitura; gravado por rollup_metrics)"""
+    
+    list_display = ['periodo', 'escopo', 'inicio', 'processos', 'sessoes', 'resultados', 'atualizado_em']
+    list_filter = ['periodo']
+    search_fields = ['escopo']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ConsumoTokens)
+class ConsumoTokensAdmin(admin.ModelAdmin):
+    """Admin para modelo ConsumoTokens (somente leitura; gravado pela razão de tokens)"""
+    
+    list_display = ['created_at', 'usuario', 'operacao', 'modelo', 'tokens_prompt', 'tokens_cache', 'tokens_resposta', 'custo']
+    list_filter = ['operacao', 'modelo', 'created_at']
+    raw_id_fields = ['usuario', 'processo', 'sessao']
+    date_hierarchy = 'created_at'
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
 # Customização do Admin Site
 admin.site.site_header = "Kermartin 3.0 - Administração"
 admin.site.site_title = "Kermartin 3.0"
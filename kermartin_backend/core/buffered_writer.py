@@ -0,0 +1,261 @@
+"""
+Gravação em Lote do Kermartin 3.0
+Fila em memória esvaziada por uma thread com bulk_create, para tirar
+gravações de log do caminho da requisição; upsert em lote e gravação
+espaçada de progresso para o laço de análise
+"""
+
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from typing import Dict, Iterable
+from django.conf import settings
+from django.db import close_old_connections
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger('kermartin')
+
+
+class BufferedModelWriter:
+    """
+    Grava instâncias de um modelo em lote
+
+    submit() só enfileira (não toca o banco). Uma thread por processo grava a
+    cada `batch_size` itens ou `flush_interval` segundos, o que vier antes.
+    A fila é limitada: sob sobrecarga (ex.: varredura de bots) os excedentes
+    são descartados e contados, em vez de crescer a memória ou travar a
+    requisição. Sem thread (background=False), grava ao completar um lote
+    e em flush().
+    """
+
+    def __init__(
+        self,
+        model,
+        batch_size: int = 100,
+        flush_interval: float = 0.5,
+        max_queue: int = 10000,
+        background: bool = True
+    ):
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.background = background
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, **fields) -> bool:
+        """Enfileira uma instância; False se descartada por fila cheia"""
+
+        try:
+            self._queue.put_nowait(self.model(**fields))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            # Um aviso no primeiro descarte e a cada mil, não um por requisição
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.warning(f"Fila de {self.model.__name__} cheia: {dropped} eventos descartados")
+            return False
+
+        if self.background:
+            self._ensure_thread()
+        elif self._queue.qsize() >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self) -> int:
+        """Grava tudo o que está na fila, no thread atual"""
+
+        written = 0
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                return written
+            written += self._write(batch)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pendentes': self._queue.qsize(),
+            'gravados': self.written,
+            'descartados': self.dropped,
+        }
+
+    # Thread de gravação
+
+    def _ensure_thread(self) -> None:
+        if self._thread_running():
+            return
+        with self._lock:
+            if self._thread_running():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name=f"{self.model.__name__}Writer", daemon=True
+            )
+            self._thread.start()
+
+    def _thread_running(self) -> bool:
+        # Após fork (gunicorn), a thread do processo pai não existe no filho
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            close_old_connections()
+            self._write(batch)
+
+    def _drain(self, limit: int) -> list:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list) -> int:
+        try:
+            self.model.objects.bulk_create(batch, batch_size=self.batch_size)
+        except Exception as e:
+            logger.error(f"Erro ao gravar lote de {self.model.__name__}: {e}")
+            with self._lock:
+                self.dropped += len(batch)
+            return 0
+        with self._lock:
+            self.written += len(batch)
+        return len(batch)
+
+
+class BulkUpsertBuffer:
+    """
+    Linhas acumuladas e gravadas com INSERT ... ON CONFLICT DO UPDATE em lote
+
+    Para gravações que não podem ser descartadas (resultados de análise): roda
+    no thread de quem chama e erros sobem. Linhas com a mesma chave única no
+    lote são deduplicadas (a última vence), pois o upsert não pode alterar a
+    mesma linha duas vezes num comando.
+    """
+
+    def __init__(self, model, unique_fields: Iterable[str], update_fields: Iterable[str], batch_size: int = 25):
+        self.model = model
+        self.unique_fields = list(unique_fields)
+        self.update_fields = list(update_fields)
+        self.batch_size = batch_size
+        self.written = 0
+        self._key_attnames = [model._meta.get_field(name).attname for name in self.unique_fields]
+        self._pending = {}
+
+    def add(self, **fields) -> None:
+        instance = self.model(**fields)
+        key = tuple(getattr(instance, attname) for attname in self._key_attnames)
+        self._pending.pop(key, None)
+        self._pending[key] = instance
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        if not self._pending:
+            return 0
+        batch = list(self._pending.values())
+        self.model.objects.bulk_create(
+            batch,
+            update_conflicts=True,
+            unique_fields=self.unique_fields,
+            update_fields=self.update_fields,
+        )
+        self._pending.clear()
+        self.written += len(batch)
+        return len(batch)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+class ThrottledSave:
+    """
+    Gravação espaçada de campos de uma instância (ex.: progresso da sessão)
+
+    set() atualiza os atributos em memória e indica quando já passou
+    `interval` desde a última gravação; save()/asave() gravam só os campos
+    informados (e updated_at, se o modelo tiver).
+    """
+
+    def __init__(self, instance, fields: Iterable[str], interval: float):
+        self.instance = instance
+        self.fields = list(fields)
+        if any(field.name == 'updated_at' for field in instance._meta.concrete_fields):
+            self.fields.append('updated_at')
+        self.interval = interval
+        self.dirty = False
+        self._last_save = time.monotonic()
+
+    def set(self, **values) -> bool:
+        """Atualiza os atributos; True quando é hora de gravar (a vez fica reservada)"""
+        for name, value in values.items():
+            setattr(self.instance, name, value)
+        self.dirty = True
+        now = time.monotonic()
+        if now - self._last_save < self.interval:
+            return False
+        # Reservada já aqui: corrotinas concorrentes não gravam todas juntas
+        self._last_save = now
+        return True
+
+    def save(self) -> None:
+        self.dirty = False
+        self.instance.save(update_fields=self.fields)
+
+    async def asave(self) -> None:
+        self.dirty = False
+        await self.instance.asave(update_fields=self.fields)
+
+
+_security_writer = None
+_security_writer_lock = threading.Lock()
+
+
+def get_security_event_writer() -> BufferedModelWriter:
+    """Fila de LogSeguranca compartilhada do processo"""
+    global _security_writer
+    if _security_writer is None:
+        with _security_writer_lock:
+            if _security_writer is None:
+                from .models import LogSeguranca
+
+                kermartin_settings = settings.KERMARTIN_SETTINGS
+                _security_writer = BufferedModelWriter(
+                    LogSeguranca,
+                    batch_size=kermartin_settings.get('SECURITY_EVENT_BATCH_SIZE', 100),
+                    flush_interval=kermartin_settings.get('SECURITY_EVENT_FLUSH_MS', 500) / 1000,
+                    max_queue=kermartin_settings.get('SECURITY_EVENT_QUEUE_MAX', 10000),
+                    background=kermartin_settings.get('SECURITY_EVENT_ASYNC', True),
+                )
+                # Eventos ainda na fila são gravados no encerramento do processo
+                atexit.register(_security_writer.flush)
+    return _security_writer
+
+
+@receiver(setting_changed)
+def _reset_security_writer(setting, **kwargs):
+    """Descarta a instância quando KERMARTIN_SETTINGS muda (testes)"""
+    global _security_writer
+    if setting == 'KERMARTIN_SETTINGS':
+        _security_writer = None
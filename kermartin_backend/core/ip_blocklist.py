@@ -0,0 +1,256 @@
+"""
+Bloqueio de IPs do Kermartin 3.0
+Consulta por endereço em O(1) (ZSCORE no Redis ou chave por IP), faixas CIDR
+numa trie de prefixos local e resultados recentes em cache do processo
+"""
+
+import time
+import logging
+import threading
+import ipaddress
+from typing import Dict, Optional, Union
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from ai_engine.cache_stats import get_instrumented_cache
+from ai_engine.tiered_cache import LocalLRUCache
+from .redis_utils import get_redis_client, make_redis_key
+
+logger = logging.getLogger('kermartin')
+
+_END = 'end'
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class PrefixTrie:
+    """Trie binária de redes: um endereço casa se algum prefixo bloqueado o contém"""
+
+    def __init__(self):
+        self._roots = {4: {}, 6: {}}
+        self.size = 0
+
+    def add(self, network: IPNetwork) -> None:
+        node = self._roots[network.version]
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            node = node.setdefault((bits >> (width - 1 - i)) & 1, {})
+        if _END not in node:
+            node[_END] = True
+            self.size += 1
+
+    def contains(self, address: Union[ipaddress.IPv4Address, ipaddress.IPv6Address]) -> bool:
+        node = self._roots[address.version]
+        bits = int(address)
+        width = address.max_prefixlen
+        for i in range(width):
+            if _END in node:
+                return True
+            node = node.get((bits >> (width - 1 - i)) & 1)
+            if node is None:
+                return False
+        return _END in node
+
+
+class IPBlocklist:
+    """
+    Lista de IPs e faixas bloqueados, com expiração por entrada
+
+    Com Redis, endereços ficam num sorted set (membro = IP, score = expiração),
+    consultado com ZSCORE, e faixas CIDR noutro sorted set. Sem Redis, cada IP
+    é uma chave própria com TTL no cache do Django. Faixas são poucas: cada
+    processo as carrega numa trie a cada BLOCKLIST_LOCAL_TTL_SEC. Resultados
+    por IP também ficam esse tempo em memória, então um bloqueio feito em
+    outro processo vale aqui em no máximo BLOCKLIST_LOCAL_TTL_SEC.
+    """
+
+    IPS_KEY = 'blocked_ips:v2'
+    NETWORKS_KEY = 'blocked_networks:v2'
+    IP_KEY_PREFIX = 'blocked_ip_'
+    INDEX_KEY = 'blocked_ips_index'
+
+    def __init__(self, local_ttl: Optional[float] = None, local_max_entries: Optional[int] = None):
+        kermartin_settings = settings.KERMARTIN_SETTINGS
+        self.local_ttl = (
+            local_ttl if local_ttl is not None
+            else kermartin_settings.get('BLOCKLIST_LOCAL_TTL_SEC', 5.0)
+        )
+        self.local = LocalLRUCache(
+            local_max_entries or kermartin_settings.get('BLOCKLIST_LOCAL_MAX_ENTRIES', 10000),
+            self.local_ttl
+        )
+        self.cache = get_instrumented_cache()
+        self._networks = PrefixTrie()
+        self._networks_loaded_at = None
+        self._refresh_lock = threading.Lock()
+
+    # Consulta
+
+    def is_blocked(self, ip: str) -> bool:
+        """True se o IP está bloqueado diretamente ou por uma faixa"""
+
+        if not ip:
+            return False
+
+        cached = self.local.get(ip, None)
+        if cached is not None:
+            return cached
+
+        try:
+            address = ipaddress.ip_address(ip.strip())
+        except ValueError:
+            return False
+
+        try:
+            blocked = self._networks_trie().contains(address) or self._is_address_blocked(str(address))
+        except Exception as e:
+            logger.error(f"Erro ao consultar IPs bloqueados: {e}")
+            return False
+
+        self.local.set(ip, blocked)
+        return blocked
+
+    def count(self) -> int:
+        """Endereços e faixas bloqueados no momento"""
+
+        now = time.time()
+        try:
+            client = get_redis_client(write=False)
+            if client is not None:
+                pipe = client.pipeline(transaction=False)
+                pipe.zcount(make_redis_key(self.IPS_KEY), now, '+inf')
+                pipe.zcount(make_redis_key(self.NETWORKS_KEY), now, '+inf')
+                return sum(pipe.execute())
+
+            index = self.cache.get(self.INDEX_KEY, {})
+            networks = self.cache.get(self.NETWORKS_KEY, {})
+            return sum(1 for expires_at in list(index.values()) + list(networks.values()) if expires_at > now)
+        except Exception as e:
+            logger.error(f"Erro ao contar IPs bloqueados: {e}")
+            return 0
+
+    # Alteração
+
+    def block(self, ip_or_network: str, duration: int = 3600) -> None:
+        """Bloqueia um IP ou faixa CIDR (ex.: 203.0.113.0/24) por `duration` segundos"""
+
+        network = ipaddress.ip_network(ip_or_network.strip(), strict=False)
+        now = time.time()
+        expires_at = now + duration
+
+        client = get_redis_client()
+        if network.num_addresses == 1:
+            member = str(network.network_address)
+            if client is not None:
+                key = make_redis_key(self.IPS_KEY)
+                pipe = client.pipeline(transaction=False)
+                pipe.zadd(key, {member: expires_at})
+                pipe.zremrangebyscore(key, '-inf', now)
+                pipe.execute()
+            else:
+                self.cache.set(f"{self.IP_KEY_PREFIX}{member}", 1, timeout=duration)
+                self._update_index(self.INDEX_KEY, member, expires_at)
+            self.local.set(member, True)
+        else:
+            member = str(network)
+            if client is not None:
+                key = make_redis_key(self.NETWORKS_KEY)
+                pipe = client.pipeline(transaction=False)
+                pipe.zadd(key, {member: expires_at})
+                pipe.zremrangebyscore(key, '-inf', now)
+                pipe.execute()
+            else:
+                self._update_index(self.NETWORKS_KEY, member, expires_at)
+            # Recarrega a trie e descarta resultados negativos em memória
+            self._networks_loaded_at = None
+            self.local.clear()
+
+    def unblock(self, ip_or_network: str) -> None:
+        """Remove um IP ou faixa da lista"""
+
+        network = ipaddress.ip_network(ip_or_network.strip(), strict=False)
+        single = network.num_addresses == 1
+        member = str(network.network_address) if single else str(network)
+
+        client = get_redis_client()
+        if client is not None:
+            client.zrem(make_redis_key(self.IPS_KEY if single else self.NETWORKS_KEY), member)
+        else:
+            if single:
+                self.cache.delete(f"{self.IP_KEY_PREFIX}{member}")
+            self._update_index(self.INDEX_KEY if single else self.NETWORKS_KEY, member, None)
+
+        self._networks_loaded_at = None
+        self.local.clear()
+
+    # Internos
+
+    def _is_address_blocked(self, ip: str) -> bool:
+        client = get_redis_client(write=False)
+        if client is not None:
+            expires_at = client.zscore(make_redis_key(self.IPS_KEY), ip)
+            return expires_at is not None and expires_at > time.time()
+        return self.cache.get(f"{self.IP_KEY_PREFIX}{ip}") is not None
+
+    def _networks_trie(self) -> PrefixTrie:
+        """Trie das faixas ativas, recarregada a cada local_ttl segundos"""
+
+        loaded_at = self._networks_loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < self.local_ttl:
+            return self._networks
+
+        # Só um thread recarrega; os demais seguem com a trie atual
+        if not self._refresh_lock.acquire(blocking=loaded_at is None):
+            return self._networks
+        try:
+            trie = PrefixTrie()
+            for network in self._load_networks():
+                trie.add(ipaddress.ip_network(network, strict=False))
+            self._networks = trie
+            self._networks_loaded_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+        return self._networks
+
+    def _load_networks(self):
+        now = time.time()
+        client = get_redis_client(write=False)
+        if client is not None:
+            members = client.zrangebyscore(make_redis_key(self.NETWORKS_KEY), now, '+inf')
+            return [m.decode() if isinstance(m, bytes) else m for m in members]
+        networks = self.cache.get(self.NETWORKS_KEY, {})
+        return [network for network, expires_at in networks.items() if expires_at > now]
+
+    def _update_index(self, key: str, member: str, expires_at: Optional[float]) -> None:
+        """Índice {membro: expiração} do fallback sem Redis (contagem e faixas)"""
+        now = time.time()
+        index: Dict[str, float] = {
+            m: exp for m, exp in self.cache.get(key, {}).items() if exp > now and m != member
+        }
+        if expires_at is not None:
+            index[member] = expires_at
+        timeout = max(int(max(index.values()) - now) + 1, 1) if index else 1
+        self.cache.set(key, index, timeout=timeout)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_ip_blocklist() -> IPBlocklist:
+    """Lista compartilhada do processo"""
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = IPBlocklist()
+    return _default
+
+
+@receiver(setting_changed)
+def _reset_ip_blocklist(setting, **kwargs):
+    """Descarta a instância (e o cache local) quando CACHES/KERMARTIN_SETTINGS mudam (testes)"""
+    global _default
+    if setting in ('CACHES', 'KERMARTIN_SETTINGS'):
+        _default = None
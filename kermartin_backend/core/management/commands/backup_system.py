@@ -100,8 +100,8 @@ class Command(BaseCommand):
         for filename, model in models_to_backup:
             self.stdout.write(f'  📋 Backup de {model._meta.verbose_name_plural}...')
             
-            # Serializar dados
-            data = serializers.serialize('json', model.objects.all(), indent=2)
+            # Serializar dados (_base_manager: sem o adiamento dos textos longos)
+            data = serializers.serialize('json', model._base_manager.all(), indent=2)
             
             # Salvar arquivo
             filepath = os.path.join(backup_dir, f'{filename}.json')
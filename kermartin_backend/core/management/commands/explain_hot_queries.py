@@ -0,0 +1,65 @@
+"""
+Comando Django: planos das consultas quentes do Kermartin 3.0
+Executa EXPLAIN nas consultas registradas em core.query_plans e aponta as
+que leem a tabela inteira (varredura sequencial)
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from core.query_plans import explain_all, hot_queries
+
+
+class Command(BaseCommand):
+    """Confere se as consultas quentes usam os índices esperados"""
+
+    help = 'Executa EXPLAIN nas consultas quentes registradas e aponta varreduras sequenciais'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--query',
+            action='append',
+            dest='queries',
+            help='Consulta registrada a verificar (pode repetir; padrão: todas)'
+        )
+        parser.add_argument(
+            '--plans',
+            action='store_true',
+            help='Mostra o SQL e o plano completo de cada consulta'
+        )
+        parser.add_argument(
+            '--fail-on-seqscan',
+            action='store_true',
+            help='Termina com erro se alguma consulta fizer varredura sequencial (CI)'
+        )
+
+    def handle(self, *args, **options):
+        registered = hot_queries()
+        unknown = set(options['queries'] or []) - set(registered)
+        if unknown:
+            raise CommandError(
+                f"Consultas não registradas: {', '.join(sorted(unknown))}. "
+                f"Disponíveis: {', '.join(sorted(registered))}"
+            )
+
+        self.stdout.write(f'🔎 EXPLAIN em {connection.vendor} ({connection.settings_dict["NAME"]})')
+        if connection.vendor == 'postgresql':
+            # Com poucas linhas o PostgreSQL prefere Seq Scan mesmo com índice
+            self.stdout.write('   Planos dependem das estatísticas: rode ANALYZE numa base com volume real')
+
+        plans = explain_all(options['queries'])
+        for plan in plans:
+            if plan.sequencial:
+                self.stdout.write(self.style.WARNING(
+                    f"  ⚠️  {plan.nome}: varredura sequencial em {', '.join(plan.varreduras)}"
+                ))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'  ✅ {plan.nome}'))
+            if options['plans']:
+                self.stdout.write(f'     SQL: {plan.sql}')
+                for line in plan.plano.splitlines():
+                    self.stdout.write(f'     {line}')
+
+        sequential = [plan.nome for plan in plans if plan.sequencial]
+        self.stdout.write(f'{len(plans) - len(sequential)}/{len(plans)} consultas usando índice')
+        if sequential and options['fail_on_seqscan']:
+            raise CommandError(f"Varredura sequencial em: {', '.join(sequential)}")
@@ -0,0 +1,59 @@
+"""
+Comando Django: agregados de métricas do Kermartin 3.0
+Recalcula MetricaRollup (totais e séries por hora/dia) uma vez ou em intervalo fixo
+"""
+
+import time
+import logging
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.rollups import refresh_rollups
+
+logger = logging.getLogger('kermartin')
+
+
+class Command(BaseCommand):
+    """Materializa as métricas lidas pelos dashboards"""
+
+    help = 'Recalcula os agregados de métricas (MetricaRollup) usados pelos dashboards'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            type=int,
+            default=settings.KERMARTIN_SETTINGS.get('METRICS_ROLLUP_HOURS', 48),
+            help='Horas recentes recalculadas na série por hora'
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=settings.KERMARTIN_SETTINGS.get('METRICS_ROLLUP_DAYS', 35),
+            help='Dias recentes recalculados na série por dia'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=0,
+            help='Repete a cada N segundos (0 = executa uma vez)'
+        )
+
+    def handle(self, *args, **options):
+        """Executa o recálculo"""
+
+        while True:
+            started = time.monotonic()
+            try:
+                result = refresh_rollups(options['hours'], options['days'])
+                self.stdout.write(self.style.SUCCESS(
+                    f"Agregados atualizados em {time.monotonic() - started:.2f}s: "
+                    f"{result['totais']} totais, {result['horas']} horas, {result['dias']} dias"
+                ))
+            except Exception as e:
+                logger.error(f"Erro ao atualizar agregados de métricas: {e}")
+                self.stdout.write(self.style.ERROR(f"Erro ao atualizar agregados: {e}"))
+                if not options['interval']:
+                    raise
+
+            if not options['interval']:
+                break
+            time.sleep(max(0.0, options['interval'] - (time.monotonic() - started)))
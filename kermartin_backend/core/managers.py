@@ -0,0 +1,52 @@
+"""
+Managers com Adiamento de Textos Longos do Kermartin 3.0
+Modelos que declaram LARGE_TEXT_FIELDS carregam essas colunas só quando
+pedido explicitamente com .with_text(); listagens, admin e verificações de
+existência não trazem os textos do banco
+"""
+
+from django.db import models
+from django.db.models import BooleanField, Case, Q, Value, When
+
+
+class DeferredTextQuerySet(models.QuerySet):
+    """QuerySet com carregamento explícito dos textos longos"""
+
+    def with_text(self, *fields):
+        """
+        Carrega os textos longos: todos, ou só os indicados em `fields`
+
+        Refaz o adiamento a partir do padrão do modelo, então descarta
+        defer() aplicados antes na mesma cadeia.
+        """
+        large_fields = self.model.LARGE_TEXT_FIELDS
+        unknown = set(fields) - set(large_fields)
+        if unknown:
+            raise ValueError(f"Campos sem adiamento em {self.model.__name__}: {', '.join(sorted(unknown))}")
+        queryset = self.defer(None)
+        if fields:
+            queryset = queryset.defer(*(field for field in large_fields if field not in fields))
+        return queryset
+
+
+class DocumentoQuerySet(DeferredTextQuerySet):
+
+    def processados(self):
+        """Documentos com texto extraído (índice parcial documento_processado_idx)"""
+        return self.exclude(texto_extraido='')
+
+    def with_text_flag(self):
+        """Anota `tem_texto` sem ler texto_extraido para o Python"""
+        return self.annotate(tem_texto=Case(
+            When(Q(texto_extraido__isnull=True) | Q(texto_extraido=''), then=Value(False)),
+            default=Value(True),
+            output_field=BooleanField(),
+        ))
+
+
+class DeferredTextManager(models.Manager):
+    """Manager padrão dos modelos com textos longos: adia LARGE_TEXT_FIELDS"""
+
+    def get_queryset(self):
+        return super().get_queryset().defer(*self.model.LARGE_TEXT_FIELDS)
+
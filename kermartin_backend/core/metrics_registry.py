@@ -0,0 +1,502 @@
+"""
+Registro de Métricas do Kermartin 3.0
+Contadores, gauges e histogramas de buckets fixos em memória do processo,
+somados entre os workers do gunicorn via diretório compartilhado e
+expostos no formato de texto do Prometheus
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger('kermartin')
+
+# Limites superiores (segundos); cobrem de requisições em cache a chamadas longas de LLM
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Tempo gasto pelo próprio middleware (fora da view): de dezenas de µs a poucos ms
+OVERHEAD_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025)
+
+Labels = Tuple[str, ...]
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str, labelnames: Sequence[str]):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, object] = {}
+
+    def _key(self, labels: Dict[str, object]) -> Labels:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _samples(self) -> List:
+        return [
+            [list(key), list(value) if isinstance(value, list) else value]
+            for key, value in self._values.items()
+        ]
+
+
+class Counter(_Metric):
+    """Valor que só cresce (somado entre processos)"""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self.registry._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+        self.registry._maybe_flush()
+
+
+class Gauge(_Metric):
+    """Valor instantâneo (somado entre os processos vivos)"""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.registry._lock:
+            self._values[key] = float(value)
+        self.registry._maybe_flush()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self.registry._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+        self.registry._maybe_flush()
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Distribuição em buckets fixos
+
+    Cada série guarda contagens não cumulativas por bucket (o último é +Inf)
+    seguidas da soma; observe() é um bisect e um incremento sob o lock.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.registry._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+        self.registry._maybe_flush()
+
+
+class MetricsRegistry:
+    """
+    Métricas do processo
+
+    Com `multiproc_dir` (METRICS_MULTIPROC_DIR), cada processo grava seus
+    valores em <dir>/<pid>.json a cada `flush_interval` segundos (e ao sair);
+    a exposição soma os arquivos de todos os processos. Contadores e
+    histogramas de workers já encerrados continuam somados, para que os totais
+    não regridam quando o gunicorn recicla um worker; gauges só contam
+    processos vivos. O diretório deve ser esvaziado ao iniciar o servidor.
+
+    Coletores registrados com register_collector() rodam só no momento da
+    exposição e servem para valores globais (banco, Redis).
+    """
+
+    def __init__(self, multiproc_dir: Optional[str] = None, flush_interval: Optional[float] = None):
+        kermartin_settings = settings.KERMARTIN_SETTINGS
+        self.multiproc_dir = (
+            multiproc_dir if multiproc_dir is not None
+            else kermartin_settings.get('METRICS_MULTIPROC_DIR', '')
+        )
+        self.flush_interval = (
+            flush_interval if flush_interval is not None
+            else kermartin_settings.get('METRICS_FLUSH_SEC', 5.0)
+        )
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple]]] = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        if self.multiproc_dir:
+            os.makedirs(self.multiproc_dir, exist_ok=True)
+
+    # Definição
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def register_collector(self, collector: Callable[[], Iterable[Tuple]]) -> None:
+        """Coletor: função que devolve (nome, ajuda, [(labels, valor)]) de gauges"""
+        self._collectors.append(collector)
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is not None:
+            return metric
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, documentation, labelnames, **kwargs)
+        return metric
+
+    # Persistência entre processos
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Valores locais do processo"""
+        with self._lock:
+            return {
+                name: {
+                    'kind': metric.kind,
+                    'help': metric.documentation,
+                    'labelnames': list(metric.labelnames),
+                    'buckets': list(getattr(metric, 'buckets', ())),
+                    'samples': metric._samples(),
+                }
+                for name, metric in self._metrics.items()
+            }
+
+    def flush(self) -> None:
+        """Grava os valores do processo em <dir>/<pid>.json (troca atômica)"""
+        self._last_flush = time.monotonic()
+        if not self.multiproc_dir:
+            return
+        path = os.path.join(self.multiproc_dir, f"{os.getpid()}.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Erro ao gravar métricas do processo: {e}")
+
+    def _maybe_flush(self) -> None:
+        if self.multiproc_dir and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def collect(self) -> Dict[str, Dict]:
+        """Valores de todos os processos somados (ou só os locais, sem diretório)"""
+
+        if not self.multiproc_dir:
+            return self.snapshot()
+
+        self.flush()
+        merged: Dict[str, Dict] = {}
+        for filename in os.listdir(self.multiproc_dir):
+            if not filename.endswith('.json'):
+                continue
+            pid = int(filename[:-5]) if filename[:-5].isdigit() else None
+            try:
+                with open(os.path.join(self.multiproc_dir, filename), encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Arquivo de métricas ignorado ({filename}): {e}")
+                continue
+            alive = pid is not None and _pid_alive(pid)
+            for name, metric in data.items():
+                if metric['kind'] == 'gauge' and not alive:
+                    continue
+                target = merged.setdefault(name, {**metric, 'samples': []})
+                target['samples'].extend(metric['samples'])
+
+        for metric in merged.values():
+            metric['samples'] = _sum_samples(metric['samples'])
+        return merged
+
+    # Exposição
+
+    def render(self) -> str:
+        """Formato de texto do Prometheus (versão 0.0.4)"""
+
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {_escape_help(metric['help'])}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            labelnames = metric['labelnames']
+            for values, value in metric['samples']:
+                labels = list(zip(labelnames, values))
+                if metric['kind'] == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric['buckets'] + ['+Inf'], value[:-1]):
+                        cumulative += count
+                        le = bound if bound == '+Inf' else _format_value(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labels + [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-1])}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for collector in self._collectors:
+            try:
+                for name, documentation, samples in collector():
+                    lines.append(f"# HELP {name} {_escape_help(documentation)}")
+                    lines.append(f"# TYPE {name} gauge")
+                    for labels, value in samples:
+                        lines.append(f"{name}{_format_labels(list(labels.items()))} {_format_value(value)}")
+            except Exception as e:
+                logger.error(f"Erro no coletor de métricas {getattr(collector, '__name__', collector)}: {e}")
+
+        return '\n'.join(lines) + '\n'
+
+    def quantiles(
+        self,
+        name: str,
+        by: Sequence[str],
+        quantiles: Sequence[float] = (0.5, 0.95, 0.99)
+    ) -> Dict[str, Dict]:
+        """
+        Quantis estimados de um histograma, agrupados pelos labels `by`
+
+        Interpolação linear dentro do bucket, como histogram_quantile() do
+        Prometheus; a precisão é a da largura dos buckets.
+        """
+
+        metric = self.collect().get(name)
+        if metric is None:
+            return {}
+
+        indexes = [metric['labelnames'].index(label) for label in by]
+        groups: Dict[str, List] = {}
+        for values, state in metric['samples']:
+            group = ' '.join(values[i] for i in indexes)
+            if group in groups:
+                groups[group] = [a + b for a, b in zip(groups[group], state)]
+            else:
+                groups[group] = list(state)
+
+        buckets = metric['buckets']
+        result = {}
+        for group, state in groups.items():
+            counts, total_sum = state[:-1], state[-1]
+            total = sum(counts)
+            summary = {'count': total, 'avg': total_sum / total if total else 0.0}
+            for q in quantiles:
+                summary[f"p{int(q * 100)}"] = _bucket_quantile(q, buckets, counts)
+            result[group] = summary
+        return result
+
+    def reset(self) -> None:
+        with self._lock:
+            for metric in self._metrics.values():
+                metric._values.clear()
+
+
+# Auxiliares
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _sum_samples(samples: List) -> List:
+    totals = {}
+    for values, value in samples:
+        key = tuple(values)
+        if key not in totals:
+            totals[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+            totals[key] = [a + b for a, b in zip(totals[key], value)]
+        else:
+            totals[key] += value
+    return [[list(key), value] for key, value in totals.items()]
+
+
+def _bucket_quantile(q: float, buckets: Sequence[float], counts: Sequence[int]) -> float:
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    cumulative = 0
+    for i, count in enumerate(counts):
+        if cumulative + count >= rank and count:
+            if i >= len(buckets):
+                # Acima do último limite: o melhor que se sabe é o último limite
+                return buckets[-1]
+            lower = buckets[i - 1] if i > 0 else 0.0
+            return lower + (buckets[i] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return buckets[-1]
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return f"{value:.1f}"
+    return repr(value)
+
+
+def _escape_help(text: str) -> str:
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _format_labels(labels: List[Tuple[str, object]]) -> str:
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+# Registro do processo e métricas da aplicação
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    """Registro compartilhado do processo"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = MetricsRegistry()
+                _define_metrics(_registry)
+                atexit.register(_registry.flush)
+    return _registry
+
+
+def _define_metrics(registry: MetricsRegistry) -> None:
+    registry.counter(
+        'kermartin_http_requests_total', 'Requisições HTTP por rota, método e status',
+        ('method', 'route', 'status')
+    )
+    registry.histogram(
+        'kermartin_http_request_duration_seconds', 'Latência das requisições HTTP por rota',
+        ('method', 'route')
+    )
+    registry.histogram(
+        'kermartin_http_middleware_overhead_seconds', 'Tempo do KermartinMiddleware por requisição, sem a view',
+        buckets=OVERHEAD_BUCKETS
+    )
+    registry.counter(
+        'kermartin_http_slow_requests_total', 'Requisições acima de SLOW_REQUEST_SEC por rota',
+        ('route',)
+    )
+    registry.counter(
+        'kermartin_llm_requests_total', 'Chamadas ao modelo de linguagem por modelo e resultado',
+        ('model', 'status')
+    )
+    registry.histogram(
+        'kermartin_llm_request_duration_seconds', 'Latência das chamadas ao modelo de linguagem',
+        ('model',)
+    )
+    registry.counter(
+        'kermartin_llm_tokens_total', 'Tokens consumidos por modelo e tipo (prompt/resposta)',
+        ('model', 'kind')
+    )
+    registry.counter(
+        'kermartin_retrieval_requests_total', 'Consultas de jurisprudência por provedor e resultado',
+        ('provider', 'operation', 'status')
+    )
+    registry.histogram(
+        'kermartin_retrieval_duration_seconds', 'Latência das consultas de jurisprudência por provedor',
+        ('provider', 'operation')
+    )
+    registry.histogram(
+        'kermartin_stage_duration_seconds', 'Duração por etapa do pipeline (spans de core.tracing)',
+        ('stage',)
+    )
+    registry.register_collector(_collect_global_values)
+
+
+def _collect_global_values():
+    """Valores do banco/Redis, lidos dos agregados (MetricaRollup) na exposição"""
+    from .rollups import get_global_totals
+    from .ip_blocklist import get_ip_blocklist
+
+    totais = get_global_totals()
+    return [
+        ('kermartin_entities', 'Totais de registros por tipo (agregados)', [
+            ({'tipo': tipo}, getattr(totais, tipo))
+            for tipo in ('usuarios', 'processos', 'documentos', 'sessoes', 'resultados')
+        ]),
+        ('kermartin_active_users_30d', 'Usuários com atividade nos últimos 30 dias', [
+            ({}, totais.distribuicoes.get('usuarios_ativos_30d', 0)),
+        ]),
+        ('kermartin_blocked_ips', 'IPs e faixas bloqueados', [
+            ({}, get_ip_blocklist().count()),
+        ]),
+    ]
+
+
+def observe_request(method: str, route: str, status: int, duration: float, overhead: Optional[float] = None) -> None:
+    registry = get_metrics_registry()
+    registry.counter('kermartin_http_requests_total', '').inc(method=method, route=route, status=status)
+    registry.histogram('kermartin_http_request_duration_seconds', '').observe(duration, method=method, route=route)
+    if overhead is not None:
+        registry.histogram('kermartin_http_middleware_overhead_seconds', '').observe(overhead)
+
+
+def observe_slow_request(route: str) -> None:
+    get_metrics_registry().counter('kermartin_http_slow_requests_total', '').inc(route=route)
+
+
+def observe_llm_call(
+    model: str,
+    duration: float,
+    status: str = 'ok',
+    tokens_prompt: int = 0,
+    tokens_response: int = 0
+) -> None:
+    registry = get_metrics_registry()
+    registry.counter('kermartin_llm_requests_total', '').inc(model=model, status=status)
+    registry.histogram('kermartin_llm_request_duration_seconds', '').observe(duration, model=model)
+    if tokens_prompt:
+        registry.counter('kermartin_llm_tokens_total', '').inc(tokens_prompt, model=model, kind='prompt')
+    if tokens_response:
+        registry.counter('kermartin_llm_tokens_total', '').inc(tokens_response, model=model, kind='resposta')
+
+
+def observe_retrieval(provider: str, operation: str, duration: float, status: str = 'ok') -> None:
+    registry = get_metrics_registry()
+    registry.counter('kermartin_retrieval_requests_total', '').inc(
+        provider=provider, operation=operation, status=status
+    )
+    registry.histogram('kermartin_retrieval_duration_seconds', '').observe(
+        duration, provider=provider, operation=operation
+    )
+
+
+@receiver(setting_changed)
+def _reset_metrics_registry(setting, **kwargs):
+    """Descarta o registro quando KERMARTIN_SETTINGS muda (testes)"""
+    global _registry
+    if setting == 'KERMARTIN_SETTINGS':
+        _registry = None
@@ -2,30 +2,126 @@
 Middleware personalizado para Kermartin 3.0
 """
 
+import re
 import time
 import logging
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.utils.deprecation import MiddlewareMixin
+from django.conf import settings
 from django.http import JsonResponse
-from django.core.cache import cache
-from .models import LogSeguranca
+from .buffered_writer import get_security_event_writer
+from .ip_blocklist import get_ip_blocklist
+from .ratelimit import get_rate_limiter
+from .metrics_registry import observe_request, observe_slow_request
+from .metrics import record_slow_request
+from .tracing import start_trace, end_trace, open_span, close_span, current_trace_id
+from .profiling import get_profiler
+
+TRACEPARENT_RE = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-[0-9a-f]{16}-[0-9a-f]{2}$')
+TRACE_ID_RE = re.compile(r'^[0-9A-Za-z-]{8,64}$')
+
+# Padrões de varredura por caminho e User-Agent, compilados uma vez
+SUSPICIOUS_PATH_RE = re.compile(
+    r'admin|wp-admin|phpmyadmin|\.env|config|backup|sql|database|shell|cmd', re.IGNORECASE
+)
+SUSPICIOUS_AGENT_RE = re.compile(r'bot|crawler|scanner|hack', re.IGNORECASE)
+
+# Cabeçalhos fixos de todas as respostas (exceto o caminho rápido)
+RESPONSE_HEADERS = (
+    ('X-Content-Type-Options', 'nosniff'),
+    ('X-Frame-Options', 'DENY'),
+    ('X-XSS-Protection', '1; mode=block'),
+    ('Referrer-Policy', 'strict-origin-when-cross-origin'),
+    ('X-Kermartin-Version', '3.0'),
+    ('X-Powered-By', 'Kermartin AI Legal Analysis'),
+)
 
 logger = logging.getLogger('kermartin')
 
 
-class SecurityMiddleware(MiddlewareMixin):
-    """Middleware de segurança para monitoramento e proteção"""
+class KermartinMiddleware:
+    """
+    Segurança e observabilidade por requisição, numa só passagem
+
+    IP do cliente e lista de bloqueio, detecção de acesso suspeito (regex
+    pré-compiladas), trace da requisição, métricas por rota, log de
+    requisições lentas e cabeçalhos de resposta. Um único perf_counter mede
+    a requisição. Arquivos estáticos e rotas de health check seguem direto
+    para a view, sem nenhum desses passos.
+    """
+    
+    sync_capable = True
+    async_capable = True
     
     def __init__(self, get_response):
         self.get_response = get_response
-        super().__init__(get_response)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.skip_prefixes = self._skip_prefixes()
+    
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if request.path.startswith(self.skip_prefixes):
+            return self.get_response(request)
+        
+        started = time.perf_counter()
+        response = self.process_request(request)
+        if response is not None:
+            return self.process_response(request, response, started, started)
+        view_started = time.perf_counter()
+        response = self.get_response(request)
+        return self.process_response(request, response, started, view_started)
+    
+    async def __acall__(self, request):
+        if request.path.startswith(self.skip_prefixes):
+            return await self.get_response(request)
+        
+        started = time.perf_counter()
+        response = await self.aprocess_request(request)
+        if response is not None:
+            return await self.aprocess_response(request, response, started, started)
+        view_started = time.perf_counter()
+        response = await self.get_response(request)
+        return await self.aprocess_response(request, response, started, view_started)
+    
+    def _skip_prefixes(self) -> tuple:
+        """Prefixos do caminho rápido: STATIC_URL, MEDIA_URL e MIDDLEWARE_SKIP_PREFIXES"""
+        prefixes = list(settings.KERMARTIN_SETTINGS.get('MIDDLEWARE_SKIP_PREFIXES', []))
+        for url in (settings.STATIC_URL, settings.MEDIA_URL):
+            if url and url.startswith('/') and url != '/':
+                prefixes.append(url)
+        return tuple(prefixes)
+    
+    # Entrada
     
     def process_request(self, request):
-        """Processa requisição antes da view"""
+        """IP, bloqueio, atividade suspeita e início do trace; uma resposta encerra a requisição"""
         
-        # Adicionar timestamp para medir tempo de resposta
-        request.start_time = time.time()
+        ip = self._client_ip(request)
         
-        # Obter IP real do cliente
+        # Verificar se IP está bloqueado (consulta O(1), resultado recente em memória)
+        if get_ip_blocklist().is_blocked(ip):
+            return self._denied(ip)
+        
+        self._begin(request)
+        return None
+    
+    async def aprocess_request(self, request):
+        """process_request do caminho ASGI: a consulta ao Redis / recarga das faixas roda fora do event loop"""
+        
+        ip = self._client_ip(request)
+        
+        if await sync_to_async(get_ip_blocklist().is_blocked, thread_sensitive=False)(ip):
+            return self._denied(ip)
+        
+        # Trace aberto no contexto da requisição (ContextVar visto pela view)
+        self._begin(request)
+        return None
+    
+    def _client_ip(self, request) -> str:
+        """IP real do cliente (primeiro do X-Forwarded-For), guardado em request.client_ip"""
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
         if x_forwarded_for:
             ip = x_forwarded_for.split(',')[0]
@@ -33,87 +129,158 @@ class SecurityMiddleware(MiddlewareMixin):
             ip = request.META.get('REMOTE_ADDR')
         
         request.client_ip = ip
-        
-        # Verificar se IP está bloqueado
-        blocked_ips = cache.get('blocked_ips', set())
-        if ip in blocked_ips:
-            logger.warning(f"Acesso negado para IP bloqueado: {ip}")
-            return JsonResponse(
-                {'error': 'Acesso negado'}, 
-                status=403
-            )
+        return ip
+    
+    def _denied(self, ip):
+        logger.warning(f"Acesso negado para IP bloqueado: {ip}")
+        return JsonResponse(
+            {'error': 'Acesso negado'}, 
+            status=403
+        )
+    
+    def _begin(self, request):
+        """Atividade suspeita (só enfileira), trace e perfil da requisição"""
         
         # Monitorar tentativas de acesso suspeitas
         self._monitor_suspicious_activity(request)
         
-        return None
+        request.trace_token = start_trace(self._incoming_trace_id(request))
+        request.trace_span = open_span('http.request', **{'http.method': request.method})
+        
+        # Perfil por amostragem (PROFILING_ENABLED); guardado só se a requisição ficar lenta
+        request.profile = get_profiler().start('request', f"{request.method} {request.path}")
     
-    def process_response(self, request, response):
-        """Processa resposta após a view"""
+    def _monitor_suspicious_activity(self, request):
+        """Monitora atividades suspeitas (uma busca por regex no caminho e outra no User-Agent)"""
         
-        # Calcular tempo de resposta
-        if hasattr(request, 'start_time'):
-            response_time = time.time() - request.start_time
-            response['X-Response-Time'] = f"{response_time:.3f}s"
+        if SUSPICIOUS_PATH_RE.search(request.path):
+            self._log_security_event(
+                request,
+                'acesso_suspeito',
+                f"Tentativa de acesso a: {request.path}"
+            )
         
-        # Log de requisições importantes
-        if request.path.startswith('/api/'):
-            self._log_api_request(request, response)
+        user_agent = request.META.get('HTTP_USER_AGENT', '')
+        if user_agent and SUSPICIOUS_AGENT_RE.search(user_agent):
+            self._log_security_event(
+                request,
+                'user_agent_suspeito',
+                f"User-Agent suspeito: {user_agent.lower()[:100]}"
+            )
+    
+    def _incoming_trace_id(self, request):
+        """trace_id do chamador: W3C traceparent ou X-Trace-Id"""
+        traceparent = request.META.get('HTTP_TRACEPARENT', '')
+        match = TRACEPARENT_RE.match(traceparent)
+        if match:
+            return match.group(1)
+        trace_id = request.META.get('HTTP_X_TRACE_ID', '')
+        return trace_id if TRACE_ID_RE.match(trace_id) else None
+    
+    # Saída
+    
+    def process_response(self, request, response, started: float, view_started: float):
+        """Fecha o trace, registra métricas e logs e adiciona os cabeçalhos"""
         
+        route, duration, overhead = self._close(request, response, started, view_started)
+        profile_id = self._account(request, route, response.status_code, duration, overhead, response.get('X-Trace-Id'))
+        if profile_id:
+            response['X-Profile-Id'] = profile_id
         return response
     
-    def _monitor_suspicious_activity(self, request):
-        """Monitora atividades suspeitas"""
-        
-        suspicious_patterns = [
-            'admin', 'wp-admin', 'phpmyadmin', '.env', 'config',
-            'backup', 'sql', 'database', 'shell', 'cmd'
-        ]
-        
-        path = request.path.lower()
-        user_agent = request.META.get('HTTP_USER_AGENT', '').lower()
-        
-        # Verificar padrões suspeitos na URL
-        for pattern in suspicious_patterns:
-            if pattern in path:
-                self._log_security_event(
-                    request,
-                    'acesso_suspeito',
-                    f"Tentativa de acesso a: {request.path}"
-                )
-                break
+    async def aprocess_response(self, request, response, started: float, view_started: float):
+        """process_response do caminho ASGI: perfil, métricas e contadores gravados fora do event loop"""
         
-        # Verificar User-Agent suspeito
-        suspicious_agents = ['bot', 'crawler', 'scanner', 'hack']
-        for agent in suspicious_agents:
-            if agent in user_agent:
-                self._log_security_event(
-                    request,
-                    'user_agent_suspeito',
-                    f"User-Agent suspeito: {user_agent[:100]}"
-                )
-                break
+        # Trace fechado no contexto da requisição (tokens das ContextVars)
+        route, duration, overhead = self._close(request, response, started, view_started)
+        profile_id = await sync_to_async(self._account, thread_sensitive=False)(
+            request, route, response.status_code, duration, overhead, response.get('X-Trace-Id')
+        )
+        if profile_id:
+            response['X-Profile-Id'] = profile_id
+        return response
     
-    def _log_api_request(self, request, response):
-        """Log de requisições da API"""
+    def _close(self, request, response, started: float, view_started: float):
+        """Fecha o trace e adiciona os cabeçalhos; devolve rota, duração e custo do middleware"""
+        
+        view_finished = time.perf_counter()
+        route = self._route(request)
+        trace_id = self._end_trace(request, route, response.status_code)
+        if trace_id:
+            response['X-Trace-Id'] = trace_id
+        
+        for header, value in RESPONSE_HEADERS:
+            response[header] = value
+        
+        duration = time.perf_counter() - started
+        response['X-Response-Time'] = f"{duration:.3f}s"
+        return route, duration, duration - (view_finished - view_started)
+    
+    def _account(self, request, route: str, status_code: int, duration: float, overhead: float, trace_id):
+        """Perfil, métricas, contador de lentas e logs (disco, arquivos de métricas e Redis)"""
+        
+        slow_request_sec = settings.KERMARTIN_SETTINGS.get('SLOW_REQUEST_SEC', 2.0)
+        
+        profile_id = get_profiler().stop(
+            getattr(request, 'profile', None), slow_request_sec,
+            rota=route, status=status_code, trace_id=trace_id
+        )
         
-        if hasattr(request, 'start_time'):
-            response_time = time.time() - request.start_time
+        try:
+            observe_request(request.method, route, status_code, duration, overhead=overhead)
             
-            # Log apenas requisições lentas ou com erro
-            if response_time > 5.0 or response.status_code >= 400:
-                logger.info(
-                    f"API Request: {request.method} {request.path} "
-                    f"- Status: {response.status_code} "
-                    f"- Time: {response_time:.3f}s "
-                    f"- IP: {request.client_ip}"
+            # Log de requisições lentas
+            if duration > slow_request_sec:
+                observe_slow_request(route)
+                record_slow_request()
+                logger.warning(
+                    f"Slow request: {request.method} {request.path} "
+                    f"took {duration:.3f}s" + (f" (perfil {profile_id})" if profile_id else "")
                 )
+        except Exception as e:
+            logger.error(f"Erro ao registrar métricas da requisição: {e}")
+        
+        # Log de requisições da API com erro ou muito lentas
+        if (status_code >= 400 or duration > 5.0) and request.path.startswith('/api/'):
+            logger.info(
+                f"API Request: {request.method} {request.path} "
+                f"- Status: {status_code} "
+                f"- Time: {duration:.3f}s "
+                f"- IP: {getattr(request, 'client_ip', None)}"
+            )
+        
+        return profile_id
+    
+    def _end_trace(self, request, route: str, status_code: int):
+        """Fecha o span raiz e o trace; devolve o trace_id"""
+        span, token = getattr(request, 'trace_span', (None, None))
+        if span is None:
+            return None
+        trace_id = current_trace_id()
+        try:
+            span.set_attribute('http.route', route)
+            span.set_attribute('http.status_code', status_code)
+            close_span(span, token)
+            end_trace(request.trace_token)
+        except ValueError:
+            # Resposta produzida em outro contexto (ex.: thread do adaptador ASGI)
+            pass
+        request.trace_span = (None, None)
+        return trace_id
+    
+    def _route(self, request) -> str:
+        """Nome da rota (cardinalidade fixa): view_name, padrão da URL ou 'unmatched'"""
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unmatched'
+        return match.view_name or match.route or 'unmatched'
     
     def _log_security_event(self, request, event_type, description):
         """Registra evento de segurança"""
         
+        # Só enfileira: a gravação em lote acontece fora da requisição
         try:
-            LogSeguranca.objects.create(
+            get_security_event_writer().submit(
                 tipo_evento=event_type,
                 descricao=description,
                 ip_address=request.client_ip,
@@ -129,7 +296,14 @@ class SecurityMiddleware(MiddlewareMixin):
 
 
 class RateLimitMiddleware(MiddlewareMixin):
-    """Middleware para rate limiting"""
+    """Middleware para rate limiting (janela deslizante atômica, ver core.ratelimit)"""
+    
+    # Limites por prefixo de rota
+    LIMITS = {
+        '/api/analises/': {'limit': 10, 'window': 3600},  # 10 análises por hora
+        '/api/documentos/': {'limit': 20, 'window': 3600},  # 20 uploads por hora
+        '/api/auth/login/': {'limit': 5, 'window': 3600},  # 5 logins por hora
+    }
     
     def __init__(self, get_response):
         self.get_response = get_response
@@ -142,93 +316,44 @@ class RateLimitMiddleware(MiddlewareMixin):
         if not request.path.startswith('/api/'):
             return None
         
-        # Obter identificador do cliente
-        if request.user.is_authenticated:
-            client_id = f"user_{request.user.id}"
+        # Obter identificador do cliente (o usuário só existe se a autenticação já rodou)
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            client_id = f"user_{user.id}"
         else:
-            client_id = f"ip_{request.client_ip}"
-        
-        # Verificar diferentes tipos de rate limit
-        limits = {
-            '/api/analises/': {'limit': 10, 'window': 3600},  # 10 análises por hora
-            '/api/documentos/': {'limit': 20, 'window': 3600},  # 20 uploads por hora
-            '/api/auth/login/': {'limit': 5, 'window': 3600},  # 5 logins por hora
-        }
+            client_id = f"ip_{getattr(request, 'client_ip', None) or request.META.get('REMOTE_ADDR')}"
         
-        for path_prefix, config in limits.items():
+        for path_prefix, config in self.LIMITS.items():
             if request.path.startswith(path_prefix):
-                if self._is_rate_limited(client_id, path_prefix, config):
+                result = self._check(client_id, path_prefix, config)
+                request.rate_limit = result
+                if not result.allowed:
                     logger.warning(f"Rate limit excedido: {client_id} - {path_prefix}")
-                    return JsonResponse(
+                    response = JsonResponse(
                         {'error': 'Rate limit excedido. Tente novamente mais tarde.'},
                         status=429
                     )
+                    return self._add_headers(response, result)
+                break
         
         return None
     
-    def _is_rate_limited(self, client_id, path, config):
-        """Verifica se cliente excedeu rate limit"""
-        
-        cache_key = f"rate_limit_{client_id}_{path.replace('/', '_')}"
-        current_count = cache.get(cache_key, 0)
-        
-        if current_count >= config['limit']:
-            return True
-        
-        # Incrementar contador
-        cache.set(cache_key, current_count + 1, timeout=config['window'])
-        return False
-
-
-class PerformanceMiddleware(MiddlewareMixin):
-    """Middleware para monitoramento de performance"""
-    
-    def __init__(self, get_response):
-        self.get_response = get_response
-        super().__init__(get_response)
-    
-    def process_request(self, request):
-        """Inicia monitoramento de performance"""
-        request.perf_start = time.time()
-        return None
-    
     def process_response(self, request, response):
-        """Finaliza monitoramento de performance"""
-        
-        if hasattr(request, 'perf_start'):
-            duration = time.time() - request.perf_start
-            
-            # Log de requisições lentas
-            if duration > 2.0:  # Mais de 2 segundos
-                logger.warning(
-                    f"Slow request: {request.method} {request.path} "
-                    f"took {duration:.3f}s"
-                )
-            
-            # Adicionar header de performance
-            response['X-Performance-Time'] = f"{duration:.3f}s"
+        """Informa o consumo do limite ao cliente"""
         
+        result = getattr(request, 'rate_limit', None)
+        if result is not None and 'X-RateLimit-Limit' not in response:
+            self._add_headers(response, result)
         return response
-
-
-class CORSMiddleware(MiddlewareMixin):
-    """Middleware personalizado para CORS"""
     
-    def __init__(self, get_response):
-        self.get_response = get_response
-        super().__init__(get_response)
-    
-    def process_response(self, request, response):
-        """Adiciona headers CORS personalizados"""
-        
-        # Headers de segurança
-        response['X-Content-Type-Options'] = 'nosniff'
-        response['X-Frame-Options'] = 'DENY'
-        response['X-XSS-Protection'] = '1; mode=block'
-        response['Referrer-Policy'] = 'strict-origin-when-cross-origin'
-        
-        # Headers específicos do Kermartin
-        response['X-Kermartin-Version'] = '3.0'
-        response['X-Powered-By'] = 'Kermartin AI Legal Analysis'
+    def _check(self, client_id, path, config):
+        """Registra a requisição e retorna o estado do limite"""
         
+        return get_rate_limiter().hit(
+            f"{client_id}_{path.replace('/', '_')}", config['limit'], config['window']
+        )
+    
+    def _add_headers(self, response, result):
+        for header, value in result.headers().items():
+            response[header] = value
         return response
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:19
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricaRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('periodo', models.CharField(choices=[('hora', 'Hora'), ('dia', 'Dia'), ('total', 'Total')], max_length=10)),
+                ('escopo', models.CharField(default='global', max_length=20)),
+                ('inicio', models.DateTimeField()),
+                ('usuarios', models.PositiveIntegerField(default=0)),
+                ('processos', models.PositiveIntegerField(default=0)),
+                ('documentos', models.PositiveIntegerField(default=0)),
+                ('documentos_com_texto', models.PositiveIntegerField(default=0)),
+                ('documentos_bytes', models.BigIntegerField(default=0)),
+                ('sessoes', models.PositiveIntegerField(default=0)),
+                ('sessoes_concluidas', models.PositiveIntegerField(default=0)),
+                ('sessoes_com_tempo', models.PositiveIntegerField(default=0)),
+                ('sessoes_tempo_seg', models.FloatField(default=0.0)),
+                ('resultados', models.PositiveIntegerField(default=0)),
+                ('tokens_total', models.BigIntegerField(default=0)),
+                ('tempo_processamento_seg', models.FloatField(default=0.0)),
+                ('eventos_seguranca', models.PositiveIntegerField(default=0)),
+                ('eventos_erro', models.PositiveIntegerField(default=0)),
+                ('distribuicoes', models.JSONField(default=dict)),
+                ('ultima_atividade', models.DateTimeField(blank=True, null=True)),
+                ('atualizado_em', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Métrica Agregada',
+                'verbose_name_plural': 'Métricas Agregadas',
+                'db_table': 'metricas_rollup',
+                'ordering': ['periodo', 'escopo', '-inicio'],
+                'unique_together': {('periodo', 'escopo', 'inicio')},
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_metricarollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usuario',
+            name='limite_custo_mensal',
+            field=models.DecimalField(blank=True, decimal_places=2, help_text='USD', max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='usuario',
+            name='limite_tokens_mensal',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ConsumoTokens',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operacao', models.CharField(choices=[('chat', 'Chat'), ('embedding', 'Embedding')], default='chat', max_length=20)),
+                ('modelo', models.CharField(max_length=50)),
+                ('tokens_prompt', models.PositiveIntegerField(default=0)),
+                ('tokens_cache', models.PositiveIntegerField(default=0)),
+                ('tokens_resposta', models.PositiveIntegerField(default=0)),
+                ('latencia', models.FloatField(default=0.0)),
+                ('custo', models.DecimalField(decimal_places=6, default=0, max_digits=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('processo', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='consumo_tokens', to='core.processo')),
+                ('sessao', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='consumo_tokens', to='core.sessaoanalise')),
+                ('usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='consumo_tokens', to='core.usuario')),
+            ],
+            options={
+                'verbose_name': 'Consumo de Tokens',
+                'verbose_name_plural': 'Consumo de Tokens',
+                'db_table': 'consumo_tokens',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['usuario', 'created_at'], name='consumo_usuario_data_idx'), models.Index(fields=['processo', 'created_at'], name='consumo_processo_data_idx')],
+            },
+        ),
+    ]
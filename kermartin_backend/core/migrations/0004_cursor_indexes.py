@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_consumotokens'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='logseguranca',
+            index=models.Index(fields=['-created_at', '-id'], name='log_seguranca_cursor_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='processo',
+            index=models.Index(fields=['usuario', '-created_at', '-id'], name='processo_usuario_cursor_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='resultadoanalise',
+            index=models.Index(fields=['sessao', 'created_at', 'id'], name='resultado_sessao_cursor_idx'),
+        ),
+    ]
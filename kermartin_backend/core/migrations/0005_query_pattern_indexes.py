@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_cursor_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='documento',
+            index=models.Index(condition=models.Q(('texto_extraido', ''), _negated=True), fields=['processo', 'created_at'], name='documento_processado_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='logseguranca',
+            index=models.Index(fields=['tipo_evento', 'created_at'], name='log_seguranca_tipo_data_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='logseguranca',
+            index=models.Index(fields=['ip_address', 'created_at'], name='log_seguranca_ip_data_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sessaoanalise',
+            index=models.Index(fields=['status', 'created_at'], name='sessao_status_data_idx'),
+        ),
+    ]
@@ -5,9 +5,11 @@ Sistema de análise jurídica especializado em Tribunal do Júri
 
 import uuid
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
 from django.core.validators import FileExtensionValidator
 from django.utils import timezone
+from .managers import DeferredTextManager, DeferredTextQuerySet, DocumentoQuerySet
 
 
 class Usuario(models.Model):
@@ -21,6 +23,12 @@ class Usuario(models.Model):
     escritorio = models.CharField(max_length=200, blank=True)
     especialidades = models.TextField(blank=True, help_text="Especialidades jurídicas")
     
+    # Orçamento mensal (ver core.token_ledger); vazio usa o padrão do sistema, 0 = sem limite
+    limite_tokens_mensal = models.PositiveBigIntegerField(null=True, blank=True)
+    limite_custo_mensal = models.DecimalField(
+        max_digits=10, decimal_places=2, null=True, blank=True, help_text="USD"
+    )
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -76,6 +84,10 @@ class Processo(models.Model):
         verbose_name = 'Processo'
         verbose_name_plural = 'Processos'
         ordering = ['-created_at']
+        indexes = [
+            # Listagem por cursor do usuário (core.pagination)
+            models.Index(fields=['usuario', '-created_at', '-id'], name='processo_usuario_cursor_idx'),
+        ]
     
     def __str__(self):
         return f"{self.titulo} - {self.numero_processo}"
@@ -111,11 +123,23 @@ class Documento(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    # Texto só é lido com .with_text() (análise, detalhe, admin de edição)
+    LARGE_TEXT_FIELDS = ('texto_extraido',)
+    objects = DeferredTextManager.from_queryset(DocumentoQuerySet)()
+    
     class Meta:
         db_table = 'documentos'
         verbose_name = 'Documento'
         verbose_name_plural = 'Documentos'
         ordering = ['-created_at']
+        indexes = [
+            # Documentos processados do processo (DocumentoQuerySet.processados)
+            models.Index(
+                fields=['processo', 'created_at'],
+                condition=~Q(texto_extraido=''),
+                name='documento_processado_idx',
+            ),
+        ]
     
     def __str__(self):
         return f"{self.nome_arquivo} - {self.get_tipo_documento_display()}"
@@ -162,6 +186,10 @@ class SessaoAnalise(models.Model):
         verbose_name = 'Sessão de Análise'
         verbose_name_plural = 'Sessões de Análise'
         ordering = ['-created_at']
+        indexes = [
+            # Fila do run_analysis_worker e contagens por status
+            models.Index(fields=['status', 'created_at'], name='sessao_status_data_idx'),
+        ]
     
     def __str__(self):
         return f"Análise {self.get_modo_analise_display()} - {self.processo.titulo}"
@@ -197,12 +225,18 @@ class ResultadoAnalise(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    LARGE_TEXT_FIELDS = ('prompt_usado', 'resposta_ia')
+    objects = DeferredTextManager.from_queryset(DeferredTextQuerySet)()
+    
     class Meta:
         db_table = 'resultados_analise'
         verbose_name = 'Resultado de Análise'
         verbose_name_plural = 'Resultados de Análise'
         ordering = ['bloco', 'subetapa', '-created_at']
         unique_together = ['sessao', 'documento', 'bloco', 'subetapa']
+        indexes = [
+            models.Index(fields=['sessao', 'created_at', 'id'], name='resultado_sessao_cursor_idx'),
+        ]
     
     def __str__(self):
         return f"Bloco {self.bloco}.{self.subetapa} - {self.documento.nome_arquivo}"
@@ -237,6 +271,104 @@ class LogSeguranca(models.Model):
         verbose_name = 'Log de Segurança'
         verbose_name_plural = 'Logs de Segurança'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='log_seguranca_cursor_idx'),
+            # Resumos de segurança e rollups por tipo de evento e por IP numa janela
+            models.Index(fields=['tipo_evento', 'created_at'], name='log_seguranca_tipo_data_idx'),
+            models.Index(fields=['ip_address', 'created_at'], name='log_seguranca_ip_data_idx'),
+        ]
     
     def __str__(self):
         return f"{self.get_tipo_evento_display()} - {self.created_at}"
+
+
+class MetricaRollup(models.Model):
+    """Agregados pré-calculados para dashboards e métricas (ver core.rollups)"""
+    
+    PERIODO_CHOICES = [
+        ('hora', 'Hora'),
+        ('dia', 'Dia'),
+        ('total', 'Total'),
+    ]
+    
+    periodo = models.CharField(max_length=10, choices=PERIODO_CHOICES)
+    # 'global' ou o id do Usuario (totais por usuário)
+    escopo = models.CharField(max_length=20, default='global')
+    # Início do intervalo; nos totais, a época Unix
+    inicio = models.DateTimeField()
+    
+    usuarios = models.PositiveIntegerField(default=0)
+    processos = models.PositiveIntegerField(default=0)
+    documentos = models.PositiveIntegerField(default=0)
+    documentos_com_texto = models.PositiveIntegerField(default=0)
+    documentos_bytes = models.BigIntegerField(default=0)
+    sessoes = models.PositiveIntegerField(default=0)
+    sessoes_concluidas = models.PositiveIntegerField(default=0)
+    sessoes_com_tempo = models.PositiveIntegerField(default=0)
+    sessoes_tempo_seg = models.FloatField(default=0.0)
+    resultados = models.PositiveIntegerField(default=0)
+    tokens_total = models.BigIntegerField(default=0)
+    tempo_processamento_seg = models.FloatField(default=0.0)
+    eventos_seguranca = models.PositiveIntegerField(default=0)
+    eventos_erro = models.PositiveIntegerField(default=0)
+    
+    # Contagens por status/tipo/bloco e valores que não se somam entre intervalos
+    distribuicoes = models.JSONField(default=dict)
+    ultima_atividade = models.DateTimeField(null=True, blank=True)
+    
+    atualizado_em = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        db_table = 'metricas_rollup'
+        verbose_name = 'Métrica Agregada'
+        verbose_name_plural = 'Métricas Agregadas'
+        ordering = ['periodo', 'escopo', '-inicio']
+        unique_together = ['periodo', 'escopo', 'inicio']
+    
+    def __str__(self):
+        return f"{self.get_periodo_display()} {self.escopo} - {self.inicio}"
+
+
+class ConsumoTokens(models.Model):
+    """Razão de tokens: uma linha por chamada à OpenAI (ver core.token_ledger)"""
+    
+    OPERACAO_CHOICES = [
+        ('chat', 'Chat'),
+        ('embedding', 'Embedding'),
+    ]
+    
+    usuario = models.ForeignKey(
+        Usuario, on_delete=models.SET_NULL, null=True, blank=True, related_name='consumo_tokens'
+    )
+    processo = models.ForeignKey(
+        Processo, on_delete=models.SET_NULL, null=True, blank=True, related_name='consumo_tokens'
+    )
+    sessao = models.ForeignKey(
+        SessaoAnalise, on_delete=models.SET_NULL, null=True, blank=True, related_name='consumo_tokens'
+    )
+    
+    operacao = models.CharField(max_length=20, choices=OPERACAO_CHOICES, default='chat')
+    modelo = models.CharField(max_length=50)
+    
+    # tokens_prompt inclui os tokens_cache (entrada servida do cache da OpenAI)
+    tokens_prompt = models.PositiveIntegerField(default=0)
+    tokens_cache = models.PositiveIntegerField(default=0)
+    tokens_resposta = models.PositiveIntegerField(default=0)
+    
+    latencia = models.FloatField(default=0.0)  # segundos
+    custo = models.DecimalField(max_digits=12, decimal_places=6, default=0)  # USD
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'consumo_tokens'
+        verbose_name = 'Consumo de Tokens'
+        verbose_name_plural = 'Consumo de Tokens'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['usuario', 'created_at'], name='consumo_usuario_data_idx'),
+            models.Index(fields=['processo', 'created_at'], name='consumo_processo_data_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.modelo} - {self.tokens_prompt + self.tokens_resposta} tokens"
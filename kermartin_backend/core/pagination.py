@@ -0,0 +1,29 @@
+"""
+Paginação por Cursor do Kermartin 3.0
+Listagens grandes usam keyset (WHERE created_at < cursor ORDER BY created_at)
+em vez de OFFSET + COUNT(*): o custo de cada página não cresce com a
+profundidade. Cada view escolhe a classe em `pagination_class`; as demais
+seguem com a PageNumberPagination padrão do REST_FRAMEWORK
+"""
+
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedAtCursorPagination(CursorPagination):
+    """Mais recentes primeiro; id desempata registros do mesmo instante"""
+
+    ordering = ('-created_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class ChronologicalCursorPagination(CreatedAtCursorPagination):
+    """Ordem de criação (resultados de uma sessão, na sequência da análise)"""
+
+    ordering = ('created_at', 'id')
+
+
+class JurisprudenciaCursorPagination(CreatedAtCursorPagination):
+    """Jurisprudência por data de cadastro (data_julgamento aceita nulo e não serve de cursor)"""
+
+    ordering = ('-criado_em', '-id')
@@ -0,0 +1,305 @@
+"""
+Profiler por Amostragem do Kermartin 3.0
+Uma thread lê periodicamente as pilhas das threads em perfil (sys._current_frames)
+e as agrega em formato collapsed ("a;b;c N"), pronto para flamegraph.pl, inferno
+ou speedscope. Perfis de requisições lentas e análises longas ficam num buffer
+circular em disco
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import inspect
+import logging
+import threading
+from collections import Counter
+from functools import wraps
+from typing import Dict, List, Optional
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger('kermartin')
+
+MAX_STACK_DEPTH = 128
+
+PROFILE_ID_RE = re.compile(r'^[0-9]{19}-[0-9a-f]{6}$')
+
+
+def collapse_frame(frame) -> str:
+    """Pilha da raiz até o frame, como 'modulo:funcao;modulo:funcao'"""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+class ProfileSession:
+    """Amostras de uma thread durante uma requisição ou análise"""
+
+    def __init__(self, kind: str, label: str, thread_id: int):
+        self.kind = kind
+        self.label = label
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = time.perf_counter()
+        self.duration = 0.0
+
+    def add(self, stack: str) -> None:
+        self.stacks[stack] += 1
+        self.samples += 1
+
+    def collapsed(self) -> str:
+        """Formato collapsed/folded: uma pilha por linha com o número de amostras"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 20) -> List[Dict]:
+        """Funções com mais amostras no topo da pilha (tempo próprio)"""
+        own = Counter()
+        for stack, count in self.stacks.items():
+            own[stack.rsplit(';', 1)[-1]] += count
+        return [
+            {'funcao': name, 'amostras': count, 'percentual': round(count / self.samples * 100, 1)}
+            for name, count in own.most_common(limit)
+        ]
+
+
+class StackSampler:
+    """
+    Amostrador compartilhado do processo
+
+    Uma única thread atende todas as sessões ativas; sem sessões ela fica
+    parada num Event, sem custo para as requisições não amostradas.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._sessions: Dict[int, ProfileSession] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def register(self, session: ProfileSession) -> bool:
+        """Inicia a amostragem da thread; False se ela já está em perfil"""
+        with self._lock:
+            if session.thread_id in self._sessions:
+                return False
+            self._sessions[session.thread_id] = session
+            if not self._thread_running():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='StackSampler', daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return True
+
+    def unregister(self, session: ProfileSession) -> None:
+        with self._lock:
+            if self._sessions.get(session.thread_id) is session:
+                del self._sessions[session.thread_id]
+
+    def _thread_running(self) -> bool:
+        # Após fork (gunicorn), a thread do processo pai não existe no filho
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._sessions:
+                    self._wake.clear()
+            if not self._wake.is_set():
+                self._wake.wait()
+                continue
+
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                sessions = list(self._sessions.values())
+            for session in sessions:
+                frame = frames.get(session.thread_id)
+                if frame is not None:
+                    session.add(collapse_frame(frame))
+            del frames
+
+
+class ProfileStore:
+    """Buffer circular de perfis em disco: um JSON por perfil, os mais antigos são removidos"""
+
+    def __init__(self, directory: str, max_files: int = 200):
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def save(self, session: ProfileSession, metadata: Dict) -> Optional[str]:
+        profile_id = f"{time.time_ns()}-{os.urandom(3).hex()}"
+        data = {
+            'id': profile_id,
+            'tipo': session.kind,
+            'rotulo': session.label,
+            'duracao': round(session.duration, 4),
+            'amostras': session.samples,
+            'intervalo_ms': metadata.pop('intervalo_ms', None),
+            'criado_em': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            **metadata,
+            'top': session.top_functions(),
+            'collapsed': session.collapsed(),
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(profile_id)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, path)
+            self._prune()
+        except Exception as e:
+            logger.error(f"Erro ao gravar perfil: {e}")
+            return None
+        return profile_id
+
+    def get(self, profile_id: str) -> Optional[Dict]:
+        if not PROFILE_ID_RE.match(profile_id or ''):
+            return None
+        try:
+            with open(self._path(profile_id), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def list(self, limit: int = 50) -> List[Dict]:
+        """Perfis mais recentes, sem as pilhas"""
+        perfis = []
+        for name in self._files()[::-1][:limit]:
+            profile = self.get(name[:-len('.json')])
+            if profile:
+                profile.pop('collapsed', None)
+                profile['top'] = profile.get('top', [])[:5]
+                perfis.append(profile)
+        return perfis
+
+    def _files(self) -> List[str]:
+        try:
+            # O id começa pelo instante em ns: ordem do nome = ordem de criação
+            return sorted(name for name in os.listdir(self.directory) if name.endswith('.json'))
+        except FileNotFoundError:
+            return []
+
+    def _prune(self) -> None:
+        with self._lock:
+            files = self._files()
+            for name in files[:max(0, len(files) - self.max_files)]:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def _path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.json")
+
+
+class Profiler:
+    """Decide a amostragem, controla as sessões e guarda as que passaram do limite"""
+
+    def __init__(self):
+        kermartin_settings = settings.KERMARTIN_SETTINGS
+        self.enabled = kermartin_settings.get('PROFILING_ENABLED', False)
+        self.interval = kermartin_settings.get('PROFILING_INTERVAL_MS', 5) / 1000
+        self.sample_rates = {
+            'request': kermartin_settings.get('PROFILING_SAMPLE_RATE', 0.05),
+            'analysis': kermartin_settings.get('PROFILING_ANALYSIS_SAMPLE_RATE', 1.0),
+        }
+        directory = kermartin_settings.get('PROFILING_DIR') or os.path.join(
+            settings.BASE_DIR, 'logs', 'profiles'
+        )
+        self.store = ProfileStore(str(directory), kermartin_settings.get('PROFILING_MAX_FILES', 200))
+        self.sampler = StackSampler(self.interval)
+
+    def start(self, kind: str, label: str) -> Optional[ProfileSession]:
+        """Abre uma sessão para a thread atual, se habilitado e sorteado"""
+        if not self.enabled:
+            return None
+        rate = self.sample_rates.get(kind, 0.0)
+        if rate < 1.0 and random.random() >= rate:
+            return None
+        session = ProfileSession(kind, label, threading.get_ident())
+        if not self.sampler.register(session):
+            # Thread já em perfil (ex.: análise síncrona dentro de uma requisição amostrada)
+            return None
+        return session
+
+    def stop(self, session: Optional[ProfileSession], threshold: float, **metadata) -> Optional[str]:
+        """Encerra a sessão; grava e devolve o id se a duração passou de `threshold`"""
+        if session is None:
+            return None
+        self.sampler.unregister(session)
+        session.duration = time.perf_counter() - session.started
+        if session.duration < threshold or not session.samples:
+            return None
+        profile_id = self.store.save(session, {'intervalo_ms': self.interval * 1000, **metadata})
+        if profile_id:
+            logger.warning(
+                f"Perfil gravado: {session.kind} {session.label} "
+                f"({session.duration:.3f}s, {session.samples} amostras) - {profile_id}"
+            )
+        return profile_id
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler() -> Profiler:
+    """Profiler compartilhado do processo"""
+    global _profiler
+    if _profiler is None:
+        with _profiler_lock:
+            if _profiler is None:
+                _profiler = Profiler()
+    return _profiler
+
+
+def profiled(label: str):
+    """
+    Decorador para análises: perfil guardado quando a execução passa de ANALYSIS_TIMEOUT
+
+    Em funções async a thread amostrada é a do event loop, então o perfil
+    inclui as demais corrotinas que rodaram no período.
+    """
+    def decorator(func):
+        def threshold() -> float:
+            return settings.KERMARTIN_SETTINGS.get('ANALYSIS_TIMEOUT', 300)
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                session = get_profiler().start('analysis', label)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    get_profiler().stop(session, threshold())
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            session = get_profiler().start('analysis', label)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                get_profiler().stop(session, threshold())
+        return wrapper
+    return decorator
+
+
+@receiver(setting_changed)
+def _reset_profiler(setting, **kwargs):
+    """Descarta o profiler quando KERMARTIN_SETTINGS muda (testes)"""
+    global _profiler
+    if setting == 'KERMARTIN_SETTINGS':
+        _profiler = None
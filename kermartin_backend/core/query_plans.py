@@ -0,0 +1,147 @@
+"""
+Planos das Consultas Quentes do Kermartin 3.0
+Registro das consultas que a análise, o worker, as métricas e as listagens
+executam com mais frequência, e a leitura do EXPLAIN de cada uma para
+apontar varreduras sequenciais (tabela inteira)
+"""
+
+import re
+import uuid
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Callable, Dict, List
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+
+# Leitura da tabela inteira sem índice: PostgreSQL ("Seq Scan on t") e SQLite ("SCAN t").
+# "SCAN t USING INDEX i" percorre o índice na ordem do ORDER BY e para no LIMIT: não é apontado
+SEQ_SCAN_PATTERNS = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'\bSCAN (\w+)\s*$', re.MULTILINE),
+}
+
+_registry: Dict[str, Callable] = {}
+
+
+def hot_query(name: str):
+    """Registra uma função que devolve o QuerySet de uma consulta quente"""
+    def decorator(func):
+        _registry[name] = func
+        return func
+    return decorator
+
+
+def hot_queries() -> Dict[str, Callable]:
+    return dict(_registry)
+
+
+@dataclass
+class QueryPlan:
+    nome: str
+    sql: str
+    plano: str
+    varreduras: List[str] = field(default_factory=list)
+
+    @property
+    def sequencial(self) -> bool:
+        return bool(self.varreduras)
+
+
+def find_seq_scans(plan: str, vendor: str) -> List[str]:
+    """Tabelas lidas por varredura sequencial no texto do EXPLAIN"""
+    pattern = SEQ_SCAN_PATTERNS.get(vendor)
+    if pattern is None:
+        return []
+    return sorted(set(pattern.findall(plan)))
+
+
+def explain(name: str) -> QueryPlan:
+    queryset = _registry[name]()
+    plan = queryset.explain()
+    return QueryPlan(
+        nome=name,
+        sql=str(queryset.query),
+        plano=plan,
+        varreduras=find_seq_scans(plan, connection.vendor),
+    )
+
+
+def explain_all(names: List[str] = None) -> List[QueryPlan]:
+    return [explain(name) for name in names or sorted(_registry)]
+
+
+# Consultas registradas; os parâmetros são amostras, o que importa é o formato do filtro
+
+def _ultimas_horas(horas: int):
+    return timezone.now() - timedelta(hours=horas)
+
+
+@hot_query('resultado.upsert')
+def _resultado_upsert():
+    """Busca do update_or_create de _save_analysis_result (fora da análise completa, que grava em lote)"""
+    from .models import ResultadoAnalise
+    return ResultadoAnalise.objects.filter(
+        sessao_id=uuid.uuid4(), documento_id=uuid.uuid4(), bloco=1, subetapa=1
+    )
+
+
+@hot_query('resultado.listagem_sessao')
+def _resultado_listagem_sessao():
+    from .models import ResultadoAnalise
+    return ResultadoAnalise.objects.filter(sessao_id=uuid.uuid4()).order_by('created_at', 'id')[:20]
+
+
+@hot_query('documento.processados')
+def _documento_processados():
+    """Documentos analisáveis do processo (iniciar, análise completa, worker)"""
+    from .models import Documento
+    return Documento.objects.filter(processo_id=uuid.uuid4()).processados()
+
+
+@hot_query('sessao.fila_worker')
+def _sessao_fila_worker():
+    from .models import SessaoAnalise
+    return SessaoAnalise.objects.filter(status='iniciada').order_by('created_at').values_list('id', flat=True)[:10]
+
+
+@hot_query('processo.listagem_usuario')
+def _processo_listagem_usuario():
+    from .models import Processo
+    return Processo.objects.filter(usuario_id=1).order_by('-created_at', '-id')[:20]
+
+
+@hot_query('log_seguranca.por_tipo')
+def _log_seguranca_por_tipo():
+    """Resumo de segurança (SecurityValidator.get_security_summary)"""
+    from .models import LogSeguranca
+    return LogSeguranca.objects.filter(tipo_evento='prompt_injection', created_at__gte=_ultimas_horas(24))
+
+
+@hot_query('log_seguranca.por_ip')
+def _log_seguranca_por_ip():
+    from .models import LogSeguranca
+    return LogSeguranca.objects.filter(ip_address='10.0.0.1', created_at__gte=_ultimas_horas(24))
+
+
+@hot_query('log_seguranca.ameacas_24h')
+def _log_seguranca_ameacas():
+    """IPs com mais ameaças (core.rollups)"""
+    from .models import LogSeguranca
+    return LogSeguranca.objects.filter(
+        created_at__gte=_ultimas_horas(24),
+        tipo_evento__in=['prompt_injection', 'upload_suspeito', 'acesso_negado']
+    ).values('ip_address').annotate(count=Count('id')).order_by('-count')[:10]
+
+
+@hot_query('log_seguranca.janela')
+def _log_seguranca_janela():
+    from .models import LogSeguranca
+    return LogSeguranca.objects.filter(created_at__gte=_ultimas_horas(24 * 7)).values('ip_address').order_by().distinct()
+
+
+@hot_query('jurisprudencia.recentes')
+def _jurisprudencia_recentes():
+    """Sugestões e busca sem consulta (ordem padrão)"""
+    from juris.models import Jurisprudencia
+    return Jurisprudencia.objects.order_by('-data_julgamento', '-id')[:8]
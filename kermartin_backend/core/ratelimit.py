@@ -0,0 +1,195 @@
+"""
+Rate Limiting do Kermartin 3.0
+Janela deslizante (log de requisições) verificada e registrada numa única
+operação atômica: script Lua no Redis ou memória do processo sem Redis
+"""
+
+import math
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from typing import Dict, Optional
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from ai_engine.cache_stats import get_cache_stats
+from .redis_utils import get_redis_client, make_redis_key
+
+logger = logging.getLogger('kermartin')
+
+
+# KEYS[1] = chave do log; ARGV = agora (ms), janela (ms), limite, membro único
+# Retorna {permitido, restantes, ms até liberar a próxima vaga}
+SLIDING_WINDOW_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+local count = redis.call('ZCARD', key)
+
+if count < limit then
+    redis.call('ZADD', key, now, ARGV[4])
+    redis.call('PEXPIRE', key, window)
+    return {1, limit - count - 1, 0}
+end
+
+local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+local retry = window
+if oldest[2] then
+    retry = tonumber(oldest[2]) + window - now
+end
+return {0, 0, retry}
+"""
+
+
+class RateLimitResult:
+    """Resultado de uma verificação de limite"""
+
+    __slots__ = ('allowed', 'limit', 'remaining', 'reset_after', 'retry_after')
+
+    def __init__(self, allowed: bool, limit: int, remaining: int, reset_after: float, retry_after: float):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset_after = reset_after
+        self.retry_after = retry_after
+
+    def headers(self) -> Dict[str, str]:
+        """Cabeçalhos X-RateLimit-* (e Retry-After quando bloqueado)"""
+        headers = {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': str(math.ceil(self.reset_after)),
+        }
+        if not self.allowed:
+            headers['Retry-After'] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class RateLimiter:
+    """
+    Limitador por janela deslizante
+
+    Com Redis, cada verificação é uma chamada EVALSHA (uma ida ao Redis):
+    remove registros fora da janela, conta e registra a requisição se houver
+    vaga, tudo atomicamente. Sem Redis (testes/desenvolvimento), o mesmo
+    algoritmo roda em memória, protegido por lock, valendo só para o processo.
+    """
+
+    KEY_PREFIX = 'rate_limit'
+
+    # Acima disso, logs vazios são descartados na próxima verificação
+    _MAX_LOCAL_KEYS = 10000
+
+    def __init__(self):
+        self.stats = get_cache_stats()
+        self._script = None
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def hit(self, identifier: str, limit: int, window: int) -> RateLimitResult:
+        """Registra uma requisição de `identifier` se ainda houver vaga na janela (segundos)"""
+
+        key = f"{self.KEY_PREFIX}_{identifier}"
+        started = time.perf_counter()
+
+        client = get_redis_client()
+        if client is not None:
+            try:
+                result = self._hit_redis(client, key, limit, window)
+            except Exception as e:
+                logger.error(f"Erro no rate limit via Redis, usando memória local: {e}")
+                result = self._hit_local(key, limit, window)
+        else:
+            result = self._hit_local(key, limit, window)
+
+        self.stats.record(
+            'rate_limit', 'hits' if result.allowed else 'misses', time.perf_counter() - started
+        )
+        return result
+
+    def reset(self, identifier: Optional[str] = None) -> None:
+        """Limpa os registros de um identificador (ou todos os locais)"""
+
+        if identifier is None:
+            with self._lock:
+                self._local.clear()
+            return
+
+        key = f"{self.KEY_PREFIX}_{identifier}"
+        with self._lock:
+            self._local.pop(key, None)
+        client = get_redis_client()
+        if client is not None:
+            client.delete(make_redis_key(key))
+
+    def _hit_redis(self, client, key: str, limit: int, window: int) -> RateLimitResult:
+        if self._script is None:
+            self._script = client.register_script(SLIDING_WINDOW_SCRIPT)
+
+        now_ms = int(time.time() * 1000)
+        window_ms = window * 1000
+        allowed, remaining, retry_ms = self._script(
+            keys=[make_redis_key(key)],
+            args=[now_ms, window_ms, limit, f"{now_ms}-{uuid.uuid4().hex[:8]}"],
+            client=client,
+        )
+        return RateLimitResult(
+            allowed=bool(allowed),
+            limit=limit,
+            remaining=int(remaining),
+            reset_after=window if allowed else int(retry_ms) / 1000,
+            retry_after=int(retry_ms) / 1000,
+        )
+
+    def _hit_local(self, key: str, limit: int, window: int) -> RateLimitResult:
+        now = time.monotonic()
+
+        with self._lock:
+            if len(self._local) > self._MAX_LOCAL_KEYS:
+                self._prune_local(now)
+
+            _, log = self._local.setdefault(key, (window, deque()))
+            while log and log[0] <= now - window:
+                log.popleft()
+
+            if len(log) < limit:
+                log.append(now)
+                return RateLimitResult(True, limit, limit - len(log), window, 0)
+
+            retry_after = log[0] + window - now
+            return RateLimitResult(False, limit, 0, retry_after, retry_after)
+
+    def _prune_local(self, now: float) -> None:
+        """Remove logs cujas requisições já saíram da janela"""
+        expired = [
+            key for key, (window, log) in self._local.items()
+            if not log or log[-1] <= now - window
+        ]
+        for key in expired:
+            del self._local[key]
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Limitador compartilhado pelo middleware e pelo SecurityValidator"""
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = RateLimiter()
+    return _default
+
+
+@receiver(setting_changed)
+def _reset_rate_limiter(setting, **kwargs):
+    """Descarta a instância (e os logs locais) quando CACHES muda (testes)"""
+    global _default
+    if setting in ('CACHES', 'KERMARTIN_SETTINGS'):
+        _default = None
@@ -0,0 +1,41 @@
+"""
+Acesso direto ao Redis do cache do Kermartin 3.0
+Para operações que a API de cache do Django não oferece (hashes, pipelines, scripts)
+"""
+
+import logging
+from typing import Optional
+from django.core.cache import caches
+
+logger = logging.getLogger('kermartin')
+
+
+def get_redis_client(alias: str = 'default', write: bool = True) -> Optional[object]:
+    """
+    Cliente redis-py do cache indicado, ou None se o backend não for Redis
+
+    Suporta o backend nativo do Django (django.core.cache.backends.redis)
+    e o django-redis usado em produção.
+    """
+
+    backend = caches[alias]
+
+    try:
+        # django-redis
+        if hasattr(backend, 'client') and hasattr(backend.client, 'get_client'):
+            return backend.client.get_client(write=write)
+
+        # Backend Redis nativo do Django
+        client_wrapper = getattr(backend, '_cache', None)
+        if client_wrapper is not None and hasattr(client_wrapper, 'get_client'):
+            return client_wrapper.get_client(write=write)
+
+    except Exception as e:
+        logger.error(f"Erro ao obter cliente Redis: {e}")
+
+    return None
+
+
+def make_redis_key(key: str, alias: str = 'default') -> str:
+    """Chave com prefixo/versão do cache, igual à usada pela API de cache do Django"""
+    return caches[alias].make_key(key)
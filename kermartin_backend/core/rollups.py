@@ -0,0 +1,341 @@
+"""
+Agregados de Métricas do Kermartin 3.0
+Totais por usuário e globais e séries por hora/dia calculados com agregação
+condicional (uma consulta por tabela) e gravados em MetricaRollup
+"""
+
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, Iterable, List, Optional
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+from .models import (
+    Usuario, Processo, Documento, SessaoAnalise, ResultadoAnalise, LogSeguranca, MetricaRollup
+)
+
+logger = logging.getLogger('kermartin')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+GLOBAL = 'global'
+
+# Um recálculo disparado por leitura por vez (entre processos, via cache compartilhado)
+REFRESH_LOCK_KEY = 'kermartin:rollups:refresh'
+REFRESH_LOCK_TTL = 300
+
+COUNTER_FIELDS = (
+    'usuarios', 'processos', 'documentos', 'documentos_com_texto', 'documentos_bytes',
+    'sessoes', 'sessoes_concluidas', 'sessoes_com_tempo', 'sessoes_tempo_seg',
+    'resultados', 'tokens_total', 'tempo_processamento_seg', 'eventos_seguranca', 'eventos_erro',
+)
+
+
+def _choices(field_choices) -> List:
+    return [value for value, _ in field_choices]
+
+
+def _distribution(name: str, field: str, values: Iterable) -> Dict:
+    """Count condicional por valor: 'name__valor' -> COUNT(*) FILTER (WHERE field = valor)"""
+    return {f"{name}__{value}": Count('pk', filter=Q(**{field: value})) for value in values}
+
+
+# Tabelas agregadas: modelo, caminho até o usuário (None = só global) e agregados
+def _table_specs():
+    return [
+        (Usuario, None, {
+            'usuarios': Count('pk'),
+        }),
+        (Processo, 'usuario_id', {
+            'processos': Count('pk'),
+            **_distribution('status', 'status', _choices(Processo.STATUS_CHOICES)),
+            **_distribution('tipo_crime', 'tipo_crime', [''] + _choices(Processo.TIPO_CRIME_CHOICES)),
+        }),
+        (Documento, 'processo__usuario_id', {
+            'documentos': Count('pk'),
+            'documentos_com_texto': Count('pk', filter=~Q(texto_extraido='')),
+            'documentos_bytes': Sum('tamanho_arquivo'),
+            **_distribution('tipo_documento', 'tipo_documento', _choices(Documento.TIPO_DOCUMENTO_CHOICES)),
+        }),
+        (SessaoAnalise, 'processo__usuario_id', {
+            'sessoes': Count('pk'),
+            'sessoes_concluidas': Count('pk', filter=Q(status='concluida')),
+            'sessoes_com_tempo': Count('pk', filter=Q(tempo_total__isnull=False)),
+            'sessoes_tempo_seg': Sum('tempo_total'),
+            'ultima_atividade': Max('created_at'),
+            **_distribution('modo_analise', 'modo_analise', _choices(SessaoAnalise.MODO_CHOICES)),
+        }),
+        (ResultadoAnalise, 'sessao__processo__usuario_id', {
+            'resultados': Count('pk'),
+            'tokens_total': Sum('tokens_total'),
+            'tempo_processamento_seg': Sum('tempo_processamento'),
+            **_distribution('bloco', 'bloco', range(1, 5)),
+        }),
+        (LogSeguranca, None, {
+            'eventos_seguranca': Count('pk'),
+            'eventos_erro': Count('pk', filter=Q(tipo_evento='erro_sistema')),
+            **_distribution('tipo_evento', 'tipo_evento', _choices(LogSeguranca.TIPO_EVENTO_CHOICES)),
+        }),
+    ]
+
+
+def _merge(acc: Dict, values: Dict) -> None:
+    """Soma uma linha de agregados no acumulador (contadores, distribuições e máximo)"""
+    for key, value in values.items():
+        if value is None:
+            continue
+        if isinstance(value, timedelta):
+            value = value.total_seconds()
+        if key == 'ultima_atividade':
+            acc[key] = max(acc.get(key) or value, value)
+        elif '__' in key:
+            name, bucket = key.split('__', 1)
+            if value:
+                dist = acc['distribuicoes'].setdefault(name, {})
+                dist[bucket] = dist.get(bucket, 0) + value
+        else:
+            acc[key] = acc.get(key, 0) + value
+
+
+def _new_acc() -> Dict:
+    return {'distribuicoes': {}}
+
+
+def _to_row(periodo: str, escopo: str, inicio: datetime, acc: Dict, now: datetime) -> MetricaRollup:
+    fields = {field: acc.get(field, 0) for field in COUNTER_FIELDS}
+    return MetricaRollup(
+        periodo=periodo,
+        escopo=escopo,
+        inicio=inicio,
+        distribuicoes=acc['distribuicoes'],
+        ultima_atividade=acc.get('ultima_atividade'),
+        atualizado_em=now,
+        **fields
+    )
+
+
+def compute_totals(usuario_id: Optional[int] = None) -> Dict[str, Dict]:
+    """
+    Totais por escopo: {'global': {...}, '<usuario_id>': {...}}
+
+    Uma consulta agrupada por usuário em cada tabela; o global é a soma dos
+    usuários (mais usuários e eventos de segurança, que só existem no global).
+    Com `usuario_id`, calcula só os totais desse usuário.
+    """
+
+    accs = defaultdict(_new_acc)
+    for model, user_path, aggregates in _table_specs():
+        if user_path is None:
+            if usuario_id is None:
+                _merge(accs[GLOBAL], model.objects.aggregate(**aggregates))
+            continue
+
+        qs = model.objects.all()
+        if usuario_id is not None:
+            qs = qs.filter(**{user_path: usuario_id})
+        for values in qs.values(user_path).annotate(**aggregates).order_by():
+            escopo = str(values.pop(user_path))
+            _merge(accs[escopo], values)
+            if usuario_id is None:
+                _merge(accs[GLOBAL], values)
+
+    if usuario_id is not None:
+        accs.setdefault(str(usuario_id), _new_acc())
+    return accs
+
+
+def compute_series(periodo: str, since: datetime) -> Dict[datetime, Dict]:
+    """Agregados globais por hora ou dia desde `since`: uma consulta por tabela"""
+
+    kind = 'hour' if periodo == 'hora' else 'day'
+    accs = defaultdict(_new_acc)
+    for model, _, aggregates in _table_specs():
+        aggregates = {k: v for k, v in aggregates.items() if k != 'ultima_atividade'}
+        rows = (
+            model.objects.filter(created_at__gte=since)
+            .annotate(intervalo=Trunc('created_at', kind))
+            .values('intervalo')
+            .annotate(**aggregates)
+            .order_by()
+        )
+        for values in rows:
+            _merge(accs[values.pop('intervalo')], values)
+    return accs
+
+
+def _window_values(now: datetime) -> Dict:
+    """Valores distintos por janela (não somáveis entre intervalos), guardados no total global"""
+
+    last_30d = now - timedelta(days=30)
+    last_24h = now - timedelta(hours=24)
+    last_7d = now - timedelta(days=7)
+    return {
+        'usuarios_ativos_30d': Usuario.objects.filter(
+            Q(processos__created_at__gte=last_30d) |
+            Q(processos__sessoes_analise__created_at__gte=last_30d)
+        ).distinct().count(),
+        'ips_unicos_7d': LogSeguranca.objects.filter(
+            created_at__gte=last_7d
+        ).values('ip_address').distinct().count(),
+        'top_ips_ameaca_24h': list(
+            LogSeguranca.objects.filter(
+                created_at__gte=last_24h,
+                tipo_evento__in=['prompt_injection', 'upload_suspeito', 'acesso_negado']
+            ).values('ip_address').annotate(count=Count('id')).order_by('-count')[:10]
+        ),
+    }
+
+
+def refresh_rollups(hours: Optional[int] = None, days: Optional[int] = None) -> Dict[str, int]:
+    """
+    Recalcula totais (global e por usuário) e as séries recentes
+
+    Intervalos a partir do início da janela são apagados e regravados numa
+    transação: leitores veem a versão anterior ou a nova, nunca parcial.
+    """
+
+    kermartin_settings = settings.KERMARTIN_SETTINGS
+    hours = hours if hours is not None else kermartin_settings.get('METRICS_ROLLUP_HOURS', 48)
+    days = days if days is not None else kermartin_settings.get('METRICS_ROLLUP_DAYS', 35)
+
+    now = timezone.now()
+    since_hour = (now - timedelta(hours=hours)).replace(minute=0, second=0, microsecond=0)
+    since_day = timezone.localtime(now - timedelta(days=days)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+
+    totals = compute_totals()
+    totals[GLOBAL]['distribuicoes'].update(_window_values(now))
+    rows = [_to_row('total', escopo, EPOCH, acc, now) for escopo, acc in totals.items()]
+    rows += [_to_row('hora', GLOBAL, inicio, acc, now) for inicio, acc in compute_series('hora', since_hour).items()]
+    rows += [_to_row('dia', GLOBAL, inicio, acc, now) for inicio, acc in compute_series('dia', since_day).items()]
+
+    with transaction.atomic():
+        MetricaRollup.objects.filter(periodo='total').delete()
+        MetricaRollup.objects.filter(periodo='hora', inicio__gte=since_hour).delete()
+        MetricaRollup.objects.filter(periodo='dia', inicio__gte=since_day).delete()
+        # Upsert: outro processo pode ter regravado os mesmos intervalos em paralelo
+        MetricaRollup.objects.bulk_create(
+            rows,
+            batch_size=500,
+            update_conflicts=True,
+            unique_fields=['periodo', 'escopo', 'inicio'],
+            update_fields=list(COUNTER_FIELDS) + ['distribuicoes', 'ultima_atividade', 'atualizado_em'],
+        )
+
+    return {
+        'totais': len(totals),
+        'horas': sum(1 for row in rows if row.periodo == 'hora'),
+        'dias': sum(1 for row in rows if row.periodo == 'dia'),
+    }
+
+
+def refresh_user_totals(usuario_id: int) -> MetricaRollup:
+    """Recalcula só os totais de um usuário (número fixo de consultas)"""
+
+    acc = compute_totals(usuario_id)[str(usuario_id)]
+    row = _to_row('total', str(usuario_id), EPOCH, acc, timezone.now())
+    defaults = {field: getattr(row, field) for field in COUNTER_FIELDS}
+    defaults.update(
+        distribuicoes=row.distribuicoes,
+        ultima_atividade=row.ultima_atividade,
+        atualizado_em=row.atualizado_em,
+    )
+    row, _ = MetricaRollup.objects.update_or_create(
+        periodo='total', escopo=str(usuario_id), inicio=EPOCH, defaults=defaults
+    )
+    return row
+
+
+# Leitura
+
+def _is_stale(row: Optional[MetricaRollup], max_age: float) -> bool:
+    return row is None or (timezone.now() - row.atualizado_em).total_seconds() > max_age
+
+
+def _refresh_in_background() -> bool:
+    """Dispara refresh_rollups numa thread, se nenhum outro recálculo estiver em curso"""
+
+    if not cache.add(REFRESH_LOCK_KEY, 1, timeout=REFRESH_LOCK_TTL):
+        return False
+
+    def run():
+        try:
+            refresh_rollups()
+        except Exception as e:
+            logger.error(f"Erro ao atualizar agregados de métricas: {e}")
+        finally:
+            cache.delete(REFRESH_LOCK_KEY)
+            connection.close()
+
+    threading.Thread(target=run, name='RollupRefresh', daemon=True).start()
+    return True
+
+
+def get_global_totals() -> MetricaRollup:
+    """
+    Totais globais gravados pelo comando rollup_metrics (processo `rollup`)
+
+    Se passaram de METRICS_ROLLUP_MAX_AGE_SEC, a linha atual é servida e um
+    único recálculo é disparado em segundo plano. Só sem nenhuma linha
+    (base nova) o recálculo roda na requisição.
+    """
+
+    max_age = settings.KERMARTIN_SETTINGS.get('METRICS_ROLLUP_MAX_AGE_SEC', 600)
+    row = MetricaRollup.objects.filter(periodo='total', escopo=GLOBAL).first()
+    if row is None:
+        refresh_rollups()
+        row = MetricaRollup.objects.get(periodo='total', escopo=GLOBAL)
+    elif _is_stale(row, max_age):
+        _refresh_in_background()
+    return row
+
+
+def get_user_totals(usuario_id: int) -> MetricaRollup:
+    """Totais de um usuário, recalculados se mais velhos que METRICS_ROLLUP_USER_MAX_AGE_SEC"""
+
+    max_age = settings.KERMARTIN_SETTINGS.get('METRICS_ROLLUP_USER_MAX_AGE_SEC', 60)
+    row = MetricaRollup.objects.filter(periodo='total', escopo=str(usuario_id)).first()
+    if _is_stale(row, max_age):
+        row = refresh_user_totals(usuario_id)
+    return row
+
+
+def sum_period(periodo: str, since: datetime) -> Dict:
+    """
+    Soma dos intervalos globais iniciados a partir de `since` (uma consulta)
+
+    A janela é alinhada à hora/dia: 'últimas 24h' inclui a hora parcial inicial.
+    """
+
+    if periodo == 'hora':
+        since = since.replace(minute=0, second=0, microsecond=0)
+    else:
+        since = timezone.localtime(since).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    acc = _new_acc()
+    rows = MetricaRollup.objects.filter(
+        periodo=periodo, escopo=GLOBAL, inicio__gte=since
+    ).values(*COUNTER_FIELDS, 'distribuicoes')
+    for values in rows:
+        for name, dist in values.pop('distribuicoes').items():
+            for bucket, count in dist.items():
+                values[f"{name}__{bucket}"] = count
+        _merge(acc, values)
+
+    for field in COUNTER_FIELDS:
+        acc.setdefault(field, 0)
+    return acc
+
+
+def series(periodo: str, since: datetime, field: str) -> List[Dict]:
+    """Série [{data, valor}] de um contador global por hora ou dia (uma consulta)"""
+
+    rows = MetricaRollup.objects.filter(
+        periodo=periodo, escopo=GLOBAL, inicio__gte=since
+    ).order_by('inicio').values_list('inicio', field)
+    return [{'data': inicio.isoformat(), 'valor': valor} for inicio, valor in rows]
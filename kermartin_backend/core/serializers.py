@@ -3,8 +3,9 @@ Serializers para as APIs do Kermartin 3.0
 """
 
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
-from .models import Usuario, Processo, Documento, SessaoAnalise, ResultadoAnalise
+from .models import Usuario, Processo, Documento, SessaoAnalise, ResultadoAnalise, LogSeguranca
 
 
 class UsuarioSerializer(serializers.ModelSerializer):
@@ -41,9 +42,21 @@ class ProcessoSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
     
     def get_total_documentos(self, obj):
-        return obj.documentos.count()
+        # Anotado na listagem (ProcessoViewSet.get_queryset); consulta só fora dela
+        total = getattr(obj, 'num_documentos', None)
+        return total if total is not None else obj.documentos.count()
     
     def get_ultima_analise(self, obj):
+        if hasattr(obj, 'ultima_sessao_id'):
+            if obj.ultima_sessao_id is None:
+                return None
+            return {
+                'id': str(obj.ultima_sessao_id),
+                'modo': dict(SessaoAnalise.MODO_CHOICES).get(obj.ultima_sessao_modo, obj.ultima_sessao_modo),
+                'status': dict(SessaoAnalise.STATUS_CHOICES).get(obj.ultima_sessao_status, obj.ultima_sessao_status),
+                'data': obj.ultima_sessao_data
+            }
+        
         ultima_sessao = obj.sessoes_analise.order_by('-created_at').first()
         if ultima_sessao:
             return {
@@ -83,7 +96,15 @@ class DocumentoSerializer(serializers.ModelSerializer):
             return f"{size / (1024 * 1024):.1f} MB"
     
     def get_tem_texto_extraido(self, obj):
-        return bool(obj.texto_extraido)
+        tem_texto = getattr(obj, 'tem_texto', None)
+        return tem_texto if tem_texto is not None else bool(obj.texto_extraido)
+
+
+class DocumentoListSerializer(DocumentoSerializer):
+    """Listagem de documentos: sem o texto extraído (carregado só no detalhe)"""
+    
+    class Meta(DocumentoSerializer.Meta):
+        fields = [field for field in DocumentoSerializer.Meta.fields if field != 'texto_extraido']
 
 
 class DocumentoUploadSerializer(serializers.ModelSerializer):
@@ -98,9 +119,11 @@ class DocumentoUploadSerializer(serializers.ModelSerializer):
         if not value.name.lower().endswith('.pdf'):
             raise serializers.ValidationError("Apenas arquivos PDF são permitidos")
         
-        max_size = 10 * 1024 * 1024  # 10MB
+        max_size = settings.KERMARTIN_SETTINGS['MAX_DOCUMENT_SIZE']
         if value.size > max_size:
-            raise serializers.ValidationError("Arquivo muito grande. Máximo 10MB")
+            raise serializers.ValidationError(
+                f"Arquivo muito grande. Máximo {max_size // (1024 * 1024)}MB"
+            )
         
         return value
 
@@ -123,7 +146,8 @@ class SessaoAnaliseSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'tempo_inicio', 'tempo_fim', 'created_at', 'updated_at']
     
     def get_total_resultados(self, obj):
-        return obj.resultados.count()
+        total = getattr(obj, 'num_resultados', None)
+        return total if total is not None else obj.resultados.count()
     
     def get_tempo_total_formatado(self, obj):
         if obj.tempo_total:
@@ -163,6 +187,20 @@ class ResultadoAnaliseSerializer(serializers.ModelSerializer):
         return f"{obj.tempo_processamento:.2f}s"
 
 
+class LogSegurancaSerializer(serializers.ModelSerializer):
+    """Serializer para modelo LogSeguranca (somente leitura)"""
+    
+    tipo_evento_display = serializers.CharField(source='get_tipo_evento_display', read_only=True)
+    
+    class Meta:
+        model = LogSeguranca
+        fields = [
+            'id', 'usuario', 'tipo_evento', 'tipo_evento_display', 'descricao',
+            'ip_address', 'user_agent', 'dados_extras', 'created_at'
+        ]
+        read_only_fields = fields
+
+
 class IniciarAnaliseSerializer(serializers.Serializer):
     """Serializer para iniciar análise"""
     
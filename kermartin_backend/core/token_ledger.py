@@ -0,0 +1,369 @@
+"""
+Razão de Tokens do Kermartin 3.0
+Cada chamada à OpenAI (chat e embeddings) vira uma linha de ConsumoTokens,
+gravada em lote; totais correntes por usuário (mês) e por processo ficam no
+Redis, de modo que consumo e orçamento são lidos sem varrer resultados
+"""
+
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from typing import Dict, Iterator, Optional
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db.models import Count, Sum
+from django.dispatch import receiver
+from django.utils import timezone
+from .buffered_writer import BufferedModelWriter
+from .redis_utils import get_redis_client, make_redis_key
+
+logger = logging.getLogger('kermartin')
+
+# Campos inteiros dos totais; o custo é somado em micro-USD (HINCRBY, sem erro de ponto flutuante)
+FIELDS = ('chamadas', 'tokens_prompt', 'tokens_cache', 'tokens_resposta', 'custo_micro')
+
+# Totais ausentes no Redis (expirados ou perdidos) são refeitos a partir da razão
+SEEDED_FIELD = 'semeado'
+
+MONTH_TTL = 40 * 24 * 3600
+PROCESS_TTL = 90 * 24 * 3600
+
+MICRO = Decimal('0.000001')
+
+# Usuário, processo e sessão a quem as chamadas do fluxo atual são atribuídas
+_scope: ContextVar[Dict] = ContextVar('kermartin_token_scope', default={})
+
+
+class BudgetExceeded(Exception):
+    """Orçamento mensal de tokens ou custo do usuário esgotado"""
+
+    def __init__(self, message: str, consumo: Dict):
+        super().__init__(message)
+        self.consumo = consumo
+
+
+@contextmanager
+def usage_scope(usuario_id=None, processo_id=None, sessao_id=None) -> Iterator[None]:
+    """Atribui as chamadas feitas dentro do bloco (inclusive em tarefas asyncio filhas)"""
+    token = _scope.set({
+        'usuario_id': usuario_id,
+        'processo_id': processo_id,
+        'sessao_id': sessao_id,
+    })
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def _price(model: str):
+    pricing = getattr(settings, 'OPENAI_PRICING', {})
+    if model in pricing:
+        return pricing[model]
+    # Versões datadas (gpt-4o-2024-08-06) usam o preço do prefixo mais longo
+    matches = [name for name in pricing if model.startswith(name)]
+    return pricing[max(matches, key=len)] if matches else None
+
+
+def compute_cost(model: str, tokens_prompt: int, tokens_cache: int = 0, tokens_resposta: int = 0) -> Decimal:
+    """Custo em USD da chamada; tokens_prompt inclui os tokens servidos do cache"""
+    price = _price(model)
+    if price is None:
+        return Decimal(0)
+    entrada, entrada_cache, saida = (Decimal(str(value)) for value in price)
+    tokens_cache = min(tokens_cache, tokens_prompt)
+    custo = (
+        (tokens_prompt - tokens_cache) * entrada
+        + tokens_cache * entrada_cache
+        + tokens_resposta * saida
+    ) / Decimal(1_000_000)
+    return custo.quantize(MICRO)
+
+
+def usage_from_response(usage) -> Dict[str, int]:
+    """Tokens do objeto `usage` da OpenAI (chat ou embeddings)"""
+    if usage is None:
+        return {'tokens_prompt': 0, 'tokens_cache': 0, 'tokens_resposta': 0}
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'tokens_prompt': getattr(usage, 'prompt_tokens', 0) or 0,
+        'tokens_cache': (getattr(details, 'cached_tokens', 0) or 0) if details is not None else 0,
+        'tokens_resposta': getattr(usage, 'completion_tokens', 0) or 0,
+    }
+
+
+class TokenLedger:
+    """
+    Razão de tokens e custo
+
+    record() enfileira a linha da razão (BufferedModelWriter) e soma os
+    totais correntes: um hash por usuário e mês e um por processo. Sem
+    Redis, as somas usam cache.add/incr por campo, como em cache_stats.
+    """
+
+    def __init__(self, writer: BufferedModelWriter, backend=None):
+        self.writer = writer
+        self.backend = backend or cache
+
+    # Gravação
+
+    def record(
+        self,
+        operacao: str,
+        modelo: str,
+        tokens_prompt: int = 0,
+        tokens_cache: int = 0,
+        tokens_resposta: int = 0,
+        latencia: float = 0.0,
+        **scope
+    ) -> Decimal:
+        """Registra uma chamada; usuário/processo/sessão vêm do usage_scope() atual"""
+
+        ids = {**_scope.get(), **scope}
+        custo = compute_cost(modelo, tokens_prompt, tokens_cache, tokens_resposta)
+
+        self.writer.submit(
+            usuario_id=ids.get('usuario_id'),
+            processo_id=ids.get('processo_id'),
+            sessao_id=ids.get('sessao_id'),
+            operacao=operacao,
+            modelo=modelo[:50],
+            tokens_prompt=tokens_prompt,
+            tokens_cache=tokens_cache,
+            tokens_resposta=tokens_resposta,
+            latencia=latencia,
+            custo=custo,
+        )
+
+        values = {
+            'chamadas': 1,
+            'tokens_prompt': tokens_prompt,
+            'tokens_cache': tokens_cache,
+            'tokens_resposta': tokens_resposta,
+            'custo_micro': int(custo / MICRO),
+        }
+        keys = []
+        if ids.get('usuario_id') is not None:
+            keys.append((self._user_key(ids['usuario_id']), MONTH_TTL))
+        if ids.get('processo_id') is not None:
+            keys.append((self._process_key(ids['processo_id']), PROCESS_TTL))
+        self._increment(keys, values)
+        return custo
+
+    def _increment(self, keys, values: Dict[str, int]) -> None:
+        if not keys:
+            return
+        try:
+            client = get_redis_client()
+            if client is not None:
+                pipe = client.pipeline(transaction=False)
+                for key, ttl in keys:
+                    redis_key = make_redis_key(key)
+                    for field, value in values.items():
+                        pipe.hincrby(redis_key, field, value)
+                    pipe.expire(redis_key, ttl)
+                pipe.execute()
+            else:
+                for key, ttl in keys:
+                    for field, value in values.items():
+                        field_key = f"{key}:{field}"
+                        if not self.backend.add(field_key, value, timeout=ttl):
+                            self.backend.incr(field_key, value)
+        except Exception as e:
+            logger.error(f"Erro ao somar consumo de tokens: {e}")
+
+    # Leitura
+
+    def user_totals(self, usuario_id, month: Optional[datetime] = None) -> Dict:
+        """Consumo do usuário no mês (padrão: mês corrente)"""
+        start = self._month_start(month)
+        return self._totals(
+            self._user_key(usuario_id, start), MONTH_TTL,
+            lambda: {'usuario_id': usuario_id, 'created_at__gte': start, 'created_at__lt': self._next_month(start)}
+        )
+
+    def process_totals(self, processo_id) -> Dict:
+        """Consumo acumulado do processo"""
+        return self._totals(
+            self._process_key(processo_id), PROCESS_TTL,
+            lambda: {'processo_id': processo_id}
+        )
+
+    def _totals(self, key: str, ttl: int, ledger_filter) -> Dict:
+        raw = self._read(key)
+        if raw is None:
+            raw = self._seed(key, ttl, ledger_filter())
+        return self._summarize(raw)
+
+    def _read(self, key: str) -> Optional[Dict[str, int]]:
+        """Totais correntes, ou None se a chave ainda não foi semeada da razão"""
+        try:
+            client = get_redis_client(write=False)
+            if client is not None:
+                values = {
+                    (k.decode() if isinstance(k, bytes) else k): int(v)
+                    for k, v in client.hgetall(make_redis_key(key)).items()
+                }
+            else:
+                names = {f"{key}:{field}": field for field in FIELDS + (SEEDED_FIELD,)}
+                values = {names[k]: v for k, v in self.backend.get_many(list(names)).items()}
+        except Exception as e:
+            logger.error(f"Erro ao ler consumo de tokens: {e}")
+            return None
+        return values if values.get(SEEDED_FIELD) else None
+
+    def _seed(self, key: str, ttl: int, ledger_filter: Dict) -> Dict[str, int]:
+        """
+        Refaz os totais a partir da razão (consulta pelos índices usuario/processo + data)
+
+        Sobrescreve as somas feitas antes da semeadura, que já estão na razão
+        (a fila deste processo é gravada antes); só as linhas ainda na fila de
+        outros processos, no máximo TOKEN_LEDGER_FLUSH_MS, ficam de fora.
+        """
+        from .models import ConsumoTokens
+
+        self.writer.flush()
+        aggregates = ConsumoTokens.objects.filter(**ledger_filter).aggregate(
+            chamadas=Count('id'),
+            tokens_prompt=Sum('tokens_prompt'),
+            tokens_cache=Sum('tokens_cache'),
+            tokens_resposta=Sum('tokens_resposta'),
+            custo=Sum('custo'),
+        )
+        values = {field: aggregates.get(field) or 0 for field in FIELDS if field != 'custo_micro'}
+        values['custo_micro'] = int((aggregates['custo'] or Decimal(0)) / MICRO)
+        values[SEEDED_FIELD] = 1
+
+        try:
+            client = get_redis_client()
+            if client is not None:
+                redis_key = make_redis_key(key)
+                pipe = client.pipeline()
+                pipe.hset(redis_key, mapping=values)
+                pipe.expire(redis_key, ttl)
+                pipe.execute()
+            else:
+                self.backend.set_many({f"{key}:{field}": value for field, value in values.items()}, timeout=ttl)
+        except Exception as e:
+            logger.error(f"Erro ao semear consumo de tokens: {e}")
+        return values
+
+    def _summarize(self, raw: Dict[str, int]) -> Dict:
+        summary = {field: raw.get(field, 0) for field in FIELDS if field != 'custo_micro'}
+        summary['tokens_total'] = summary['tokens_prompt'] + summary['tokens_resposta']
+        summary['custo_usd'] = float(Decimal(raw.get('custo_micro', 0)) * MICRO)
+        return summary
+
+    # Orçamento
+
+    def budget(self, usuario) -> Dict:
+        """Consumo do mês, limites (do usuário ou padrão) e saldo"""
+
+        kermartin_settings = settings.KERMARTIN_SETTINGS
+        limite_tokens = usuario.limite_tokens_mensal
+        if limite_tokens is None:
+            limite_tokens = kermartin_settings.get('TOKEN_BUDGET_MONTHLY_TOKENS', 0)
+        limite_custo = usuario.limite_custo_mensal
+        if limite_custo is None:
+            limite_custo = kermartin_settings.get('TOKEN_BUDGET_MONTHLY_USD', 0)
+        limite_custo = float(limite_custo)
+
+        consumo = self.user_totals(usuario.id)
+        excedido = bool(
+            (limite_tokens and consumo['tokens_total'] >= limite_tokens)
+            or (limite_custo and consumo['custo_usd'] >= limite_custo)
+        )
+        return {
+            'mes': self._month_start().strftime('%Y-%m'),
+            **consumo,
+            'limite_tokens': limite_tokens or None,
+            'limite_custo_usd': limite_custo or None,
+            'tokens_restantes': max(0, limite_tokens - consumo['tokens_total']) if limite_tokens else None,
+            'custo_restante_usd': round(max(0.0, limite_custo - consumo['custo_usd']), 6) if limite_custo else None,
+            'excedido': excedido,
+        }
+
+    def check_budget(self, usuario) -> Dict:
+        """Levanta BudgetExceeded se o usuário não puder iniciar outra análise no mês"""
+        consumo = self.budget(usuario)
+        if consumo['excedido']:
+            raise BudgetExceeded('Orçamento mensal de tokens esgotado', consumo)
+        return consumo
+
+    # Chaves
+
+    @staticmethod
+    def _month_start(month: Optional[datetime] = None) -> datetime:
+        moment = month or timezone.now()
+        moment = moment.astimezone(dt_timezone.utc) if timezone.is_aware(moment) else moment
+        return datetime(moment.year, moment.month, 1, tzinfo=dt_timezone.utc)
+
+    @staticmethod
+    def _next_month(start: datetime) -> datetime:
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+
+    def _user_key(self, usuario_id, month: Optional[datetime] = None) -> str:
+        return f"token_ledger:usuario:{usuario_id}:{self._month_start(month):%Y%m}"
+
+    @staticmethod
+    def _process_key(processo_id) -> str:
+        return f"token_ledger:processo:{processo_id}"
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_token_ledger() -> TokenLedger:
+    """Razão de tokens compartilhada do processo"""
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                from .models import ConsumoTokens
+
+                kermartin_settings = settings.KERMARTIN_SETTINGS
+                writer = BufferedModelWriter(
+                    ConsumoTokens,
+                    batch_size=kermartin_settings.get('TOKEN_LEDGER_BATCH_SIZE', 100),
+                    flush_interval=kermartin_settings.get('TOKEN_LEDGER_FLUSH_MS', 1000) / 1000,
+                    max_queue=kermartin_settings.get('TOKEN_LEDGER_QUEUE_MAX', 10000),
+                    background=kermartin_settings.get('TOKEN_LEDGER_ASYNC', True),
+                )
+                # Linhas ainda na fila são gravadas no encerramento do processo
+                atexit.register(writer.flush)
+                _ledger = TokenLedger(writer)
+    return _ledger
+
+
+def record_usage(
+    operacao: str,
+    modelo: str,
+    tokens_prompt: int = 0,
+    tokens_cache: int = 0,
+    tokens_resposta: int = 0,
+    latencia: float = 0.0,
+    **scope
+) -> None:
+    """Registra uma chamada à OpenAI na razão; falhas não interrompem a análise"""
+    try:
+        get_token_ledger().record(
+            operacao, modelo, tokens_prompt, tokens_cache, tokens_resposta, latencia, **scope
+        )
+    except Exception as e:
+        logger.error(f"Erro ao registrar consumo de tokens: {e}")
+
+
+@receiver(setting_changed)
+def _reset_token_ledger(setting, **kwargs):
+    """Descarta a instância quando KERMARTIN_SETTINGS muda (testes)"""
+    global _ledger
+    if setting == 'KERMARTIN_SETTINGS':
+        _ledger = None
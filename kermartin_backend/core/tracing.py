@@ -0,0 +1,336 @@
+"""
+Rastreamento por Etapas do Kermartin 3.0
+Spans com gerenciador de contexto (contextvars), trace_id propagado a partir
+da requisição e exportação em JSONL com campos no formato OTLP
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import inspect
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, Iterator, Optional
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from .metrics_registry import get_metrics_registry
+
+logger = logging.getLogger('kermartin')
+
+SERVICE_NAME = 'kermartin'
+
+# (trace_id, amostrado) do fluxo atual e o span aberto mais interno
+_trace: ContextVar[Optional[tuple]] = ContextVar('kermartin_trace', default=None)
+_current_span: ContextVar[Optional['Span']] = ContextVar('kermartin_span', default=None)
+
+
+def _new_id(nbytes: int) -> str:
+    return os.urandom(nbytes).hex()
+
+
+class Span:
+    """Etapa cronometrada de um trace"""
+
+    __slots__ = (
+        'name', 'trace_id', 'span_id', 'parent_id', 'attributes',
+        'start_ns', 'end_ns', 'duration', 'error', '_started',
+    )
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.duration = 0.0
+        self.error = None
+        self._started = time.perf_counter()
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def record_error(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._started
+        self.end_ns = self.start_ns + int(self.duration * 1e9)
+
+    def to_otlp(self) -> Dict:
+        """Registro no formato de span do OTLP/JSON (uma linha do arquivo)"""
+        return {
+            'resource': {'service.name': SERVICE_NAME},
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'startTimeUnixNano': self.start_ns,
+            'endTimeUnixNano': self.end_ns,
+            'durationMs': round(self.duration * 1000, 3),
+            'attributes': self.attributes,
+            'status': {'code': 'ERROR', 'message': self.error} if self.error else {'code': 'OK'},
+        }
+
+
+class _NoopSpan:
+    """Span de traces não amostrados: mede só a duração da etapa"""
+
+    __slots__ = ('name', '_started', 'duration')
+
+    trace_id = span_id = None
+
+    def __init__(self, name: str):
+        self.name = name
+        self._started = time.perf_counter()
+        self.duration = 0.0
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def set_attributes(self, **attributes) -> None:
+        pass
+
+    def record_error(self, error: BaseException) -> None:
+        pass
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._started
+
+
+_NOOP_SPAN = _NoopSpan('noop')
+
+
+class JsonlSpanExporter:
+    """
+    Grava spans finalizados em JSONL, um por linha
+
+    export() só enfileira; uma thread escreve em lote. Fila cheia descarta o
+    span (contado), como a fila de eventos de segurança.
+    """
+
+    def __init__(self, path: str, max_queue: int = 10000, batch_size: int = 200):
+        self.path = path
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def export(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if not self._thread_running():
+            with self._lock:
+                if not self._thread_running():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='SpanExporter', daemon=True)
+                    self._thread.start()
+
+    def _thread_running(self) -> bool:
+        # Após fork (gunicorn), a thread do processo pai não existe no filho
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def flush(self) -> int:
+        """Grava o que está na fila no thread atual e espera o lote em andamento"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        written = self._write(batch)
+        for _ in batch:
+            self._queue.task_done()
+        self._queue.join()
+        return written
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=0.2))
+                except queue.Empty:
+                    break
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, batch) -> int:
+        if not batch:
+            return 0
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            lines = ''.join(json.dumps(span.to_otlp(), default=str) + '\n' for span in batch)
+            with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+        except Exception as e:
+            logger.error(f"Erro ao exportar spans: {e}")
+            return 0
+        return len(batch)
+
+
+class Tracer:
+    """Decide amostragem, abre spans e os entrega ao exportador"""
+
+    def __init__(self):
+        kermartin_settings = settings.KERMARTIN_SETTINGS
+        self.enabled = kermartin_settings.get('TRACING_ENABLED', False)
+        self.sample_rate = kermartin_settings.get('TRACING_SAMPLE_RATE', 1.0)
+        self.exporter = None
+        if self.enabled:
+            path = kermartin_settings.get('TRACING_EXPORT_PATH') or os.path.join(
+                settings.BASE_DIR, 'logs', 'traces.jsonl'
+            )
+            self.exporter = JsonlSpanExporter(
+                str(path), max_queue=kermartin_settings.get('TRACING_QUEUE_MAX', 10000)
+            )
+            atexit.register(self.exporter.flush)
+
+    def sample(self) -> bool:
+        return self.enabled and (self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+    def export(self, span) -> None:
+        if self.exporter is not None and isinstance(span, Span):
+            self.exporter.export(span)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """Tracer compartilhado do processo"""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = Tracer()
+    return _tracer
+
+
+# API
+
+def current_trace_id() -> Optional[str]:
+    """trace_id do fluxo atual (requisição, comando ou worker), se houver"""
+    context = _trace.get()
+    return context[0] if context else None
+
+
+def start_trace(trace_id: Optional[str] = None, sampled: Optional[bool] = None):
+    """
+    Inicia um trace no contexto atual; devolve o token para end_trace()
+
+    Para middleware, onde entrada e saída ficam em métodos separados;
+    no restante do código, use `with trace(...)`.
+    """
+    if sampled is None:
+        sampled = get_tracer().sample()
+    return _trace.set((trace_id or _new_id(16), sampled))
+
+
+def end_trace(token) -> None:
+    _trace.reset(token)
+
+
+@contextmanager
+def trace(name: str, trace_id: Optional[str] = None, **attributes) -> Iterator:
+    """Trace com span raiz (comandos, workers, testes)"""
+    token = start_trace(trace_id)
+    try:
+        with span(name, **attributes) as root:
+            yield root
+    finally:
+        end_trace(token)
+
+
+def open_span(name: str, **attributes):
+    """Abre um span filho do atual; devolve (span, token) para close_span()"""
+    context = _trace.get()
+    if context is None:
+        # Fora de um trace (ex.: shell): só a duração da etapa
+        return _NoopSpan(name), None
+    trace_id, sampled = context
+    if not sampled:
+        return _NoopSpan(name), None
+    parent = _current_span.get()
+    new_span = Span(name, trace_id, parent.span_id if parent else None, attributes)
+    return new_span, _current_span.set(new_span)
+
+
+def close_span(opened, token) -> None:
+    opened.finish()
+    if token is not None:
+        _current_span.reset(token)
+    get_tracer().export(opened)
+    _observe_stage(opened.name, opened.duration)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator:
+    """Etapa cronometrada: `with span('pdf.extract', paginas=10) as s: ...`"""
+    opened, token = open_span(name, **attributes)
+    try:
+        yield opened
+    except BaseException as e:
+        opened.record_error(e)
+        raise
+    finally:
+        close_span(opened, token)
+
+
+def current_span():
+    """Span aberto mais interno do trace amostrado atual (ou um span vazio)"""
+    return _current_span.get() or _NOOP_SPAN
+
+
+def traced(name: str):
+    """Decorador: executa a função (síncrona ou async) dentro de span(name)"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _observe_stage(stage: str, duration: float) -> None:
+    """Duração por etapa no /metrics, amostrada ou não (orçamento de latência)"""
+    try:
+        get_metrics_registry().histogram('kermartin_stage_duration_seconds', '').observe(duration, stage=stage)
+    except Exception as e:
+        logger.error(f"Erro ao registrar duração da etapa {stage}: {e}")
+
+
+@receiver(setting_changed)
+def _reset_tracer(setting, **kwargs):
+    """Descarta o tracer quando KERMARTIN_SETTINGS muda (testes)"""
+    global _tracer
+    if setting == 'KERMARTIN_SETTINGS':
+        _tracer = None
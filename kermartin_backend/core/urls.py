@@ -6,7 +6,7 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import (
     UsuarioViewSet, ProcessoViewSet, DocumentoViewSet,
-    AnaliseViewSet, MenuViewSet, EstatisticasViewSet
+    AnaliseViewSet, MenuViewSet, EstatisticasViewSet, PerfilViewSet, LogSegurancaViewSet
 )
 
 app_name = 'core'
@@ -19,6 +19,8 @@ router.register(r'documentos', DocumentoViewSet, basename='documento')
 router.register(r'analises', AnaliseViewSet, basename='analise')
 router.register(r'menu', MenuViewSet, basename='menu')
 router.register(r'estatisticas', EstatisticasViewSet, basename='estatisticas')
+router.register(r'perfis', PerfilViewSet, basename='perfil')
+router.register(r'logs-seguranca', LogSegurancaViewSet, basename='log-seguranca')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -4,26 +4,61 @@ Sistema de análise jurídica especializado em Tribunal do Júri
 """
 
 import logging
-from django.db.models import Count, Sum, Avg
+from datetime import timedelta
 from django.utils import timezone
+from django.db.models import Count, OuterRef, Subquery
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.parsers import MultiPartParser, FormParser
 from ai_engine.processor import KermartinProcessor, SecurityError, OpenAIError
 from ai_engine.security import SecurityValidator
 from ai_engine.document_processor import DocumentProcessor
+from ai_engine.cache_manager import KermartinCacheManager
 import hashlib
-from .models import Usuario, Processo, Documento, SessaoAnalise, ResultadoAnalise
+import hmac
+from django.conf import settings
+from django.http import HttpResponse
+from django.views import View
+from .models import Usuario, Processo, Documento, SessaoAnalise, LogSeguranca
+from .metrics import KermartinMetrics
+from .rollups import get_user_totals
+from .token_ledger import get_token_ledger, BudgetExceeded
+from .profiling import get_profiler
+from .metrics_registry import get_metrics_registry
 from .serializers import (
-    UsuarioSerializer, ProcessoSerializer, DocumentoSerializer,
+    UsuarioSerializer, ProcessoSerializer, DocumentoSerializer, DocumentoListSerializer,
     DocumentoUploadSerializer, SessaoAnaliseSerializer, ResultadoAnaliseSerializer,
-    IniciarAnaliseSerializer, MenuInterativoSerializer, EstatisticasSerializer
+    IniciarAnaliseSerializer, MenuInterativoSerializer, EstatisticasSerializer,
+    LogSegurancaSerializer
 )
+from .pagination import CreatedAtCursorPagination, ChronologicalCursorPagination
 
 logger = logging.getLogger('kermartin')
 
+# Colunas lidas na listagem de resultados (sem prompt_usado nem o texto do documento)
+RESULTADO_LISTAGEM_CAMPOS = (
+    'id', 'sessao_id', 'bloco', 'subetapa', 'resposta_ia', 'tokens_total',
+    'tempo_processamento', 'modelo_usado', 'created_at',
+    'documento__id', 'documento__nome_arquivo',
+)
+
+
+def documentos_para_listagem(queryset):
+    """Documentos sem o texto extraído, com o título do processo e o indicador de texto"""
+    return queryset.select_related('processo').defer('processo__observacoes').with_text_flag()
+
+
+def sessoes_para_listagem(queryset):
+    """Sessões com o título do processo e o total de resultados anotado"""
+    # Com agregação o Django ignora Meta.ordering: ordem explícita para a paginação
+    return (
+        queryset.select_related('processo')
+        .annotate(num_resultados=Count('resultados'))
+        .order_by('-created_at')
+    )
+
 
 class UsuarioViewSet(viewsets.ReadOnlyModelViewSet):
     """ViewSet para usuários"""
@@ -53,28 +88,50 @@ class ProcessoViewSet(viewsets.ModelViewSet):
     
     serializer_class = ProcessoSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = CreatedAtCursorPagination
     
     def get_queryset(self):
-        usuario = Usuario.objects.get(user=self.request.user)
-        return Processo.objects.filter(usuario=usuario)
+        # Totais e última sessão anotados: número fixo de consultas por página
+        ultima_sessao = SessaoAnalise.objects.filter(processo=OuterRef('pk')).order_by('-created_at')
+        return (
+            Processo.objects.filter(usuario__user=self.request.user)
+            .select_related('usuario')
+            .annotate(
+                num_documentos=Count('documentos', distinct=True),
+                ultima_sessao_id=Subquery(ultima_sessao.values('id')[:1]),
+                ultima_sessao_modo=Subquery(ultima_sessao.values('modo_analise')[:1]),
+                ultima_sessao_status=Subquery(ultima_sessao.values('status')[:1]),
+                ultima_sessao_data=Subquery(ultima_sessao.values('created_at')[:1]),
+            )
+            .order_by('-created_at')
+        )
     
     def perform_create(self, serializer):
         usuario = Usuario.objects.get(user=self.request.user)
         serializer.save(usuario=usuario)
     
+    def perform_update(self, serializer):
+        processo = serializer.save()
+        KermartinCacheManager().invalidate_processo_cache(processo.id)
+    
+    def perform_destroy(self, instance):
+        processo_id = instance.id
+        instance.delete()
+        KermartinCacheManager().invalidate_processo_cache(processo_id)
+    
     @action(detail=True, methods=['get'])
     def documentos(self, request, pk=None):
         """Lista documentos do processo"""
         processo = self.get_object()
-        documentos = processo.documentos.all()
-        serializer = DocumentoSerializer(documentos, many=True)
+        documentos = documentos_para_listagem(processo.documentos.all())
+        serializer = DocumentoListSerializer(documentos, many=True)
         return Response(serializer.data)
     
     @action(detail=True, methods=['get'])
     def analises(self, request, pk=None):
         """Lista análises do processo"""
         processo = self.get_object()
-        sessoes = processo.sessoes_analise.all().order_by('-created_at')
+        sessoes = sessoes_para_listagem(processo.sessoes_analise.all()).order_by('-created_at')
         serializer = SessaoAnaliseSerializer(sessoes, many=True)
         return Response(serializer.data)
 
@@ -87,14 +144,27 @@ class DocumentoViewSet(viewsets.ModelViewSet):
     parser_classes = [MultiPartParser, FormParser]
     
     def get_queryset(self):
-        usuario = Usuario.objects.get(user=self.request.user)
-        return Documento.objects.filter(processo__usuario=usuario)
+        queryset = Documento.objects.filter(processo__usuario__user=self.request.user)
+        if self.action == 'list':
+            return documentos_para_listagem(queryset)
+        return queryset.select_related('processo').with_text()
     
     def get_serializer_class(self):
         if self.action == 'create':
             return DocumentoUploadSerializer
+        if self.action == 'list':
+            return DocumentoListSerializer
         return DocumentoSerializer
     
+    def perform_update(self, serializer):
+        documento = serializer.save()
+        KermartinCacheManager().invalidate_document_cache(documento.id)
+    
+    def perform_destroy(self, instance):
+        documento_id = instance.id
+        instance.delete()
+        KermartinCacheManager().invalidate_document_cache(documento_id)
+    
     def create(self, request, *args, **kwargs):
         """Upload de documento com processamento"""
         
@@ -124,16 +194,20 @@ class DocumentoViewSet(viewsets.ModelViewSet):
             
             # Processar documento em background
             try:
-                processor = DocumentProcessor()
-                texto_extraido = processor.extract_text_from_pdf(documento.arquivo_original.path)
-                
-                documento.texto_extraido = texto_extraido
                 # Tamanho e hash para auditoria e deduplicação
                 documento.tamanho_arquivo = documento.arquivo_original.size
                 hasher = hashlib.sha256()
                 for chunk in documento.arquivo_original.chunks():
                     hasher.update(chunk)
                 documento.hash_arquivo = hasher.hexdigest()
+                
+                # Reuploads do mesmo arquivo reaproveitam a extração armazenada
+                processor = DocumentProcessor()
+                extracao = processor.process_document(
+                    documento.arquivo_original.path,
+                    file_hash=documento.hash_arquivo
+                )
+                documento.texto_extraido = extracao['texto']
                 documento.save()
                 
                 logger.info(f"Documento processado: {documento.nome_arquivo}")
@@ -156,8 +230,9 @@ class AnaliseViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     
     def get_queryset(self):
-        usuario = Usuario.objects.get(user=self.request.user)
-        return SessaoAnalise.objects.filter(processo__usuario=usuario)
+        return sessoes_para_listagem(
+            SessaoAnalise.objects.filter(processo__usuario__user=self.request.user)
+        )
     
     @action(detail=False, methods=['post'])
     def iniciar(self, request):
@@ -180,13 +255,17 @@ class AnaliseViewSet(viewsets.ModelViewSet):
             
             # Buscar processo
             usuario = Usuario.objects.get(user=request.user)
+            
+            # Orçamento mensal de tokens (totais correntes, sem varrer a razão)
+            get_token_ledger().check_budget(usuario)
+            
             processo = Processo.objects.get(
                 id=data['processo_id'],
                 usuario=usuario
             )
             
             # Verificar se há documentos
-            documentos = processo.documentos.filter(texto_extraido__isnull=False)
+            documentos = processo.documentos.processados()
             if not documentos.exists():
                 return Response(
                     {'error': 'Processo não possui documentos processados'},
@@ -206,7 +285,7 @@ class AnaliseViewSet(viewsets.ModelViewSet):
             
             if data['modo_analise'] == 'individual':
                 # Análise individual
-                documento = documentos.first()
+                documento = documentos.with_text().first()
                 resultado = processor.analyze_document(
                     documento, 
                     data['bloco'], 
@@ -224,7 +303,7 @@ class AnaliseViewSet(viewsets.ModelViewSet):
                 # Análise completa ou personalizada
                 blocos = data.get('blocos_selecionados', [1, 2, 3, 4])
                 resultado = processor.analyze_complete_process(
-                    list(documentos), 
+                    list(documentos.with_text()), 
                     sessao, 
                     blocos
                 )
@@ -242,6 +321,11 @@ class AnaliseViewSet(viewsets.ModelViewSet):
                 {'error': 'Processo não encontrado'},
                 status=status.HTTP_404_NOT_FOUND
             )
+        except BudgetExceeded as e:
+            return Response(
+                {'error': str(e), 'consumo': e.consumo},
+                status=status.HTTP_429_TOO_MANY_REQUESTS
+            )
         except SecurityError as e:
             return Response(
                 {'error': f'Erro de segurança: {e}'},
@@ -261,11 +345,17 @@ class AnaliseViewSet(viewsets.ModelViewSet):
     
     @action(detail=True, methods=['get'])
     def resultados(self, request, pk=None):
-        """Lista resultados de uma análise"""
+        """Lista resultados de uma análise, paginados por cursor na ordem de criação"""
         sessao = self.get_object()
-        resultados = sessao.resultados.all().order_by('bloco', 'subetapa')
-        serializer = ResultadoAnaliseSerializer(resultados, many=True)
-        return Response(serializer.data)
+        resultados = (
+            sessao.resultados.select_related('documento')
+            .with_text('resposta_ia')
+            .only(*RESULTADO_LISTAGEM_CAMPOS)
+        )
+        paginator = ChronologicalCursorPagination()
+        page = paginator.paginate_queryset(resultados, request, view=self)
+        serializer = ResultadoAnaliseSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
     
     @action(detail=True, methods=['get'])
     def resumo(self, request, pk=None):
@@ -360,70 +450,131 @@ class EstatisticasViewSet(viewsets.ViewSet):
         
         usuario = Usuario.objects.get(user=request.user)
         
-        # Contadores básicos
-        total_processos = Processo.objects.filter(usuario=usuario).count()
-        total_documentos = Documento.objects.filter(processo__usuario=usuario).count()
-        total_analises = SessaoAnalise.objects.filter(processo__usuario=usuario).count()
+        # Totais pré-agregados (MetricaRollup): número fixo de consultas,
+        # recalculados quando passam de METRICS_ROLLUP_USER_MAX_AGE_SEC
+        totais = get_user_totals(usuario.id)
+        distribuicoes = totais.distribuicoes
         
-        # Tokens utilizados
-        tokens_utilizados = ResultadoAnalise.objects.filter(
-            sessao__processo__usuario=usuario
-        ).aggregate(total=Sum('tokens_total'))['total'] or 0
+        tempo_total_str = (
+            str(timedelta(seconds=totais.sessoes_tempo_seg)) if totais.sessoes_tempo_seg else "0:00:00"
+        )
+        media_tempo = totais.tempo_processamento_seg / totais.resultados if totais.resultados else 0
         
-        # Tempo total de análises
-        tempo_total = SessaoAnalise.objects.filter(
-            processo__usuario=usuario,
-            tempo_total__isnull=False
-        ).aggregate(total=Sum('tempo_total'))['total']
+        estatisticas = {
+            'total_processos': totais.processos,
+            'total_documentos': totais.documentos,
+            'total_analises': totais.sessoes,
+            'tokens_utilizados': totais.tokens_total,
+            'tempo_total_analises': tempo_total_str,
+            'processos_por_status': distribuicoes.get('status', {}),
+            'analises_por_bloco': distribuicoes.get('bloco', {}),
+            'documentos_por_tipo': distribuicoes.get('tipo_documento', {}),
+            'ultima_atividade': totais.ultima_atividade,
+            'media_tempo_analise': round(media_tempo, 2)
+        }
         
-        tempo_total_str = str(tempo_total) if tempo_total else "0:00:00"
+        serializer = EstatisticasSerializer(estatisticas)
+        return Response(serializer.data)
+    
+    @action(detail=False, methods=['get'])
+    def consumo(self, request):
+        """Consumo de tokens e custo do mês e orçamento restante (?processo_id= para um processo)"""
         
-        # Distribuições
-        processos_por_status = dict(
-            Processo.objects.filter(usuario=usuario)
-            .values('status')
-            .annotate(count=Count('id'))
-            .values_list('status', 'count')
-        )
+        usuario = Usuario.objects.get(user=request.user)
+        ledger = get_token_ledger()
         
-        analises_por_bloco = dict(
-            ResultadoAnalise.objects.filter(sessao__processo__usuario=usuario)
-            .values('bloco')
-            .annotate(count=Count('id'))
-            .values_list('bloco', 'count')
-        )
+        processo_id = request.query_params.get('processo_id')
+        if processo_id:
+            if not Processo.objects.filter(id=processo_id, usuario=usuario).exists():
+                return Response(
+                    {'error': 'Processo não encontrado'},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            return Response({'processo_id': processo_id, **ledger.process_totals(processo_id)})
         
-        documentos_por_tipo = dict(
-            Documento.objects.filter(processo__usuario=usuario)
-            .values('tipo_documento')
-            .annotate(count=Count('id'))
-            .values_list('tipo_documento', 'count')
-        )
+        return Response(ledger.budget(usuario))
+    
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def cache(self, request):
+        """Estatísticas do cache por namespace (somente administradores)"""
         
-        # Última atividade
-        ultima_atividade = SessaoAnalise.objects.filter(
-            processo__usuario=usuario
-        ).order_by('-created_at').first()
+        return Response(KermartinMetrics().get_cache_metrics())
+
+
+class PerfilViewSet(viewsets.ViewSet):
+    """Perfis de requisições lentas e análises longas (somente staff, ver core.profiling)"""
+    
+    permission_classes = [IsAdminUser]
+    
+    def list(self, request):
+        """Perfis mais recentes do buffer, com as funções mais amostradas"""
         
-        ultima_atividade_data = ultima_atividade.created_at if ultima_atividade else None
+        try:
+            limit = int(request.query_params.get('limit', 50))
+        except (TypeError, ValueError):
+            limit = 50
+        limit = max(1, min(limit, 200))
+        return Response(get_profiler().store.list(limit))
+    
+    def retrieve(self, request, pk=None):
+        """Perfil completo; ?formato=collapsed devolve as pilhas para flamegraph/speedscope"""
         
-        # Média de tempo
-        media_tempo = ResultadoAnalise.objects.filter(
-            sessao__processo__usuario=usuario
-        ).aggregate(media=Avg('tempo_processamento'))['media'] or 0
+        perfil = get_profiler().store.get(pk)
+        if perfil is None:
+            return Response(
+                {'error': 'Perfil não encontrado'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        if request.query_params.get('formato') == 'collapsed':
+            return HttpResponse(perfil['collapsed'], content_type='text/plain; charset=utf-8')
+        return Response(perfil)
+
+
+class LogSegurancaViewSet(viewsets.ReadOnlyModelViewSet):
+    """Logs de segurança (somente staff), filtráveis por ?tipo_evento= e ?ip="""
+    
+    serializer_class = LogSegurancaSerializer
+    permission_classes = [IsAdminUser]
+    pagination_class = CreatedAtCursorPagination
+    
+    def get_queryset(self):
+        queryset = LogSeguranca.objects.all()
+        tipo_evento = self.request.query_params.get('tipo_evento')
+        ip = self.request.query_params.get('ip')
+        if tipo_evento:
+            queryset = queryset.filter(tipo_evento=tipo_evento)
+        if ip:
+            queryset = queryset.filter(ip_address=ip)
+        return queryset
+
+
+class MetricsView(View):
+    """
+    Métricas no formato de texto do Prometheus (/metrics)
+    
+    Acesso com `Authorization: Bearer <METRICS_AUTH_TOKEN>` ou a partir dos
+    endereços em METRICS_ALLOWED_IPS (REMOTE_ADDR, não X-Forwarded-For).
+    """
+    
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+    
+    def get(self, request):
+        if not self._allowed(request):
+            return HttpResponse('Acesso negado\n', status=403, content_type='text/plain; charset=utf-8')
         
-        estatisticas = {
-            'total_processos': total_processos,
-            'total_documentos': total_documentos,
-            'total_analises': total_analises,
-            'tokens_utilizados': tokens_utilizados,
-            'tempo_total_analises': tempo_total_str,
-            'processos_por_status': processos_por_status,
-            'analises_por_bloco': analises_por_bloco,
-            'documentos_por_tipo': documentos_por_tipo,
-            'ultima_atividade': ultima_atividade_data,
-            'media_tempo_analise': round(media_tempo, 2)
-        }
+        try:
+            body = get_metrics_registry().render()
+        except Exception as e:
+            logger.error(f"Erro ao expor métricas: {e}")
+            return HttpResponse(f"# erro: {e}\n", status=500, content_type=self.CONTENT_TYPE)
         
-        serializer = EstatisticasSerializer(estatisticas)
-        return Response(serializer.data)
+        return HttpResponse(body, content_type=self.CONTENT_TYPE)
+    
+    def _allowed(self, request) -> bool:
+        kermartin_settings = settings.KERMARTIN_SETTINGS
+        token = kermartin_settings.get('METRICS_AUTH_TOKEN', '')
+        if token:
+            auth = request.META.get('HTTP_AUTHORIZATION', '')
+            if hmac.compare_digest(auth.encode(), f"Bearer {token}".encode()):
+                return True
+        return request.META.get('REMOTE_ADDR') in kermartin_settings.get('METRICS_ALLOWED_IPS', ())
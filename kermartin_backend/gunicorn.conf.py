@@ -0,0 +1,16 @@
+"""
+Configuração do gunicorn para Kermartin 3.0 (carregada do diretório atual)
+"""
+
+import os
+import glob
+
+
+def on_starting(server):
+    """Esvazia o diretório de métricas dos workers de uma execução anterior"""
+    directory = os.getenv('METRICS_MULTIPROC_DIR', os.getenv('PROMETHEUS_MULTIPROC_DIR', ''))
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
@@ -1,8 +1,9 @@
 from django.contrib import admin
+from core.admin import DeferredTextAdminMixin
 from .models import Jurisprudencia
 
 @admin.register(Jurisprudencia)
-class JurisprudenciaAdmin(admin.ModelAdmin):
+class JurisprudenciaAdmin(DeferredTextAdminMixin, admin.ModelAdmin):
     list_display = ("titulo", "tribunal", "data_julgamento", "tema")
     list_filter = ("tribunal", "tema")
     search_fields = ("titulo", "ementa", "fundamentacao", "teses_defensivas")
@@ -1,13 +1,17 @@
+import time
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from ai_engine.processor import OpenAI
 from juris.models import Jurisprudencia, JurisEmbedding
+from core.token_ledger import get_token_ledger, record_usage, usage_from_response
 
 
 def embed_texts(client: OpenAI, texts: list[str]) -> list[list[float]]:
     # Usa API de embeddings padrão text-embedding-3-small (ou config via env depois)
     model = getattr(settings, 'OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
+    started = time.perf_counter()
     resp = client.embeddings.create(model=model, input=texts)
+    record_usage('embedding', model, latencia=time.perf_counter() - started, **usage_from_response(resp.usage))
     return [d.embedding for d in resp.data]
 
 
@@ -23,31 +27,35 @@ class Command(BaseCommand):
         reindex = options['reindex']
 
         client = OpenAI(api_key=settings.OPENAI_API_KEY)
-        qs = Jurisprudencia.objects.all()
-        count = qs.count()
+        # Pendências decididas no banco (sem hasattr por registro) e só ids em memória
+        pendentes = Jurisprudencia.objects.order_by('id')
+        if not reindex:
+            pendentes = pendentes.filter(embedding__isnull=True)
+        ids = list(pendentes.values_list('id', flat=True))
+        count = len(ids)
         self.stdout.write(self.style.NOTICE(f"Indexando {count} registros (batch={batch_size})"))
 
         done = 0
         for offset in range(0, count, batch_size):
-            chunk = list(qs[offset:offset+batch_size])
+            # Textos carregados só para o lote atual
+            chunk = list(
+                Jurisprudencia.objects.with_text()
+                .filter(id__in=ids[offset:offset+batch_size])
+                .only('id', 'titulo', 'ementa', 'fundamentacao')
+                .order_by('id')
+            )
             texts = []
             for j in chunk:
-                if (not reindex) and hasattr(j, 'embedding'):
-                    continue
                 text = (j.titulo or '') + "\n" + (j.ementa or '') + "\n" + (j.fundamentacao or '')
                 texts.append(text[:8000])  # segurança no tamanho
             if not texts:
                 continue
             embs = embed_texts(client, texts)
-            idx = 0
-            for j in chunk:
-                if (not reindex) and hasattr(j, 'embedding'):
-                    continue
-                vec = embs[idx]
-                idx += 1
+            for j, vec in zip(chunk, embs):
                 JurisEmbedding.objects.update_or_create(
                     jurisprudencia=j, defaults={'embedding': vec, 'dim': len(vec)}
                 )
                 done += 1
+        get_token_ledger().writer.flush()
         self.stdout.write(self.style.SUCCESS(f"Embeddings indexados/atualizados: {done}"))
 
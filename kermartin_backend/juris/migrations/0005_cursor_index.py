@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('juris', '0004_jurisprudencia_bloco_jurisprudencia_fase'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='jurisprudencia',
+            index=models.Index(fields=['-criado_em', '-id'], name='juris_cursor_idx'),
+        ),
+    ]
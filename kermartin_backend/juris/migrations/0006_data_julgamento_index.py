@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('juris', '0005_cursor_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='jurisprudencia',
+            index=models.Index(fields=['-data_julgamento', '-id'], name='juris_data_julgamento_idx'),
+        ),
+    ]
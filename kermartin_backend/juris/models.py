@@ -1,4 +1,5 @@
 from django.db import models
+from core.managers import DeferredTextManager, DeferredTextQuerySet
 
 
 class Jurisprudencia(models.Model):
@@ -17,8 +18,18 @@ class Jurisprudencia(models.Model):
     bloco = models.IntegerField(blank=True, null=True)
     criado_em = models.DateTimeField(auto_now_add=True)
 
+    # Ementa e fundamentação só com .with_text() (busca textual, embeddings, detalhe)
+    LARGE_TEXT_FIELDS = ('ementa', 'fundamentacao')
+    objects = DeferredTextManager.from_queryset(DeferredTextQuerySet)()
+
     class Meta:
         ordering = ['-data_julgamento', '-id']
+        indexes = [
+            # Listagem por cursor (core.pagination.JurisprudenciaCursorPagination)
+            models.Index(fields=['-criado_em', '-id'], name='juris_cursor_idx'),
+            # Ordem padrão (Meta.ordering) nas sugestões e na busca sem consulta
+            models.Index(fields=['-data_julgamento', '-id'], name='juris_data_julgamento_idx'),
+        ]
         verbose_name = 'Jurisprudência'
         verbose_name_plural = 'Jurisprudências'
 
@@ -10,3 +10,10 @@ class JurisprudenciaSerializer(serializers.ModelSerializer):
             'pontos_estrategicos', 'teses_defensivas', 'tema', 'link', 'vinculante', 'dispositivos_citados', 'fase', 'bloco', 'criado_em'
         )
 
+
+
+class JurisprudenciaListSerializer(JurisprudenciaSerializer):
+    """Listagem: sem a fundamentação, disponível no detalhe"""
+
+    class Meta(JurisprudenciaSerializer.Meta):
+        fields = tuple(field for field in JurisprudenciaSerializer.Meta.fields if field != 'fundamentacao')
@@ -6,8 +6,9 @@ from django.db import transaction
 import csv
 from io import TextIOWrapper
 from datetime import datetime
+from core.pagination import JurisprudenciaCursorPagination
 from .models import Jurisprudencia
-from .serializers import JurisprudenciaSerializer
+from .serializers import JurisprudenciaSerializer, JurisprudenciaListSerializer
 
 
 class JurisprudenciaViewSet(mixins.ListModelMixin,
@@ -16,9 +17,13 @@ class JurisprudenciaViewSet(mixins.ListModelMixin,
                             viewsets.GenericViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = JurisprudenciaSerializer
+    pagination_class = JurisprudenciaCursorPagination
 
     def get_queryset(self):
-        qs = Jurisprudencia.objects.all()
+        if self.action == 'list':
+            qs = Jurisprudencia.objects.with_text('ementa')
+        else:
+            qs = Jurisprudencia.objects.with_text()
         tema = self.request.query_params.get('tema')
         tribunal = self.request.query_params.get('tribunal')
         if tema:
@@ -27,6 +32,11 @@ class JurisprudenciaViewSet(mixins.ListModelMixin,
             qs = qs.filter(tribunal__icontains=tribunal)
         return qs
 
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return JurisprudenciaListSerializer
+        return JurisprudenciaSerializer
+
     @action(detail=False, methods=["post"], url_path="import")
     def import_csv(self, request):
         """Importa jurisprudência via CSV.
@@ -0,0 +1,12 @@
+"""
+ASGI config for Kermartin 3.0 project.
+Necessário para as views assíncronas (AsyncOpenAI) do ai_engine.
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kermartin_project.settings')
+
+application = get_asgi_application()
@@ -54,9 +54,8 @@ INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
-    'kermartin_backend.core.middleware.SecurityMiddleware',
+    'kermartin_backend.core.middleware.KermartinMiddleware',
     'kermartin_backend.core.middleware.RateLimitMiddleware',
-    'kermartin_backend.core.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,7 +63,6 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'kermartin_backend.core.middleware.CORSMiddleware',
 ]
 
 ROOT_URLCONF = 'kermartin_backend.kermartin_project.urls'
@@ -86,6 +84,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'kermartin_backend.kermartin_project.wsgi.application'
+ASGI_APPLICATION = 'kermartin_backend.kermartin_project.asgi.application'
 
 # Database
 DATABASES = {
@@ -181,6 +180,19 @@ OPENAI_API_KEY = config('OPENAI_API_KEY', default='')
 OPENAI_MODEL = config('OPENAI_MODEL', default='gpt-4-1106-preview')
 OPENAI_MAX_TOKENS = config('OPENAI_MAX_TOKENS', default=4000, cast=int)
 
+# Preços em USD por 1M de tokens: (entrada, entrada em cache, saída).
+# Modelos com sufixo de versão (ex.: gpt-4o-2024-08-06) usam o prefixo mais longo
+OPENAI_PRICING = {
+    'gpt-4-1106-preview': (10.00, 10.00, 30.00),
+    'gpt-4-turbo': (10.00, 10.00, 30.00),
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4.1': (2.00, 0.50, 8.00),
+    'gpt-4.1-mini': (0.40, 0.10, 1.60),
+    'text-embedding-3-small': (0.02, 0.02, 0.0),
+    'text-embedding-3-large': (0.13, 0.13, 0.0),
+}
+
 # Redis Configuration
 REDIS_URL = config('REDIS_URL', default='redis://localhost:6379/0')
 
@@ -189,6 +201,10 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.redis.RedisCache',
         'LOCATION': REDIS_URL,
+        'OPTIONS': {
+            # Envelope compacto/comprimido no lugar do pickle puro
+            'serializer': 'ai_engine.cache_serializer.KermartinCacheSerializer',
+        }
     }
 }
 
@@ -238,7 +254,8 @@ SECURE_CONTENT_TYPE_NOSNIFF = True
 X_FRAME_OPTIONS = 'DENY'
 
 # File Upload Settings
-FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
+# Uploads acima de 2.5MB vão para arquivo temporário em disco (TemporaryFileUploadHandler)
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 
 # Configurações específicas para produção
@@ -254,6 +271,7 @@ if not DEBUG:
             'LOCATION': config('REDIS_URL', default='redis://localhost:6379/1'),
             'OPTIONS': {
                 'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                'SERIALIZER': 'ai_engine.cache_serializer.KermartinCacheSerializer',
             }
         }
     }
@@ -268,17 +286,91 @@ if not DEBUG:
 
 # Kermartin Specific Settings
 KERMARTIN_SETTINGS = {
-    'MAX_DOCUMENT_SIZE': 10 * 1024 * 1024,  # 10MB
+    'MAX_DOCUMENT_SIZE': int(os.getenv('MAX_DOCUMENT_SIZE', 300 * 1024 * 1024)),  # 300MB
+    # Acima deste tamanho o PDF é extraído em modo documento grande (páginas em disco)
+    'LARGE_DOCUMENT_THRESHOLD': int(os.getenv('LARGE_DOCUMENT_THRESHOLD', 10 * 1024 * 1024)),
+    'LARGE_DOCUMENT_PREVIEW_CHARS': int(os.getenv('LARGE_DOCUMENT_PREVIEW_CHARS', 20000)),
     'ALLOWED_FILE_TYPES': ['pdf'],
     'ANALYSIS_TIMEOUT': 300,  # 5 minutes
     'CACHE_ANALYSIS_RESULTS': True,
     'CACHE_TIMEOUT': 3600,  # 1 hour
+    # Cache em dois níveis: L1 em memória do processo na frente do Redis
+    'L1_CACHE_MAX_ENTRIES': int(os.getenv('L1_CACHE_MAX_ENTRIES', 1024)),
+    'L1_CACHE_TTL_SEC': float(os.getenv('L1_CACHE_TTL_SEC', 5.0)),
+    'CACHE_LOCK_TIMEOUT_SEC': int(os.getenv('CACHE_LOCK_TIMEOUT_SEC', 30)),
+    'CACHE_EARLY_REFRESH_BETA': float(os.getenv('CACHE_EARLY_REFRESH_BETA', 1.0)),
+    # Estatísticas de cache: contadores locais somados no Redis a cada N segundos
+    'CACHE_STATS_FLUSH_SEC': float(os.getenv('CACHE_STATS_FLUSH_SEC', 10.0)),
+    # Sem o KermartinCacheSerializer, o tamanho das escritas é amostrado 1 a cada N (pickle extra)
+    'CACHE_STATS_SIZE_SAMPLE_EVERY': int(os.getenv('CACHE_STATS_SIZE_SAMPLE_EVERY', 20)),
+    # Serialização do cache: compressão (zstd, ou zlib) a partir deste tamanho
+    'CACHE_COMPRESS_MIN_BYTES': int(os.getenv('CACHE_COMPRESS_MIN_BYTES', 1024)),
+    'CACHE_ZSTD_LEVEL': int(os.getenv('CACHE_ZSTD_LEVEL', 3)),
+    'CACHE_ZLIB_LEVEL': int(os.getenv('CACHE_ZLIB_LEVEL', 6)),
+    # Eventos de segurança: gravados em lote por uma thread (fila limitada)
+    'SECURITY_EVENT_ASYNC': config('SECURITY_EVENT_ASYNC', default=True, cast=bool),
+    'SECURITY_EVENT_BATCH_SIZE': int(os.getenv('SECURITY_EVENT_BATCH_SIZE', 100)),
+    'SECURITY_EVENT_FLUSH_MS': int(os.getenv('SECURITY_EVENT_FLUSH_MS', 500)),
+    'SECURITY_EVENT_QUEUE_MAX': int(os.getenv('SECURITY_EVENT_QUEUE_MAX', 10000)),
+    # IPs bloqueados: resultados e faixas CIDR em memória do processo por N segundos
+    'BLOCKLIST_LOCAL_TTL_SEC': float(os.getenv('BLOCKLIST_LOCAL_TTL_SEC', 5.0)),
+    'BLOCKLIST_LOCAL_MAX_ENTRIES': int(os.getenv('BLOCKLIST_LOCAL_MAX_ENTRIES', 10000)),
+    # Métricas agregadas (MetricaRollup): janelas recalculadas e idade máxima aceita
+    'METRICS_ROLLUP_HOURS': int(os.getenv('METRICS_ROLLUP_HOURS', 48)),
+    'METRICS_ROLLUP_DAYS': int(os.getenv('METRICS_ROLLUP_DAYS', 35)),
+    'METRICS_ROLLUP_MAX_AGE_SEC': int(os.getenv('METRICS_ROLLUP_MAX_AGE_SEC', 600)),
+    'METRICS_ROLLUP_USER_MAX_AGE_SEC': int(os.getenv('METRICS_ROLLUP_USER_MAX_AGE_SEC', 60)),
+    # /metrics (Prometheus): valores de cada worker gravados neste diretório a cada N segundos
+    'METRICS_MULTIPROC_DIR': os.getenv('METRICS_MULTIPROC_DIR', os.getenv('PROMETHEUS_MULTIPROC_DIR', '')),
+    'METRICS_FLUSH_SEC': float(os.getenv('METRICS_FLUSH_SEC', 5.0)),
+    'METRICS_AUTH_TOKEN': os.getenv('METRICS_AUTH_TOKEN', ''),
+    'METRICS_ALLOWED_IPS': [ip.strip() for ip in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()],
+    'SLOW_REQUEST_SEC': float(os.getenv('SLOW_REQUEST_SEC', 2.0)),
+    # Caminho rápido do KermartinMiddleware (além de STATIC_URL e MEDIA_URL): sem trace, métricas nem verificações
+    'MIDDLEWARE_SKIP_PREFIXES': [
+        p.strip() for p in os.getenv(
+            'MIDDLEWARE_SKIP_PREFIXES', '/health,/favicon.ico,/api/ai/infra/health/,/api/ai/jurisprudencia/health/'
+        ).split(',') if p.strip()
+    ],
+    # Rastreamento por etapas (core.tracing): spans em JSONL no formato OTLP
+    'TRACING_ENABLED': config('TRACING_ENABLED', default=False, cast=bool),
+    'TRACING_SAMPLE_RATE': float(os.getenv('TRACING_SAMPLE_RATE', 1.0)),
+    'TRACING_EXPORT_PATH': os.getenv('TRACING_EXPORT_PATH', ''),  # default: logs/traces.jsonl
+    'TRACING_QUEUE_MAX': int(os.getenv('TRACING_QUEUE_MAX', 10000)),
+    # Razão de tokens (core.token_ledger): gravação em lote e orçamento mensal padrão (0 = sem limite)
+    'TOKEN_LEDGER_ASYNC': config('TOKEN_LEDGER_ASYNC', default=True, cast=bool),
+    'TOKEN_LEDGER_BATCH_SIZE': int(os.getenv('TOKEN_LEDGER_BATCH_SIZE', 100)),
+    'TOKEN_LEDGER_FLUSH_MS': int(os.getenv('TOKEN_LEDGER_FLUSH_MS', 1000)),
+    'TOKEN_LEDGER_QUEUE_MAX': int(os.getenv('TOKEN_LEDGER_QUEUE_MAX', 10000)),
+    'TOKEN_BUDGET_MONTHLY_TOKENS': int(os.getenv('TOKEN_BUDGET_MONTHLY_TOKENS', 0)),
+    'TOKEN_BUDGET_MONTHLY_USD': float(os.getenv('TOKEN_BUDGET_MONTHLY_USD', 0)),
+    # Profiler por amostragem (core.profiling): pilhas de requisições lentas e análises acima de ANALYSIS_TIMEOUT
+    'PROFILING_ENABLED': config('PROFILING_ENABLED', default=False, cast=bool),
+    'PROFILING_SAMPLE_RATE': float(os.getenv('PROFILING_SAMPLE_RATE', 0.05)),
+    'PROFILING_ANALYSIS_SAMPLE_RATE': float(os.getenv('PROFILING_ANALYSIS_SAMPLE_RATE', 1.0)),
+    'PROFILING_INTERVAL_MS': float(os.getenv('PROFILING_INTERVAL_MS', 5)),
+    'PROFILING_DIR': os.getenv('PROFILING_DIR', ''),  # default: logs/profiles
+    'PROFILING_MAX_FILES': int(os.getenv('PROFILING_MAX_FILES', 200)),
+    # Análise completa: resultados gravados em lote (upsert) e progresso da sessão no máximo a cada N segundos
+    'RESULT_WRITE_BATCH_SIZE': int(os.getenv('RESULT_WRITE_BATCH_SIZE', 25)),
+    'SESSION_PROGRESS_SAVE_SEC': float(os.getenv('SESSION_PROGRESS_SAVE_SEC', 2.0)),
     'SECURITY_MAX_CONTENT_LENGTH': int(os.getenv('SECURITY_MAX_CONTENT_LENGTH', 300000)),  # chars
+    # Extrações endereçadas por SHA-256 do PDF (default: MEDIA_ROOT/extracoes)
+    'EXTRACTION_STORE_DIR': os.getenv('EXTRACTION_STORE_DIR', ''),
+    # Extração de PDF por página: processos paralelos e fallback pdfplumber
+    'PDF_EXTRACTION_WORKERS': int(os.getenv('PDF_EXTRACTION_WORKERS', min(4, os.cpu_count() or 1))),
+    'PDF_PARALLEL_MIN_PAGES': int(os.getenv('PDF_PARALLEL_MIN_PAGES', 24)),
+    'PDF_MIN_PAGE_CHARS': int(os.getenv('PDF_MIN_PAGE_CHARS', 20)),
     'CHUNK_SIZE_CHARS': int(os.getenv('CHUNK_SIZE_CHARS', 12000)),
     'CHUNK_OVERLAP_CHARS': int(os.getenv('CHUNK_OVERLAP_CHARS', 800)),
     'OPENAI_RETRY_MAX_ATTEMPTS': int(os.getenv('OPENAI_RETRY_MAX_ATTEMPTS', 6)),
     'OPENAI_RETRY_BASE_DELAY_SEC': float(os.getenv('OPENAI_RETRY_BASE_DELAY_SEC', 1.5)),
     'OPENAI_CHUNK_SLEEP_SEC': float(os.getenv('OPENAI_CHUNK_SLEEP_SEC', 0.25)),
+    # Caminho assíncrono (AsyncOpenAI): chamadas simultâneas por processo
+    'OPENAI_ASYNC_MAX_CONCURRENCY': int(os.getenv('OPENAI_ASYNC_MAX_CONCURRENCY', 64)),
+    'ANALYSIS_WORKER_POLL_SEC': float(os.getenv('ANALYSIS_WORKER_POLL_SEC', 2.0)),
+    # Sessões em_progresso sem heartbeat (updated_at) há N segundos são retomadas por outro worker
+    'ANALYSIS_WORKER_LEASE_SEC': float(os.getenv('ANALYSIS_WORKER_LEASE_SEC', 300)),
 }
 
 # Rate limiting strategy
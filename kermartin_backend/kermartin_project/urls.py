@@ -11,6 +11,7 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 from django.views.generic import RedirectView
+from core.views import MetricsView
 
 urlpatterns = [
     # Admin
@@ -30,6 +31,9 @@ urlpatterns = [
     # AI Engine
     path('api/ai/', include('ai_engine.urls')),
 
+    # Métricas (Prometheus)
+    path('metrics', MetricsView.as_view(), name='metrics'),
+
     # Web UI
     path('', include('webui.urls')),
 
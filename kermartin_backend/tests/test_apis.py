@@ -3,13 +3,15 @@ Testes para APIs do Kermartin 3.0
 """
 
 import json
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from django.urls import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
-from core.models import Usuario, Processo, Documento
+from core.models import Usuario, Processo, Documento, SessaoAnalise, ResultadoAnalise, LogSeguranca
 
 
 class TestAuthenticationAPI(APITestCase):
@@ -327,3 +329,154 @@ class TestSecurityAPI(APITestCase):
         response = self.client.get(url)
         
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TestListagemConsultas(APITestCase):
+    """Testes para o número de consultas das listagens (sem N+1)"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="lista@kermartin.com",
+            email="lista@kermartin.com",
+            password="senha123"
+        )
+        self.usuario = Usuario.objects.create(
+            user=self.user,
+            nome_completo="Dr. Lista",
+            oab_numero="654321",
+            oab_estado="SP"
+        )
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+
+    def criar_processos(self, quantidade):
+        for i in range(quantidade):
+            processo = Processo.objects.create(usuario=self.usuario, titulo=f"Processo {i}")
+            documento = Documento.objects.create(
+                processo=processo,
+                nome_arquivo=f"doc{i}.pdf",
+                tipo_documento="inquerito",
+                texto_extraido="Texto extraído" if i % 2 else ""
+            )
+            sessao = SessaoAnalise.objects.create(processo=processo, modo_analise='individual')
+            ResultadoAnalise.objects.create(
+                sessao=sessao, documento=documento, bloco=1, subetapa=1,
+                prompt_usado="prompt", resposta_ia="resposta"
+            )
+
+    def contar_consultas(self, url):
+        with CaptureQueriesContext(connection) as consultas:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(consultas), response
+
+    def test_consultas_constantes(self):
+        """Testa que as listagens fazem o mesmo número de consultas para 3 e 15 processos"""
+        urls = [
+            reverse('core:processo-list'),
+            reverse('core:documento-list'),
+            reverse('core:analise-list'),
+        ]
+        self.criar_processos(3)
+        poucos = [self.contar_consultas(url)[0] for url in urls]
+
+        self.criar_processos(12)
+        muitos = [self.contar_consultas(url)[0] for url in urls]
+        self.assertEqual(poucos, muitos)
+
+    def test_campos_anotados(self):
+        """Testa totais e última análise anotados e a listagem de documentos sem o texto"""
+        self.criar_processos(2)
+
+        _, response = self.contar_consultas(reverse('core:processo-list'))
+        processo = response.data['results'][0]
+        self.assertEqual(processo['total_documentos'], 1)
+        self.assertEqual(processo['ultima_analise']['modo'], dict(SessaoAnalise.MODO_CHOICES)['individual'])
+
+        _, response = self.contar_consultas(reverse('core:documento-list'))
+        documentos = {d['nome_arquivo']: d for d in response.data['results']}
+        self.assertNotIn('texto_extraido', documentos['doc0.pdf'])
+        self.assertFalse(documentos['doc0.pdf']['tem_texto_extraido'])
+        self.assertTrue(documentos['doc1.pdf']['tem_texto_extraido'])
+
+        _, response = self.contar_consultas(reverse('core:analise-list'))
+        self.assertEqual(response.data['results'][0]['total_resultados'], 1)
+
+
+class TestPaginacaoCursor(APITestCase):
+    """Testes para a paginação por cursor das listagens grandes"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="cursor@kermartin.com",
+            email="cursor@kermartin.com",
+            password="senha123"
+        )
+        self.usuario = Usuario.objects.create(
+            user=self.user,
+            nome_completo="Dr. Cursor",
+            oab_numero="112233",
+            oab_estado="SP"
+        )
+        self.client.force_authenticate(self.user)
+
+    def percorrer(self, url):
+        """Segue os links `next` e devolve os ids e as consultas de cada página"""
+        ids, consultas = [], []
+        while url:
+            with CaptureQueriesContext(connection) as capturadas:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            ids.extend(item['id'] for item in response.data['results'])
+            consultas.append(len(capturadas))
+            url = response.data['next']
+        return ids, consultas
+
+    def test_processos_por_cursor(self):
+        """Testa percurso completo, sem repetição, com custo igual em todas as páginas"""
+        processos = [
+            Processo.objects.create(usuario=self.usuario, titulo=f"Processo {i}")
+            for i in range(25)
+        ]
+
+        ids, consultas = self.percorrer(reverse('core:processo-list') + '?page_size=10')
+
+        self.assertEqual(len(ids), 25)
+        self.assertEqual(set(ids), {str(p.id) for p in processos})
+        self.assertEqual(ids[0], str(processos[-1].id))
+        self.assertEqual(len(consultas), 3)
+        self.assertEqual(len(set(consultas)), 1)
+
+    def test_resultados_na_ordem_da_analise(self):
+        """Testa resultados da sessão paginados na ordem de criação"""
+        processo = Processo.objects.create(usuario=self.usuario, titulo="Processo Resultados")
+        documento = Documento.objects.create(
+            processo=processo, nome_arquivo="doc.pdf", tipo_documento="inquerito"
+        )
+        sessao = SessaoAnalise.objects.create(processo=processo, modo_analise='completa')
+        for subetapa in range(1, 6):
+            ResultadoAnalise.objects.create(
+                sessao=sessao, documento=documento, bloco=1, subetapa=subetapa,
+                prompt_usado="prompt", resposta_ia=f"resposta {subetapa}"
+            )
+
+        response = self.client.get(reverse('core:analise-resultados', args=[sessao.id]), {'page_size': 3})
+        self.assertEqual([r['subetapa'] for r in response.data['results']], [1, 2, 3])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([r['subetapa'] for r in response.data['results']], [4, 5])
+        self.assertIsNone(response.data['next'])
+
+    def test_logs_de_seguranca_somente_staff(self):
+        """Testa listagem dos logs de segurança restrita a staff e filtrada por tipo"""
+        for tipo in ['login_falha', 'login_falha', 'acesso_negado']:
+            LogSeguranca.objects.create(tipo_evento=tipo, descricao="evento", ip_address="10.0.0.1")
+        url = reverse('core:log-seguranca-list')
+
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        ids, _ = self.percorrer(url + '?tipo_evento=login_falha')
+        self.assertEqual(len(ids), 2)
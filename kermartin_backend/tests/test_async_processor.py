@@ -0,0 +1,264 @@
+"""
+Testes para o processador assíncrono do Kermartin 3.0
+"""
+
+import asyncio
+import threading
+from datetime import timedelta
+from unittest.mock import patch
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.utils import timezone
+from core.models import Usuario, Processo, Documento, SessaoAnalise, ResultadoAnalise
+from core.buffered_writer import BulkUpsertBuffer, ThrottledSave
+from ai_engine.processor import KermartinProcessor, RESULT_UNIQUE_FIELDS, RESULT_UPDATE_FIELDS
+from ai_engine.async_processor import AsyncKermartinProcessor
+from ai_engine.management.commands.run_analysis_worker import Command as WorkerCommand
+
+
+KERMARTIN_TEST_SETTINGS = {
+    **settings.KERMARTIN_SETTINGS,
+    'OPENAI_ASYNC_MAX_CONCURRENCY': 2,
+    'CHUNK_SIZE_CHARS': 200,
+    'CHUNK_OVERLAP_CHARS': 20,
+}
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    KERMARTIN_SETTINGS=KERMARTIN_TEST_SETTINGS,
+)
+class TestAsyncKermartinProcessor(TestCase):
+    """Testes do caminho AsyncOpenAI"""
+
+    def setUp(self):
+        user = User.objects.create_user(username="async@kermartin.com", password="senha123")
+        usuario = Usuario.objects.create(
+            user=user, nome_completo="Dr. Async", oab_numero="654321", oab_estado="SP"
+        )
+        self.processo = Processo.objects.create(usuario=usuario, titulo="Processo Async")
+        self.documento = Documento.objects.create(
+            processo=self.processo,
+            nome_arquivo="inquerito.pdf",
+            tipo_documento="inquerito",
+            texto_extraido="Depoimento da testemunha sobre os fatos. " * 30
+        )
+        self.em_voo = 0
+        self.pico = 0
+
+    async def _fake_call(self, prompt):
+        self.em_voo += 1
+        self.pico = max(self.pico, self.em_voo)
+        await asyncio.sleep(0.01)
+        self.em_voo -= 1
+        return {'content': 'ok', 'tokens_prompt': 10, 'tokens_response': 5, 'tokens_total': 15}
+
+    def test_analise_completa_concorrente_respeita_semaforo(self):
+        """Chunks e subetapas rodam em paralelo, limitados pelo semáforo"""
+        sessao = SessaoAnalise.objects.create(processo=self.processo, modo_analise='completa')
+        processor = AsyncKermartinProcessor()
+
+        with patch.object(AsyncKermartinProcessor, '_acall_openai', side_effect=self._fake_call):
+            resultado = async_to_sync(processor.aanalyze_complete_process)(
+                [self.documento], sessao, [1]
+            )
+
+        self.assertEqual(resultado['status'], 'concluida')
+        self.assertEqual(len(resultado['resultados']['bloco_1'][f'documento_{self.documento.id}']), 6)
+        self.assertEqual(ResultadoAnalise.objects.filter(sessao=sessao).count(), 6)
+        self.assertEqual(self.pico, 2)
+
+        sessao.refresh_from_db()
+        self.assertEqual(sessao.status, 'concluida')
+
+    def test_validacao_e_leitura_fora_do_event_loop(self):
+        """Validação do documento e leitura dos chunks não rodam na thread do event loop"""
+        sessao = SessaoAnalise.objects.create(processo=self.processo, modo_analise='individual')
+        processor = AsyncKermartinProcessor()
+        threads = {}
+        validar = processor._validate_document
+        proximos = processor._next_prompts
+
+        def registrar(nome, func):
+            def wrapper(*args, **kwargs):
+                threads.setdefault(nome, threading.get_ident())
+                return func(*args, **kwargs)
+            return wrapper
+
+        async def analisar():
+            threads['loop'] = threading.get_ident()
+            return await processor.aanalyze_document(self.documento, 1, 1, sessao)
+
+        with patch.object(processor, '_validate_document', registrar('validacao', validar)), \
+                patch.object(processor, '_next_prompts', registrar('chunks', proximos)), \
+                patch.object(AsyncKermartinProcessor, '_acall_openai', side_effect=self._fake_call):
+            async_to_sync(analisar)()
+
+        self.assertNotEqual(threads['validacao'], threads['loop'])
+        self.assertNotEqual(threads['chunks'], threads['loop'])
+
+    def test_retry_em_rate_limit(self):
+        """Erros 429 são repetidos com backoff assíncrono"""
+        sessao = SessaoAnalise.objects.create(processo=self.processo, modo_analise='individual')
+        processor = AsyncKermartinProcessor()
+        chamadas = []
+
+        async def flaky(prompt):
+            chamadas.append(prompt)
+            if len(chamadas) == 1:
+                raise Exception("Error code: 429 - rate_limit_exceeded")
+            return await self._fake_call(prompt)
+
+        with patch.object(AsyncKermartinProcessor, '_acall_openai', side_effect=flaky), \
+                patch.object(AsyncKermartinProcessor, '_retry_delay', return_value=0):
+            resultado = async_to_sync(processor.aanalyze_document)(self.documento, 1, 1, sessao)
+
+        self.assertGreater(len(chamadas), 1)
+        self.assertEqual(resultado['bloco'], 1)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    KERMARTIN_SETTINGS={
+        **KERMARTIN_TEST_SETTINGS,
+        'RESULT_WRITE_BATCH_SIZE': 25,
+        'SESSION_PROGRESS_SAVE_SEC': 3600,
+    },
+)
+class TestGravacaoEmLote(TestCase):
+    """Testes dos resultados em upsert de lote e do progresso espaçado"""
+
+    def setUp(self):
+        user = User.objects.create_user(username="lote@kermartin.com", password="senha123")
+        usuario = Usuario.objects.create(
+            user=user, nome_completo="Dr. Lote", oab_numero="112233", oab_estado="SP"
+        )
+        self.processo = Processo.objects.create(usuario=usuario, titulo="Processo Lote")
+        self.documentos = [
+            Documento.objects.create(
+                processo=self.processo,
+                nome_arquivo=f"peca_{n}.pdf",
+                tipo_documento="inquerito",
+                texto_extraido=f"Peça {n}: depoimento da testemunha."
+            )
+            for n in range(2)
+        ]
+
+    def _escritas(self, queries, tabela):
+        return [
+            q['sql'] for q in queries
+            if f'"{tabela}"' in q['sql'] and q['sql'].startswith(('INSERT', 'UPDATE'))
+        ]
+
+    def test_upsert_atualiza_e_deduplica(self):
+        """Mesma chave no lote vira uma linha; chave já gravada é atualizada"""
+        sessao = SessaoAnalise.objects.create(processo=self.processo)
+        documento = self.documentos[0]
+        buffer = BulkUpsertBuffer(ResultadoAnalise, RESULT_UNIQUE_FIELDS, RESULT_UPDATE_FIELDS, batch_size=10)
+
+        buffer.add(sessao=sessao, documento=documento, bloco=1, subetapa=1, resposta_ia='primeira')
+        buffer.add(sessao=sessao, documento=documento, bloco=1, subetapa=1, resposta_ia='segunda')
+        self.assertEqual(len(buffer), 1)
+        self.assertEqual(buffer.flush(), 1)
+
+        buffer.add(sessao=sessao, documento=documento, bloco=1, subetapa=1, resposta_ia='terceira', tokens_total=7)
+        buffer.add(sessao=sessao, documento=documento, bloco=1, subetapa=2, resposta_ia='outra')
+        buffer.flush()
+
+        self.assertEqual(ResultadoAnalise.objects.filter(sessao=sessao).count(), 2)
+        resultado = ResultadoAnalise.objects.with_text().get(sessao=sessao, subetapa=1)
+        self.assertEqual((resultado.resposta_ia, resultado.tokens_total), ('terceira', 7))
+        self.assertEqual(buffer.written, 3)
+
+    def test_progresso_espacado(self):
+        """Progresso só é gravado depois do intervalo, com update_fields"""
+        sessao = SessaoAnalise.objects.create(processo=self.processo)
+        progresso = ThrottledSave(sessao, ['bloco_atual', 'subetapa_atual'], interval=3600)
+
+        self.assertFalse(progresso.set(bloco_atual=2, subetapa_atual=3))
+        self.assertTrue(progresso.dirty)
+        self.assertEqual(SessaoAnalise.objects.get(id=sessao.id).bloco_atual, 1)
+
+        progresso.interval = 0
+        self.assertTrue(progresso.set(bloco_atual=2, subetapa_atual=4))
+        with CaptureQueriesContext(connection) as ctx:
+            progresso.save()
+        self.assertIn('"subetapa_atual"', ctx.captured_queries[0]['sql'])
+        self.assertNotIn('"status"', ctx.captured_queries[0]['sql'])
+        self.assertEqual(SessaoAnalise.objects.get(id=sessao.id).subetapa_atual, 4)
+        self.assertFalse(progresso.dirty)
+
+    def test_analise_completa_grava_em_lote(self):
+        """Doze resultados num INSERT; sessão gravada só no início e no fim"""
+        sessao = SessaoAnalise.objects.create(processo=self.processo, modo_analise='completa')
+        with patch('ai_engine.processor.OpenAI'):
+            processor = KermartinProcessor()
+        resposta = {'content': 'ok', 'tokens_prompt': 10, 'tokens_response': 5, 'tokens_total': 15}
+
+        with patch.object(KermartinProcessor, '_call_openai', return_value=resposta), \
+                CaptureQueriesContext(connection) as ctx:
+            resultado = processor.analyze_complete_process(self.documentos, sessao, [1])
+
+        self.assertEqual(resultado['status'], 'concluida')
+        self.assertEqual(ResultadoAnalise.objects.filter(sessao=sessao).count(), 12)
+        self.assertEqual(len(self._escritas(ctx.captured_queries, 'resultados_analise')), 1)
+        self.assertEqual(len(self._escritas(ctx.captured_queries, 'sessoes_analise')), 2)
+
+        sessao.refresh_from_db()
+        self.assertEqual((sessao.status, sessao.bloco_atual, sessao.subetapa_atual), ('concluida', 1, 6))
+
+    def test_analise_assincrona_grava_em_lote(self):
+        """No caminho assíncrono os resultados das tarefas vão para o mesmo buffer"""
+        sessao = SessaoAnalise.objects.create(processo=self.processo, modo_analise='completa')
+        processor = AsyncKermartinProcessor()
+
+        async def fake_call(prompt):
+            return {'content': 'ok', 'tokens_prompt': 10, 'tokens_response': 5, 'tokens_total': 15}
+
+        with patch.object(AsyncKermartinProcessor, '_acall_openai', side_effect=fake_call), \
+                CaptureQueriesContext(connection) as ctx:
+            async_to_sync(processor.aanalyze_complete_process)(self.documentos, sessao, [1])
+
+        self.assertEqual(ResultadoAnalise.objects.filter(sessao=sessao).count(), 12)
+        self.assertEqual(len(self._escritas(ctx.captured_queries, 'resultados_analise')), 1)
+
+
+class TestWorkerLease(TestCase):
+    """Testes da reserva de sessões do run_analysis_worker"""
+
+    def setUp(self):
+        user = User.objects.create_user(username="worker@kermartin.com", password="senha123")
+        usuario = Usuario.objects.create(
+            user=user, nome_completo="Dr. Worker", oab_numero="778899", oab_estado="SP"
+        )
+        self.processo = Processo.objects.create(usuario=usuario, titulo="Processo Worker")
+
+    def _sessao(self, status, idade_seg=0):
+        sessao = SessaoAnalise.objects.create(
+            processo=self.processo, modo_analise='completa', status=status,
+            configuracoes={'execucao': 'worker'}
+        )
+        SessaoAnalise.objects.filter(id=sessao.id).update(
+            updated_at=timezone.now() - timedelta(seconds=idade_seg)
+        )
+        return sessao
+
+    def test_reserva_carimba_e_retoma_sessoes_sem_heartbeat(self):
+        """Pendentes e em_progresso além do lease são reservadas; as vivas não"""
+        pendente = self._sessao('iniciada', idade_seg=30)
+        abandonada = self._sessao('em_progresso', idade_seg=3600)
+        viva = self._sessao('em_progresso', idade_seg=10)
+
+        reservadas = WorkerCommand()._claim_sessions(10)
+
+        self.assertEqual({s.id for s in reservadas}, {pendente.id, abandonada.id})
+        for sessao in reservadas:
+            self.assertEqual(sessao.status, 'em_progresso')
+            self.assertLess((timezone.now() - sessao.updated_at).total_seconds(), 5)
+        # Lease renovado: outro worker não reserva de novo
+        self.assertEqual(WorkerCommand()._claim_sessions(10), [])
+        self.assertEqual(SessaoAnalise.objects.get(id=viva.id).status, 'em_progresso')
@@ -0,0 +1,306 @@
+"""
+Testes para o cache do Kermartin 3.0
+"""
+
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import nullcontext
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from django.contrib.auth.models import User
+from core.models import Usuario, Processo, Documento, SessaoAnalise
+from ai_engine.cache_manager import KermartinCacheManager
+from ai_engine.processor import KermartinProcessor
+from ai_engine.tiered_cache import TieredCache
+from ai_engine.cache_stats import InstrumentedCache, get_cache_stats, namespace_for
+from ai_engine.cache_serializer import KermartinCacheSerializer, MAGIC
+from ai_engine.security import CONTENT_SCANNER
+from core.metrics import KermartinMetrics
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestInvalidacaoPorTags(TestCase):
+    """Testes da invalidação por geração de tags"""
+
+    def setUp(self):
+        cache.clear()
+        self.manager = KermartinCacheManager()
+
+    def test_invalidar_documento_remove_analises_com_hash(self):
+        """Análises gravadas com content_hash somem ao invalidar o documento"""
+        tags = self.manager.tags_for(documento_id='d1', processo_id='p1', user_id=7)
+        self.manager.cache_analysis_result('d1', 1, 2, {'ok': True}, content_hash='abc', tags=tags)
+
+        self.assertEqual(self.manager.get_cached_analysis('d1', 1, 2, 'abc', tags=tags), {'ok': True})
+
+        self.manager.invalidate_document_cache('d1')
+
+        self.assertIsNone(self.manager.get_cached_analysis('d1', 1, 2, 'abc', tags=tags))
+
+    def test_invalidar_uma_tag_preserva_as_demais(self):
+        """Invalidar um processo não afeta entradas de outros processos"""
+        tags_p1 = self.manager.tags_for(documento_id='d1', processo_id='p1')
+        tags_p2 = self.manager.tags_for(documento_id='d2', processo_id='p2')
+        self.manager.set_tagged('chave_1', 1, tags_p1)
+        self.manager.set_tagged('chave_2', 2, tags_p2)
+
+        self.manager.invalidate_processo_cache('p1')
+
+        self.assertIsNone(self.manager.get_tagged('chave_1', tags_p1))
+        self.assertEqual(self.manager.get_tagged('chave_2', tags_p2), 2)
+
+    def test_geracao_despejada_nao_ressuscita_entradas(self):
+        """Se a geração some do cache, a nova semente é maior que a anterior"""
+        tags = self.manager.tags_for(user_id=7)
+        self.manager.set_tagged('estatisticas', {'total': 1}, tags)
+        self.manager.invalidate_user_cache(7)
+        self.manager.invalidate_user_cache(7)
+        anterior = self.manager.get_tag_generations(tags)[0]
+
+        self.manager.cache.delete(self.manager._generation_key(tags[0]))
+
+        self.assertGreater(self.manager.get_tag_generations(tags)[0], anterior)
+        self.assertIsNone(self.manager.get_tagged('estatisticas', tags))
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    KERMARTIN_SETTINGS={**settings.KERMARTIN_SETTINGS, 'OPENAI_CHUNK_SLEEP_SEC': 0},
+)
+class TestCacheDoProcessador(TestCase):
+    """O processador usa o gerenciador de cache com tags"""
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="cache@kermartin.com", password="senha123")
+        usuario = Usuario.objects.create(
+            user=user, nome_completo="Dr. Cache", oab_numero="111222", oab_estado="MG"
+        )
+        self.processo = Processo.objects.create(usuario=usuario, titulo="Processo Cache")
+        self.documento = Documento.objects.create(
+            processo=self.processo,
+            nome_arquivo="denuncia.pdf",
+            tipo_documento="denuncia",
+            texto_extraido="Denúncia oferecida pelo Ministério Público."
+        )
+        self.sessao = SessaoAnalise.objects.create(processo=self.processo, modo_analise='individual')
+        with patch('ai_engine.processor.OpenAI'):
+            self.processor = KermartinProcessor()
+
+    def test_invalidar_processo_forca_nova_chamada(self):
+        """Resultado vem do cache até o processo ser invalidado"""
+        resposta = {'content': 'ok', 'tokens_prompt': 10, 'tokens_response': 5, 'tokens_total': 15}
+
+        with patch.object(KermartinProcessor, '_call_openai', return_value=resposta) as chamada:
+            self.processor.analyze_document(self.documento, 1, 1, self.sessao)
+            self.processor.analyze_document(self.documento, 1, 1, self.sessao)
+            self.assertEqual(chamada.call_count, 1)
+
+            KermartinCacheManager().invalidate_processo_cache(self.processo.id)
+            self.processor.analyze_document(self.documento, 1, 1, self.sessao)
+
+        self.assertEqual(chamada.call_count, 2)
+
+    def test_documento_validado_uma_vez(self):
+        """O texto é varrido uma vez para todas as subetapas"""
+        resposta = {'content': 'ok', 'tokens_prompt': 10, 'tokens_response': 5, 'tokens_total': 15}
+
+        with patch.object(KermartinProcessor, '_call_openai', return_value=resposta), \
+                patch.object(CONTENT_SCANNER, 'scan', wraps=CONTENT_SCANNER.scan) as scan:
+            for subetapa in range(1, 7):
+                self.processor.analyze_document(self.documento, 1, subetapa, self.sessao)
+
+        self.assertEqual(scan.call_count, 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestCacheEmDoisNiveis(TestCase):
+    """Testes do L1 local, single-flight e renovação antecipada"""
+
+    def setUp(self):
+        cache.clear()
+        self.tiered = TieredCache(max_entries=2, ttl=60)
+
+    def test_l1_evita_ida_ao_backend(self):
+        """Leituras repetidas são servidas pelo L1, limitado em entradas"""
+        self.tiered.set('a', 1, timeout=60)
+
+        with patch.object(cache, 'get', side_effect=AssertionError('backend consultado')):
+            self.assertEqual(self.tiered.get('a'), 1)
+
+        self.tiered.set('b', 2, timeout=60)
+        self.tiered.set('c', 3, timeout=60)
+        self.assertEqual(len(self.tiered.local._data), 2)
+        self.assertEqual(self.tiered.get('a'), 1)  # despejada do L1, ainda no backend
+
+    def test_single_flight_calcula_uma_vez(self):
+        """Falhas simultâneas na mesma chave disparam um único cálculo"""
+        calculos = []
+
+        def calcular():
+            calculos.append(1)
+            time.sleep(0.1)
+            return {'total': 42}
+
+        resultados = []
+        threads = [
+            threading.Thread(target=lambda: resultados.append(self.tiered.get_or_set('visao', calcular, 60)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calculos), 1)
+        self.assertEqual(resultados, [{'total': 42}] * 8)
+
+    def test_renovacao_antecipada_serve_valor_atual(self):
+        """Com outro processo renovando, o chamador recebe o valor antigo sem esperar"""
+        self.tiered.get_or_set('visao', lambda: 'antigo', 60)
+        cache.add('visao_lock', 1, timeout=30)  # renovação em andamento em outro processo
+
+        with patch.object(TieredCache, '_should_refresh', return_value=True):
+            valor = self.tiered.get_or_set('visao', lambda: 'novo', 60)
+
+        self.assertEqual(valor, 'antigo')
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    KERMARTIN_SETTINGS={**settings.KERMARTIN_SETTINGS, 'CACHE_STATS_FLUSH_SEC': 3600},
+)
+class TestEstatisticasDeCache(TestCase):
+    """Testes da instrumentação do cache por namespace"""
+
+    def setUp(self):
+        cache.clear()
+        self.stats = get_cache_stats()
+        self.tiered = TieredCache(max_entries=1, ttl=60)
+
+    def test_namespaces_das_chaves(self):
+        """Chaves do sistema caem no namespace esperado"""
+        manager = KermartinCacheManager()
+
+        self.assertEqual(namespace_for(manager.get_analysis_cache_key('d1', 1, 1)), 'analysis')
+        self.assertEqual(namespace_for(manager.get_document_cache_key('d1', 'full_analysis')), 'doc')
+        self.assertEqual(namespace_for(manager.get_user_cache_key('7', 'statistics')), 'user')
+        self.assertEqual(namespace_for('kermartin_system_overview_g1'), 'metrics')
+        self.assertEqual(namespace_for('rate_limit_user_7_analysis'), 'rate_limit')
+        self.assertEqual(namespace_for(manager._generation_key('documento:d1')), 'tags')
+
+    def test_contagens_agregadas(self):
+        """Acertos L1/Redis, faltas, escritas e despejos são somados por namespace"""
+        doc_key = 'kermartin_3_0_doc_d1_full_analysis'
+        user_key = 'kermartin_3_0_user_7_statistics'
+
+        self.tiered.get(doc_key)                    # falta
+        self.tiered.set(doc_key, {'a': 1}, 60)      # escrita
+        self.tiered.get(doc_key)                    # acerto L1
+        self.tiered.set(user_key, {'b': 2}, 60)     # escrita; despeja doc_key do L1
+        self.tiered.get(doc_key)                    # acerto Redis
+
+        snapshot = self.stats.snapshot()
+        doc = snapshot['doc']
+
+        self.assertEqual((doc['misses'], doc['hits_l1'], doc['hits'], doc['sets']), (1, 1, 1, 1))
+        self.assertEqual(doc['evictions'], 1)
+        self.assertGreater(doc['bytes_written'], 0)
+        self.assertEqual(sum(doc['latency_ms']['get'].values()), 2)
+        self.assertEqual(snapshot['user']['sets'], 1)
+        self.assertEqual(doc['hit_rate'], 66.67)
+        self.assertEqual(KermartinMetrics()._estimate_cache_hit_rate(), 66.67)
+
+
+    def test_bytes_gravados_vem_do_serializador(self):
+        """Com o KermartinCacheSerializer, conta os bytes que ele produziu, sem pickle extra"""
+        serializer = KermartinCacheSerializer()
+        gravados = {}
+
+        class Backend:
+            def set(self, key, value, timeout=None):
+                gravados[key] = serializer.dumps(value)
+
+        instrumentado = InstrumentedCache(backend=Backend(), stats=self.stats)
+        resultado = {'resposta': "A testemunha afirmou que estava no local. " * 200}
+        antes = self.stats.snapshot()['analysis']['bytes_written']
+
+        with patch('ai_engine.cache_stats.pickle.dumps') as pickle_dumps:
+            instrumentado.set('kermartin_analysis_d1_1_1', resultado, 60)
+
+        pickle_dumps.assert_not_called()
+        depois = self.stats.snapshot()['analysis']['bytes_written']
+        self.assertEqual(depois - antes, len(gravados['kermartin_analysis_d1_1_1']))
+
+
+class TestSerializadorDeCache(TestCase):
+    """Testes do envelope versionado e comprimido do cache"""
+
+    def setUp(self):
+        self.serializer = KermartinCacheSerializer()
+
+    def test_analise_grande_comprimida(self):
+        """Resultados com respostas longas ocupam bem menos que o pickle"""
+        resultado = {
+            'bloco': 1,
+            'subetapa': 2,
+            'resposta': "[Parte 1/3]\nA testemunha afirmou que estava no local. " * 400,
+            'tokens_total': 1234,
+            'tempo_processamento': 3.5,
+        }
+
+        dados = self.serializer.dumps(resultado)
+
+        self.assertTrue(dados.startswith(MAGIC))
+        self.assertLess(len(dados) * 5, len(pickle.dumps(resultado, pickle.HIGHEST_PROTOCOL)))
+        self.assertEqual(self.serializer.loads(dados), resultado)
+
+    def test_inteiros_sem_envelope_e_fallback_pickle(self):
+        """Inteiros seguem crus (INCR); tipos não suportados usam pickle"""
+        self.assertEqual(self.serializer.dumps(42), 42)
+        self.assertEqual(self.serializer.loads(b'42'), 42)
+
+        bloqueados = {'10.0.0.1', '10.0.0.2'}
+        self.assertEqual(self.serializer.loads(self.serializer.dumps(bloqueados)), bloqueados)
+
+    def test_orjson_so_para_tipos_nativos(self):
+        """Sem msgpack, datetime e UUID caem para pickle em vez de voltarem como texto"""
+        valores = {
+            'quando': timezone.now(),
+            'id': uuid.uuid4(),
+            'dados': {'tokens': [1, 2], 'ok': True},
+        }
+        with patch('ai_engine.cache_serializer.msgpack', None):
+            for valor in valores.values():
+                self.assertEqual(self.serializer.loads(self.serializer.dumps(valor)), valor)
+            self.assertEqual(self.serializer.dumps(valores['dados'])[len(MAGIC) + 1:len(MAGIC) + 2], b'j')
+
+    def test_subclasses_e_tuplas_mantem_o_tipo(self):
+        """SafeString, OrderedDict e tuplas caem para pickle em vez de virarem str/dict/list"""
+        valores = [
+            mark_safe('<b>Réu</b>'),
+            OrderedDict([('b', 1), ('a', 2)]),
+            {'pagina': (1, 2)},
+        ]
+        for codec in ('msgpack', 'orjson'):
+            with patch('ai_engine.cache_serializer.msgpack', None) if codec == 'orjson' else nullcontext():
+                for valor in valores:
+                    lido = self.serializer.loads(self.serializer.dumps(valor))
+                    self.assertEqual(lido, valor)
+                    self.assertIs(type(lido), type(valor))
+                self.assertIsInstance(lido['pagina'], tuple)
+
+    def test_entradas_antigas_e_versoes_desconhecidas(self):
+        """Pickle anterior ao envelope é lido; versão futura vira falta"""
+        antigo = pickle.dumps({'stats': {'total': 3}})
+        self.assertEqual(self.serializer.loads(antigo), {'stats': {'total': 3}})
+
+        futuro = MAGIC + bytes([99]) + b'p0' + pickle.dumps('x')
+        self.assertIsNone(self.serializer.loads(futuro))
@@ -0,0 +1,212 @@
+"""
+Testes para o processador de documentos do Kermartin 3.0
+"""
+
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+import fitz
+from django.conf import settings
+from django.test import TestCase, override_settings
+from ai_engine.document_processor import DocumentProcessor
+from ai_engine.chunking import iter_chunks, make_chunks
+
+
+def criar_pdf(path, paginas):
+    """Gera um PDF simples com uma string por página"""
+    doc = fitz.open()
+    for texto in paginas:
+        page = doc.new_page()
+        y = 72
+        for linha in texto.split('\n'):
+            page.insert_text((72, y), linha)
+            y += 14
+    doc.save(path)
+    doc.close()
+
+
+class TestExtracaoReaproveitada(TestCase):
+    """Testes do armazenamento de extrações por SHA-256"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pdf_path = os.path.join(self.tmpdir, 'inquerito.pdf')
+        criar_pdf(self.pdf_path, [
+            "Inquérito policial número 123.\nRelatório da autoridade policial.\n"
+            "Depoimento da testemunha em 10/02/2024, art. 121 do Código Penal."
+        ])
+        store_dir = os.path.join(self.tmpdir, 'extracoes')
+        self.override = override_settings(
+            KERMARTIN_SETTINGS={**settings.KERMARTIN_SETTINGS, 'EXTRACTION_STORE_DIR': store_dir}
+        )
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_reupload_nao_reabre_pdf(self):
+        """Segundo processamento do mesmo arquivo vem do armazenamento"""
+        primeira = DocumentProcessor().process_document(self.pdf_path)
+
+        self.assertFalse(primeira['cache_hit'])
+        self.assertIn('inquerito', primeira['estrutura']['tipo_provavel'])
+        self.assertIn('10/02/2024', primeira['informacoes_chave']['datas'])
+
+        with patch.object(DocumentProcessor, 'extract_text_from_pdf') as extract:
+            segunda = DocumentProcessor().process_document(self.pdf_path, file_hash=primeira['hash'])
+
+        extract.assert_not_called()
+        self.assertTrue(segunda['cache_hit'])
+        self.assertEqual(segunda['texto'], primeira['texto'])
+        self.assertEqual(segunda['estrutura'], primeira['estrutura'])
+
+
+class TestExtracaoParalela(TestCase):
+    """Testes da extração por página em processos paralelos"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pdf_path = os.path.join(self.tmpdir, 'processo.pdf')
+        paginas = [f"Folha {n} dos autos do processo criminal." for n in range(1, 7)]
+        paginas[3] = ""  # página sem texto: vai para o fallback pdfplumber
+        criar_pdf(self.pdf_path, paginas)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_paginas_em_ordem_com_pool(self):
+        """Faixas de páginas em processos distintos mantêm a ordem original"""
+        with override_settings(KERMARTIN_SETTINGS={
+            **settings.KERMARTIN_SETTINGS,
+            'PDF_EXTRACTION_WORKERS': 2,
+            'PDF_PARALLEL_MIN_PAGES': 2,
+        }):
+            processor = DocumentProcessor()
+            self.assertEqual(processor._page_ranges(6), [(0, 3), (3, 6)])
+            pages = processor._extract_pages(self.pdf_path)
+
+        self.assertEqual(len(pages), 6)
+        self.assertIn("Folha 1 ", pages[0])
+        self.assertIn("Folha 6 ", pages[5])
+        self.assertEqual(pages[3].strip(), "")
+
+        texto = "".join(processor.iter_clean_pages(pages))
+        self.assertNotIn("--- PÁGINA 4 ---", texto)
+        self.assertLess(texto.index("--- PÁGINA 3 ---"), texto.index("--- PÁGINA 5 ---"))
+
+
+class TestLimpezaTexto(TestCase):
+    """Testes da normalização de texto e do chunker"""
+
+    def test_limpeza_preserva_paragrafos(self):
+        """Controle e espaços somem; linhas e parágrafos permanecem"""
+        bruto = "Relatório\x0c   da   autoridade\r\n  policial.\n\n\n\nDos fatos:\tvítima\x00 ferida."
+        limpo = DocumentProcessor()._clean_text(bruto)
+
+        self.assertEqual(limpo, "Relatório da autoridade\npolicial.\n\nDos fatos: vítima ferida.")
+
+    def test_marcadores_de_pagina(self):
+        """Cada página limpa é gerada com o seu marcador"""
+        paginas = list(DocumentProcessor().iter_clean_pages(["Folha um.", "  ", "Folha três."]))
+
+        self.assertEqual(paginas, [
+            "--- PÁGINA 1 ---\nFolha um.\n\n",
+            "--- PÁGINA 3 ---\nFolha três.\n\n",
+        ])
+
+    def test_chunks_cortam_em_paragrafo(self):
+        """O corte prefere a quebra de parágrafo dentro da janela"""
+        texto = ("a" * 60) + "\n\n" + ("b" * 60)
+        chunks = make_chunks(texto, 100, 10)
+
+        self.assertEqual(chunks[0], ("a" * 60) + "\n\n")
+        self.assertTrue(chunks[1].endswith("b" * 60))
+        self.assertEqual(make_chunks("", 100, 10), [""])
+
+    def test_chunks_em_fluxo_equivalem_ao_texto_inteiro(self):
+        """Alimentar por páginas produz os mesmos chunks que o texto completo"""
+        paginas = [f"--- PÁGINA {n} ---\n" + "Depoimento da testemunha. " * 20 + "\n\n" for n in range(1, 8)]
+
+        em_fluxo = list(iter_chunks(iter(paginas), 500, 50))
+
+        self.assertEqual(em_fluxo, make_chunks("".join(paginas), 500, 50))
+        self.assertTrue(all(len(c) <= 500 for c in em_fluxo))
+
+
+class TestDocumentoGrande(TestCase):
+    """Testes do modo documento grande (páginas gravadas em disco)"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pdf_path = os.path.join(self.tmpdir, 'autos.pdf')
+        paginas = [f"Folha {n} dos autos. Audiência em 0{n}/03/2024." for n in range(1, 6)]
+        criar_pdf(self.pdf_path, paginas)
+        self.override = override_settings(KERMARTIN_SETTINGS={
+            **settings.KERMARTIN_SETTINGS,
+            'EXTRACTION_STORE_DIR': os.path.join(self.tmpdir, 'extracoes'),
+            'LARGE_DOCUMENT_THRESHOLD': 1,
+            'LARGE_DOCUMENT_PREVIEW_CHARS': 60,
+            'CHUNK_SIZE_CHARS': 80,
+            'CHUNK_OVERLAP_CHARS': 10,
+        })
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_paginas_em_disco_alimentam_chunks(self):
+        """Acima do limiar, o texto fica em disco e a análise lê página a página"""
+        from ai_engine.processor import KermartinProcessor
+        from core.models import Documento
+
+        processor = DocumentProcessor()
+        extracao = processor.process_document(self.pdf_path)
+
+        self.assertTrue(extracao['paginas_em_disco'])
+        self.assertEqual(extracao['paginas'], 5)
+        self.assertLessEqual(len(extracao['texto']), 60)
+        self.assertIn('05/03/2024', extracao['informacoes_chave']['datas'])
+
+        paginas = list(processor.iter_document_pages(extracao['texto'], extracao['hash']))
+        self.assertEqual(len(paginas), 5)
+        self.assertTrue(paginas[4].startswith("--- PÁGINA 5 ---"))
+
+        documento = Documento(texto_extraido=extracao['texto'], hash_arquivo=extracao['hash'])
+        with patch('ai_engine.processor.OpenAI'):
+            kermartin = KermartinProcessor()
+        chunks, _, _ = kermartin._iter_text_chunks(documento)
+
+        self.assertEqual(list(chunks), make_chunks("".join(paginas), 80, 10))
+        self.assertTrue(kermartin._validate_document(documento))
+        self.assertEqual(kermartin._content_hash(documento), extracao['hash'][:16])
+
+    def test_extracao_sem_texto_nao_publica_paginas(self):
+        """PDF sem texto suficiente falha sem deixar páginas no armazenamento"""
+        vazio = os.path.join(self.tmpdir, 'vazio.pdf')
+        criar_pdf(vazio, ['x', 'y'])
+        processor = DocumentProcessor()
+
+        with self.assertRaises(ValueError):
+            processor.extract_large_document(vazio, 'a' * 64)
+
+        self.assertFalse(processor.store.has_pages('a' * 64))
+
+    def test_paginas_fracas_numa_so_abertura_do_pdfplumber(self):
+        """Páginas escaneadas do intervalo passam por uma única abertura do pdfplumber"""
+        import pdfplumber
+        from ai_engine.pdf_workers import extract_page_range_to_dir
+
+        misto = os.path.join(self.tmpdir, 'misto.pdf')
+        criar_pdf(misto, ["Termo de depoimento da testemunha.", "", "Auto de prisão em flagrante.", "", ""])
+        saida = os.path.join(self.tmpdir, 'paginas')
+        os.makedirs(saida)
+
+        with patch.object(pdfplumber, 'open', wraps=pdfplumber.open) as abrir:
+            totais = extract_page_range_to_dir(misto, 0, 5, saida, 20)
+
+        self.assertEqual(abrir.call_count, 1)
+        self.assertEqual(totais['pages'], 2)
+        self.assertEqual(sorted(os.listdir(saida)), ['000001.txt', '000003.txt'])
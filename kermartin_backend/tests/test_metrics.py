@@ -0,0 +1,333 @@
+"""
+Testes para métricas agregadas do Kermartin 3.0
+"""
+
+import os
+import json
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from core.models import (
+    Usuario, Processo, Documento, SessaoAnalise, ResultadoAnalise, LogSeguranca, MetricaRollup
+)
+from core.metrics import KermartinMetrics
+from core.metrics_registry import MetricsRegistry, get_metrics_registry
+from core import rollups
+
+
+def criar_usuario(n: int) -> Usuario:
+    user = User.objects.create_user(
+        username=f"user{n}@kermartin.com",
+        email=f"user{n}@kermartin.com",
+        password="senha123"
+    )
+    return Usuario.objects.create(
+        user=user,
+        nome_completo=f"Dr. Usuário {n}",
+        oab_numero=f"{100000 + n}",
+        oab_estado="SP"
+    )
+
+
+def criar_atividade(usuario: Usuario, processos: int = 1) -> None:
+    """Processos com um documento, uma sessão concluída (60s) e um resultado cada"""
+    for i in range(processos):
+        processo = Processo.objects.create(usuario=usuario, titulo=f"Processo {i}", status='analyzing')
+        documento = Documento.objects.create(
+            processo=processo,
+            nome_arquivo="teste.pdf",
+            tipo_documento="inquerito",
+            texto_extraido="Texto extraído",
+            tamanho_arquivo=1024
+        )
+        sessao = SessaoAnalise.objects.create(
+            processo=processo,
+            modo_analise='individual',
+            status='concluida',
+            tempo_total=timedelta(seconds=60)
+        )
+        ResultadoAnalise.objects.create(
+            sessao=sessao,
+            documento=documento,
+            bloco=2,
+            subetapa=1,
+            prompt_usado="prompt",
+            resposta_ia="resposta",
+            tokens_total=100,
+            tempo_processamento=3.0
+        )
+
+
+class TestAgregadosDeMetricas(TestCase):
+    """Testes para os agregados (MetricaRollup)"""
+
+    def setUp(self):
+        self.usuario = criar_usuario(1)
+        self.outro = criar_usuario(2)
+        criar_atividade(self.usuario, processos=2)
+        criar_atividade(self.outro, processos=1)
+        LogSeguranca.objects.create(tipo_evento='login_falha', descricao="Falha", ip_address="10.0.0.1")
+        LogSeguranca.objects.create(tipo_evento='erro_sistema', descricao="Erro", ip_address="10.0.0.2")
+
+    def test_totais_globais_e_por_usuario(self):
+        """Testa totais, somas e distribuições gravados pelo recálculo"""
+        resultado = rollups.refresh_rollups()
+        self.assertEqual(resultado['totais'], 3)  # global + 2 usuários
+
+        totais = MetricaRollup.objects.get(periodo='total', escopo='global')
+        self.assertEqual(totais.usuarios, 2)
+        self.assertEqual(totais.processos, 3)
+        self.assertEqual(totais.documentos_bytes, 3 * 1024)
+        self.assertEqual(totais.sessoes_concluidas, 3)
+        self.assertEqual(totais.sessoes_tempo_seg, 180.0)
+        self.assertEqual(totais.tokens_total, 300)
+        self.assertEqual(totais.eventos_seguranca, 2)
+        self.assertEqual(totais.eventos_erro, 1)
+        self.assertEqual(totais.distribuicoes['status'], {'analyzing': 3})
+        self.assertEqual(totais.distribuicoes['bloco'], {'2': 3})
+        self.assertEqual(totais.distribuicoes['usuarios_ativos_30d'], 2)
+
+        do_usuario = MetricaRollup.objects.get(periodo='total', escopo=str(self.usuario.id))
+        self.assertEqual(do_usuario.processos, 2)
+        self.assertEqual(do_usuario.tokens_total, 200)
+        self.assertIsNotNone(do_usuario.ultima_atividade)
+
+    def test_soma_da_janela_por_hora(self):
+        """Testa soma dos intervalos por hora nas últimas 24h"""
+        rollups.refresh_rollups()
+
+        janela = rollups.sum_period('hora', timezone.now() - timedelta(hours=24))
+        self.assertEqual(janela['resultados'], 3)
+        self.assertEqual(janela['distribuicoes']['tipo_evento'], {'login_falha': 1, 'erro_sistema': 1})
+
+    def test_recalculo_com_consultas_fixas(self):
+        """Testa que o recálculo não cresce com o número de linhas"""
+        with CaptureQueriesContext(connection) as antes:
+            rollups.refresh_rollups()
+
+        for n in range(3, 8):
+            criar_atividade(criar_usuario(n), processos=3)
+
+        with CaptureQueriesContext(connection) as depois:
+            rollups.refresh_rollups()
+
+        self.assertEqual(len(antes), len(depois))
+
+    def test_totais_velhos_sao_recalculados(self):
+        """Testa recálculo inline quando o agregado passa da idade máxima"""
+        totais = rollups.get_user_totals(self.usuario.id)
+        self.assertEqual(totais.processos, 2)
+
+        criar_atividade(self.usuario, processos=1)
+        # Ainda recente: lê o agregado gravado
+        self.assertEqual(rollups.get_user_totals(self.usuario.id).processos, 2)
+
+        MetricaRollup.objects.filter(pk=totais.pk).update(
+            atualizado_em=timezone.now() - timedelta(hours=1)
+        )
+        self.assertEqual(rollups.get_user_totals(self.usuario.id).processos, 3)
+
+    def test_totais_globais_velhos_recalculados_em_segundo_plano(self):
+        """Testa que o agregado velho é servido e só um recálculo é disparado"""
+        rollups.refresh_rollups()
+        criar_atividade(self.usuario, processos=1)
+        MetricaRollup.objects.filter(periodo='total', escopo='global').update(
+            atualizado_em=timezone.now() - timedelta(hours=1)
+        )
+        cache.delete(rollups.REFRESH_LOCK_KEY)
+
+        with patch.object(rollups.threading, 'Thread') as thread, \
+                patch.object(rollups, 'refresh_rollups') as refresh:
+            primeira = rollups.get_global_totals()
+            segunda = rollups.get_global_totals()
+
+        self.assertEqual((primeira.processos, segunda.processos), (3, 3))
+        self.assertEqual(thread.call_count, 1)
+        refresh.assert_not_called()
+        cache.delete(rollups.REFRESH_LOCK_KEY)
+
+    def test_metricas_de_performance(self):
+        """Testa médias calculadas a partir dos totais"""
+        metrics = KermartinMetrics()._build_performance_metrics()
+
+        self.assertEqual(metrics['session_performance']['avg_session_duration'], 60.0)
+        self.assertEqual(metrics['session_performance']['completion_rate'], 100.0)
+        self.assertEqual(metrics['analysis_performance']['avg_tokens_per_analysis'], 100.0)
+        self.assertEqual(metrics['system_health']['error_rate_24h'], 50.0)
+
+    def test_visao_geral_e_seguranca(self):
+        """Testa visão geral e métricas de segurança a partir dos agregados"""
+        metrics = KermartinMetrics()
+        overview = metrics._build_system_overview()
+        security = metrics._build_security_metrics()
+
+        self.assertEqual(overview['users']['new_this_month'], 2)
+        self.assertEqual(overview['documents']['by_type'], {'inquerito': 3})
+        self.assertEqual(security['threat_analysis']['failed_logins'], 1)
+        self.assertEqual(security['events_last_7d']['unique_ips'], 2)
+
+    def test_comando_rollup_metrics(self):
+        """Testa o comando de recálculo"""
+        out = StringIO()
+        call_command('rollup_metrics', stdout=out)
+
+        self.assertIn('Agregados atualizados', out.getvalue())
+        self.assertTrue(MetricaRollup.objects.filter(periodo='dia', escopo='global').exists())
+
+
+class TestDashboardAgregado(APITestCase):
+    """Testes para o dashboard lido dos agregados"""
+
+    def setUp(self):
+        self.usuario = criar_usuario(1)
+        criar_atividade(self.usuario, processos=2)
+
+        refresh = RefreshToken.for_user(self.usuario.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        self.url = reverse('core:estatisticas-dashboard')
+
+    def test_valores_do_dashboard(self):
+        """Testa valores do dashboard a partir dos totais do usuário"""
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_processos'], 2)
+        self.assertEqual(response.data['tokens_utilizados'], 200)
+        self.assertEqual(response.data['tempo_total_analises'], "0:02:00")
+        self.assertEqual(response.data['analises_por_bloco'], {'2': 2})
+        self.assertEqual(response.data['media_tempo_analise'], 3.0)
+
+    def test_consultas_nao_crescem_com_os_dados(self):
+        """Testa que o dashboard faz o mesmo número de consultas com mais dados"""
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as poucos:
+            self.client.get(self.url)
+
+        criar_atividade(self.usuario, processos=10)
+        MetricaRollup.objects.all().delete()
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as muitos:
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.data['total_processos'], 12)
+        self.assertEqual(len(poucos), len(muitos))
+
+
+class TestRegistroDeMetricas(TestCase):
+    """Testes para o registro de métricas (formato Prometheus)"""
+
+    def test_contador_e_histograma(self):
+        """Testa exposição de contador e histograma cumulativo"""
+        registry = MetricsRegistry(multiproc_dir='')
+        registry.counter('req_total', 'Requisições', ('route',)).inc(route='a')
+        histogram = registry.histogram('lat_seconds', 'Latência', ('route',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, route='a')
+        histogram.observe(0.5, route='a')
+        histogram.observe(5.0, route='a')
+
+        text = registry.render()
+        self.assertIn('# TYPE req_total counter', text)
+        self.assertIn('req_total{route="a"} 1.0', text)
+        self.assertIn('lat_seconds_bucket{route="a",le="0.1"} 1', text)
+        self.assertIn('lat_seconds_bucket{route="a",le="1.0"} 2', text)
+        self.assertIn('lat_seconds_bucket{route="a",le="+Inf"} 3', text)
+        self.assertIn('lat_seconds_count{route="a"} 3', text)
+
+    def test_quantis_por_rota(self):
+        """Testa p50/p95/p99 estimados dos buckets"""
+        registry = MetricsRegistry(multiproc_dir='')
+        histogram = registry.histogram('lat_seconds', 'Latência', ('route',), buckets=(0.1, 0.2, 1.0))
+        for _ in range(90):
+            histogram.observe(0.05, route='rapida')
+        for _ in range(10):
+            histogram.observe(0.5, route='rapida')
+
+        resumo = registry.quantiles('lat_seconds', by=('route',))['rapida']
+        self.assertEqual(resumo['count'], 100)
+        self.assertLessEqual(resumo['p50'], 0.1)
+        self.assertGreater(resumo['p95'], 0.2)
+        self.assertLessEqual(resumo['p99'], 1.0)
+
+    def test_soma_entre_processos(self):
+        """Testa soma de contadores entre arquivos de workers e descarte de gauges mortos"""
+        with tempfile.TemporaryDirectory() as directory:
+            registry = MetricsRegistry(multiproc_dir=directory)
+            registry.counter('req_total', 'Requisições', ('route',)).inc(2, route='a')
+            registry.gauge('fila', 'Fila').set(3)
+
+            # Arquivo de outro worker (pid inexistente): contador soma, gauge não
+            outro = {
+                'req_total': {'kind': 'counter', 'help': 'Requisições', 'labelnames': ['route'],
+                              'buckets': [], 'samples': [[['a'], 5.0]]},
+                'fila': {'kind': 'gauge', 'help': 'Fila', 'labelnames': [],
+                         'buckets': [], 'samples': [[[], 7.0]]},
+            }
+            with open(os.path.join(directory, '999999999.json'), 'w') as f:
+                json.dump(outro, f)
+
+            text = registry.render()
+            self.assertIn('req_total{route="a"} 7.0', text)
+            self.assertIn('fila 3.0', text)
+
+
+class TestEndpointDeMetricas(TestCase):
+    """Testes para /metrics e a instrumentação das requisições"""
+
+    def setUp(self):
+        cache.clear()
+        get_metrics_registry().reset()
+
+    def test_metricas_da_requisicao(self):
+        """Testa contador e latência por rota após uma requisição"""
+        self.client.get(reverse('core:estatisticas-dashboard'))
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('text/plain', response['Content-Type'])
+        body = response.content.decode()
+        self.assertIn('kermartin_http_requests_total{method="GET",route="core:estatisticas-dashboard",status="401"} 1.0', body)
+        self.assertIn('kermartin_http_request_duration_seconds_bucket', body)
+        self.assertIn('kermartin_entities{tipo="usuarios"}', body)
+
+    def test_acesso_restrito(self):
+        """Testa bloqueio por IP e acesso por token"""
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.9')
+        self.assertEqual(response.status_code, 403)
+
+        with override_settings(KERMARTIN_SETTINGS={**settings.KERMARTIN_SETTINGS, 'METRICS_AUTH_TOKEN': 'segredo'}):
+            response = self.client.get(
+                '/metrics', REMOTE_ADDR='203.0.113.9', HTTP_AUTHORIZATION='Bearer segredo'
+            )
+        self.assertEqual(response.status_code, 200)
+
+    def test_requisicoes_lentas(self):
+        """Testa contagem de requisições lentas por hora"""
+        with override_settings(KERMARTIN_SETTINGS={**settings.KERMARTIN_SETTINGS, 'SLOW_REQUEST_SEC': 0.0}):
+            self.client.get('/metrics')
+            self.client.get('/metrics')
+
+        self.assertEqual(KermartinMetrics()._get_slow_requests_count(24), 2)
+
+    def test_series_de_uso(self):
+        """Testa usuários ativos por dia e novos usuários a partir dos agregados"""
+        criar_atividade(criar_usuario(1), processos=2)
+        criar_usuario(2)
+
+        analytics = KermartinMetrics().get_usage_analytics()
+        hoje = timezone.localdate().isoformat()
+
+        self.assertEqual(analytics['user_engagement']['daily_active_users'], [{'data': hoje, 'valor': 1}])
+        novos = analytics['growth_metrics']['new_users_trend']
+        self.assertEqual(sum(ponto['valor'] for ponto in novos), 2)
@@ -150,6 +150,31 @@ class TestDocumentoModel(TestCase):
         self.assertEqual(documento.get_tipo_documento_display(), "Inquérito Policial")
         self.assertTrue(documento.texto_extraido)
 
+    def test_indicador_de_texto(self):
+        """Testa tem_texto anotado sem carregar texto_extraido"""
+        Documento.objects.create(
+            processo=self.processo,
+            nome_arquivo="com_texto.pdf",
+            tipo_documento="denuncia",
+            texto_extraido="Texto extraído"
+        )
+        Documento.objects.create(
+            processo=self.processo,
+            nome_arquivo="sem_texto.pdf",
+            tipo_documento="denuncia"
+        )
+        
+        documentos = {d.nome_arquivo: d for d in Documento.objects.with_text_flag()}
+        self.assertTrue(documentos['com_texto.pdf'].tem_texto)
+        self.assertFalse(documentos['sem_texto.pdf'].tem_texto)
+        self.assertIn('texto_extraido', documentos['com_texto.pdf'].get_deferred_fields())
+        
+        # Instância adiada salva só as colunas carregadas, sem apagar o texto
+        documento = documentos['com_texto.pdf']
+        documento.nome_arquivo = "renomeado.pdf"
+        documento.save()
+        self.assertEqual(Documento.objects.with_text().get(id=documento.id).texto_extraido, "Texto extraído")
+
 
 class TestSessaoAnaliseModel(TestCase):
     """Testes para modelo SessaoAnalise"""
@@ -270,6 +295,29 @@ class TestResultadoAnaliseModel(TestCase):
                 resposta_ia="Resposta 2"
             )
 
+    def test_textos_adiados(self):
+        """Testa que prompt e resposta só são lidos com with_text()"""
+        ResultadoAnalise.objects.create(
+            sessao=self.sessao,
+            documento=self.documento,
+            bloco=1,
+            subetapa=1,
+            prompt_usado="Prompt longo",
+            resposta_ia="Resposta longa"
+        )
+        
+        resultado = ResultadoAnalise.objects.get()
+        self.assertEqual(resultado.get_deferred_fields(), {'prompt_usado', 'resposta_ia'})
+        
+        resultado = ResultadoAnalise.objects.with_text('resposta_ia').get()
+        self.assertEqual(resultado.get_deferred_fields(), {'prompt_usado'})
+        with self.assertNumQueries(0):
+            self.assertEqual(resultado.resposta_ia, "Resposta longa")
+        
+        self.assertEqual(ResultadoAnalise.objects.with_text().get().get_deferred_fields(), set())
+        with self.assertRaises(ValueError):
+            ResultadoAnalise.objects.with_text('tokens_total')
+
 
 class TestLogSegurancaModel(TestCase):
     """Testes para modelo LogSeguranca"""
@@ -0,0 +1,122 @@
+"""
+Testes para o profiler por amostragem do Kermartin 3.0
+"""
+
+import time
+import tempfile
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+from rest_framework import status
+from rest_framework.test import APITestCase
+from core.middleware import KermartinMiddleware
+from core.profiling import get_profiler
+
+
+def _ocupado(segundos):
+    fim = time.perf_counter() + segundos
+    total = 0
+    while time.perf_counter() < fim:
+        total += 1
+    return total
+
+
+class ProfilingTestCase(TestCase):
+    """Profiler habilitado, sempre amostrando, com buffer num diretório temporário"""
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(KERMARTIN_SETTINGS={
+            **settings.KERMARTIN_SETTINGS,
+            'PROFILING_ENABLED': True,
+            'PROFILING_SAMPLE_RATE': 1.0,
+            'PROFILING_INTERVAL_MS': 1,
+            'PROFILING_DIR': self.directory.name,
+            'PROFILING_MAX_FILES': 3,
+            'SLOW_REQUEST_SEC': 0.05,
+        })
+        self.settings_override.enable()
+        self.profiler = get_profiler()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+
+class TestProfiler(ProfilingTestCase):
+    """Testes para amostragem, limite e buffer circular"""
+
+    def test_pilhas_collapsed(self):
+        """Testa que a função ocupada aparece no topo das pilhas amostradas"""
+        sessao = self.profiler.start('request', 'GET /teste')
+        _ocupado(0.1)
+        profile_id = self.profiler.stop(sessao, threshold=0.0, rota='teste')
+
+        perfil = self.profiler.store.get(profile_id)
+        self.assertEqual(perfil['rota'], 'teste')
+        self.assertGreater(perfil['amostras'], 5)
+        self.assertEqual(perfil['top'][0]['funcao'], 'tests.test_profiling:_ocupado')
+        linha = perfil['collapsed'].splitlines()[0]
+        self.assertRegex(linha, r'tests\.test_profiling:test_pilhas_collapsed;tests\.test_profiling:_ocupado \d+$')
+
+    def test_abaixo_do_limite_nao_grava(self):
+        """Testa descarte de perfis mais rápidos que o limite"""
+        sessao = self.profiler.start('request', 'GET /rapido')
+        self.assertIsNone(self.profiler.stop(sessao, threshold=60.0))
+        self.assertEqual(self.profiler.store.list(), [])
+
+    def test_uma_sessao_por_thread(self):
+        """Testa que uma análise dentro de uma requisição em perfil não abre outra sessão"""
+        sessao = self.profiler.start('request', 'POST /analise')
+        self.assertIsNone(self.profiler.start('analysis', 'analysis.process'))
+        self.profiler.stop(sessao, threshold=60.0)
+
+    def test_buffer_circular(self):
+        """Testa remoção dos perfis mais antigos além de PROFILING_MAX_FILES"""
+        ids = []
+        for _ in range(5):
+            sessao = self.profiler.start('request', 'GET /teste')
+            _ocupado(0.02)
+            ids.append(self.profiler.stop(sessao, threshold=0.0))
+
+        self.assertEqual([p['id'] for p in self.profiler.store.list()], ids[:1:-1])
+        self.assertIsNone(self.profiler.store.get(ids[0]))
+        self.assertIsNone(self.profiler.store.get('../../etc/passwd'))
+
+    def test_desabilitado(self):
+        """Testa que, desligado, nada é amostrado"""
+        with override_settings(KERMARTIN_SETTINGS={**settings.KERMARTIN_SETTINGS, 'PROFILING_ENABLED': False}):
+            self.assertIsNone(get_profiler().start('request', 'GET /teste'))
+
+
+class TestPerfilDeRequisicao(ProfilingTestCase, APITestCase):
+    """Testes para o perfil anexado a requisições lentas e o endpoint de staff"""
+
+    def test_requisicao_lenta_com_perfil(self):
+        """Testa X-Profile-Id na resposta lenta e acesso restrito a staff"""
+        middleware = KermartinMiddleware(lambda request: HttpResponse(str(_ocupado(0.1))))
+        resposta = middleware(RequestFactory().get('/api/menu/', REMOTE_ADDR='10.1.1.1'))
+        profile_id = resposta['X-Profile-Id']
+
+        user = User.objects.create_user(username='perfil@kermartin.com', password='senha123')
+        self.client.force_authenticate(user)
+        self.assertEqual(self.client.get(f'/api/perfis/{profile_id}/').status_code, status.HTTP_403_FORBIDDEN)
+
+        user.is_staff = True
+        user.save()
+        resposta = self.client.get('/api/perfis/')
+        self.assertEqual(resposta.status_code, status.HTTP_200_OK)
+        perfis = {perfil['id']: perfil for perfil in resposta.data}
+        self.assertEqual(perfis[profile_id]['rotulo'], 'GET /api/menu/')
+        self.assertNotIn('collapsed', perfis[profile_id])
+
+        # limit inválido ou fora da faixa não derruba a listagem
+        self.assertEqual(self.client.get('/api/perfis/', {'limit': 'abc'}).status_code, status.HTTP_200_OK)
+        self.assertEqual(len(self.client.get('/api/perfis/', {'limit': -5}).data), 1)
+
+        resposta = self.client.get(f'/api/perfis/{profile_id}/', {'formato': 'collapsed'})
+        self.assertEqual(resposta['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertIn('tests.test_profiling:_ocupado', resposta.content.decode())
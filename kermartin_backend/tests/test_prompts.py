@@ -4,7 +4,7 @@ Testes para o sistema de prompts do Kermartin 3.0
 
 import pytest
 from django.test import TestCase
-from ai_engine.prompts import get_prompt, get_prompt_title, KERMARTIN_PERSONA
+from ai_engine.prompts import get_prompt, get_prompt_parts, get_prompt_title, KERMARTIN_PERSONA
 
 
 class TestPrompts(TestCase):
@@ -112,6 +112,18 @@ class TestPrompts(TestCase):
                 # Prompt não deve ser excessivamente longo
                 self.assertLess(len(prompt), 10000)
     
+    def test_prompt_parts(self):
+        """Partes do modelo + texto reproduzem o prompt completo"""
+        for bloco in range(1, 5):
+            max_subetapas = 6 if bloco == 1 else 5
+            for subetapa in range(1, max_subetapas + 1):
+                antes, depois = get_prompt_parts(bloco, subetapa)
+                
+                self.assertEqual(
+                    antes + self.documento_teste + depois,
+                    get_prompt(bloco, subetapa, self.documento_teste)
+                )
+    
     def test_prompt_structure(self):
         """Testa estrutura dos prompts"""
         prompt = get_prompt(1, 1, self.documento_teste)
@@ -0,0 +1,64 @@
+"""
+Testes para os índices e o EXPLAIN das consultas quentes do Kermartin 3.0
+"""
+
+from io import StringIO
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from core.models import Usuario, Processo, Documento, LogSeguranca
+from core.query_plans import find_seq_scans
+
+PLANO_POSTGRES = """Limit  (cost=0.29..8.31 rows=1 width=16)
+  ->  Index Scan using sessao_status_data_idx on sessoes_analise  (cost=0.29..8.31 rows=1 width=16)
+        Index Cond: ((status)::text = 'iniciada'::text)
+  ->  Seq Scan on logs_seguranca  (cost=0.00..35.50 rows=10 width=16)
+        Filter: (descricao = 'x'::text)"""
+
+
+class TestPlanos(TestCase):
+    """Testes para a detecção de varreduras sequenciais"""
+
+    def test_leitura_dos_planos(self):
+        """Testa Seq Scan do PostgreSQL e SCAN sem índice do SQLite"""
+        self.assertEqual(find_seq_scans(PLANO_POSTGRES, 'postgresql'), ['logs_seguranca'])
+        self.assertEqual(find_seq_scans('2 0 0 SCAN documentos', 'sqlite'), ['documentos'])
+        self.assertEqual(find_seq_scans('2 0 0 SCAN processos USING INDEX processo_idx', 'sqlite'), [])
+        self.assertEqual(find_seq_scans('3 0 0 SCAN logs_seguranca USING COVERING INDEX log_idx', 'sqlite'), [])
+        self.assertEqual(find_seq_scans('qualquer plano', 'mysql'), [])
+
+    def test_filtro_sem_indice_e_apontado(self):
+        """Testa que um filtro fora dos índices aparece como varredura sequencial"""
+        plano = LogSeguranca.objects.filter(descricao='evento').order_by().explain()
+        self.assertEqual(find_seq_scans(plano, connection.vendor), ['logs_seguranca'])
+
+    def test_consultas_quentes_usam_indices(self):
+        """Testa o comando: nenhuma consulta registrada lê a tabela inteira"""
+        saida = StringIO()
+        call_command('explain_hot_queries', '--fail-on-seqscan', stdout=saida)
+        self.assertIn('✅ resultado.upsert', saida.getvalue())
+        self.assertIn('✅ documento.processados', saida.getvalue())
+        self.assertNotIn('⚠️', saida.getvalue())
+
+
+class TestDocumentosProcessados(TestCase):
+    """Testes para o filtro coberto pelo índice parcial"""
+
+    def test_exclui_documentos_sem_texto(self):
+        """Testa que documentos sem texto extraído não entram na análise"""
+        user = User.objects.create_user(username="plano@kermartin.com", password="senha123")
+        usuario = Usuario.objects.create(
+            user=user, nome_completo="Dr. Plano", oab_numero="445566", oab_estado="SP"
+        )
+        processo = Processo.objects.create(usuario=usuario, titulo="Processo Plano")
+        Documento.objects.create(processo=processo, nome_arquivo="vazio.pdf", tipo_documento="inquerito")
+        Documento.objects.create(
+            processo=processo, nome_arquivo="denuncia.pdf",
+            tipo_documento="denuncia", texto_extraido="Denúncia"
+        )
+
+        self.assertEqual(
+            [d.nome_arquivo for d in processo.documentos.processados()],
+            ['denuncia.pdf']
+        )
@@ -0,0 +1,214 @@
+"""
+Testes para a razão de tokens e orçamentos do Kermartin 3.0
+"""
+
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from core.models import Usuario, Processo, Documento, SessaoAnalise, ConsumoTokens
+from core.token_ledger import get_token_ledger, compute_cost, usage_scope, BudgetExceeded
+from ai_engine.processor import KermartinProcessor
+
+PRICING = {
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'text-embedding-3-small': (0.02, 0.02, 0.0),
+}
+
+
+def criar_usuario(email='ledger@kermartin.com', oab='777888', **campos):
+    user = User.objects.create_user(username=email, email=email, password="senha123")
+    return Usuario.objects.create(
+        user=user, nome_completo="Dr. Ledger", oab_numero=oab, oab_estado="SP", **campos
+    )
+
+
+@override_settings(OPENAI_PRICING=PRICING)
+class TokenLedgerTestCase(TestCase):
+    """Razão com gravação síncrona (sem thread) e cache local"""
+
+    def setUp(self):
+        cache.clear()
+        self.settings_override = override_settings(KERMARTIN_SETTINGS={
+            **settings.KERMARTIN_SETTINGS,
+            'TOKEN_LEDGER_ASYNC': False,
+            'TOKEN_BUDGET_MONTHLY_TOKENS': 0,
+            'TOKEN_BUDGET_MONTHLY_USD': 0,
+            'OPENAI_CHUNK_SLEEP_SEC': 0,
+        })
+        self.settings_override.enable()
+        self.ledger = get_token_ledger()
+        self.usuario = criar_usuario()
+        self.processo = Processo.objects.create(usuario=self.usuario, titulo="Processo Ledger")
+
+    def tearDown(self):
+        get_token_ledger().writer.flush()
+        self.settings_override.disable()
+
+
+class TestCusto(TokenLedgerTestCase):
+    """Testes para o cálculo de custo"""
+
+    def test_custo_com_tokens_em_cache(self):
+        """Testa preço reduzido da entrada em cache e modelo com sufixo de versão"""
+        custo = compute_cost('gpt-4o-2024-08-06', 1_000_000, tokens_cache=400_000, tokens_resposta=100_000)
+        self.assertEqual(custo, Decimal('3.000000'))
+
+    def test_modelo_sem_preco(self):
+        """Testa custo zero para modelo fora da tabela"""
+        self.assertEqual(compute_cost('modelo-desconhecido', 1000, 0, 1000), Decimal(0))
+
+
+class TestTotais(TokenLedgerTestCase):
+    """Testes para gravação e totais correntes"""
+
+    def test_totais_por_usuario_e_processo(self):
+        """Testa a linha da razão e os totais somados sem consultar a razão"""
+        with usage_scope(usuario_id=self.usuario.id, processo_id=self.processo.id):
+            self.ledger.record('chat', 'gpt-4o', tokens_prompt=1000, tokens_cache=200, tokens_resposta=500)
+            self.ledger.record('embedding', 'text-embedding-3-small', tokens_prompt=100)
+        self.ledger.writer.flush()
+
+        linha = ConsumoTokens.objects.get(operacao='chat')
+        self.assertEqual(linha.usuario_id, self.usuario.id)
+        self.assertEqual(linha.processo_id, self.processo.id)
+        self.assertEqual(linha.custo, Decimal('0.007250'))
+
+        # Primeira leitura semeia a partir da razão; depois, só o cache
+        self.ledger.user_totals(self.usuario.id)
+        self.ledger.process_totals(self.processo.id)
+        with usage_scope(usuario_id=self.usuario.id, processo_id=self.processo.id):
+            self.ledger.record('chat', 'gpt-4o', tokens_prompt=100, tokens_resposta=10)
+
+        with self.assertNumQueries(0):
+            totais = self.ledger.user_totals(self.usuario.id)
+            processo = self.ledger.process_totals(self.processo.id)
+        self.assertEqual(totais['chamadas'], 3)
+        self.assertEqual(totais['tokens_total'], 1710)
+        self.assertEqual(totais['tokens_cache'], 200)
+        self.assertAlmostEqual(totais['custo_usd'], 0.007602)
+        self.assertEqual(processo['chamadas'], 3)
+
+    def test_totais_refeitos_da_razao(self):
+        """Testa reconstrução dos totais quando o cache/Redis foi perdido"""
+        with usage_scope(usuario_id=self.usuario.id):
+            self.ledger.record('chat', 'gpt-4o', tokens_prompt=1000, tokens_resposta=1000)
+        self.ledger.writer.flush()
+        cache.clear()
+
+        totais = self.ledger.user_totals(self.usuario.id)
+        self.assertEqual(totais['tokens_total'], 2000)
+        self.assertAlmostEqual(totais['custo_usd'], 0.0125)
+
+    def test_analise_registra_consumo(self):
+        """Testa atribuição das chamadas da análise a usuário, processo e sessão"""
+        documento = Documento.objects.create(
+            processo=self.processo,
+            nome_arquivo="denuncia.pdf",
+            tipo_documento="denuncia",
+            texto_extraido="Denúncia oferecida pelo Ministério Público."
+        )
+        sessao = SessaoAnalise.objects.create(processo=self.processo, modo_analise='individual')
+        with patch('ai_engine.processor.OpenAI'), override_settings(OPENAI_MODEL='gpt-4o'):
+            processor = KermartinProcessor()
+        processor.client.chat.completions.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='ok'))],
+            usage=SimpleNamespace(
+                prompt_tokens=10, completion_tokens=5, total_tokens=15,
+                prompt_tokens_details=SimpleNamespace(cached_tokens=4)
+            )
+        )
+
+        processor.analyze_document(documento, 1, 1, sessao)
+        self.ledger.writer.flush()
+
+        linha = ConsumoTokens.objects.get()
+        self.assertEqual((linha.usuario_id, linha.processo_id, linha.sessao_id), (self.usuario.id, self.processo.id, sessao.id))
+        self.assertEqual((linha.modelo, linha.tokens_prompt, linha.tokens_cache, linha.tokens_resposta), ('gpt-4o', 10, 4, 5))
+
+
+class TestOrcamento(TokenLedgerTestCase):
+    """Testes para o orçamento mensal por usuário"""
+
+    def test_limite_do_usuario(self):
+        """Testa limite próprio do usuário sobre o padrão do sistema"""
+        self.usuario.limite_tokens_mensal = 1000
+        self.usuario.save()
+        self.assertFalse(self.ledger.check_budget(self.usuario)['excedido'])
+
+        with usage_scope(usuario_id=self.usuario.id):
+            self.ledger.record('chat', 'gpt-4o', tokens_prompt=900, tokens_resposta=100)
+
+        with self.assertRaises(BudgetExceeded) as ctx:
+            self.ledger.check_budget(self.usuario)
+        self.assertEqual(ctx.exception.consumo['tokens_restantes'], 0)
+
+    def test_limite_de_custo_padrao(self):
+        """Testa orçamento em USD definido em KERMARTIN_SETTINGS"""
+        with override_settings(KERMARTIN_SETTINGS={
+            **settings.KERMARTIN_SETTINGS, 'TOKEN_BUDGET_MONTHLY_USD': 0.01
+        }):
+            ledger = get_token_ledger()
+            with usage_scope(usuario_id=self.usuario.id):
+                ledger.record('chat', 'gpt-4o', tokens_prompt=1000, tokens_resposta=500)
+            consumo = ledger.budget(self.usuario)
+        self.assertFalse(consumo['excedido'])
+        self.assertAlmostEqual(consumo['custo_restante_usd'], 0.0025)
+
+
+@override_settings(OPENAI_PRICING=PRICING)
+class TestOrcamentoAPI(APITestCase):
+    """Testes para o bloqueio de novas análises e o endpoint de consumo"""
+
+    def setUp(self):
+        cache.clear()
+        self.settings_override = override_settings(KERMARTIN_SETTINGS={
+            **settings.KERMARTIN_SETTINGS, 'TOKEN_LEDGER_ASYNC': False
+        })
+        self.settings_override.enable()
+        self.usuario = criar_usuario(limite_tokens_mensal=100)
+        self.processo = Processo.objects.create(usuario=self.usuario, titulo="Processo Ledger")
+        Documento.objects.create(
+            processo=self.processo, nome_arquivo="teste.pdf",
+            tipo_documento="inquerito", texto_extraido="Texto extraído do PDF"
+        )
+        refresh = RefreshToken.for_user(self.usuario.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+
+    def tearDown(self):
+        get_token_ledger().writer.flush()
+        self.settings_override.disable()
+
+    def test_analise_bloqueada_sem_orcamento(self):
+        """Testa 429 antes de criar a sessão quando o orçamento acabou"""
+        with usage_scope(usuario_id=self.usuario.id):
+            get_token_ledger().record('chat', 'gpt-4o', tokens_prompt=100)
+
+        response = self.client.post(reverse('core:analise-iniciar'), {
+            'processo_id': str(self.processo.id),
+            'modo_analise': 'completa',
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertTrue(response.data['consumo']['excedido'])
+        self.assertFalse(SessaoAnalise.objects.exists())
+
+    def test_endpoint_consumo(self):
+        """Testa consumo do mês e do processo"""
+        with usage_scope(usuario_id=self.usuario.id, processo_id=self.processo.id):
+            get_token_ledger().record('chat', 'gpt-4o', tokens_prompt=40, tokens_resposta=20)
+
+        response = self.client.get(reverse('core:estatisticas-consumo'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['tokens_total'], 60)
+        self.assertEqual(response.data['tokens_restantes'], 40)
+
+        response = self.client.get(reverse('core:estatisticas-consumo'), {'processo_id': str(self.processo.id)})
+        self.assertEqual(response.data['chamadas'], 1)
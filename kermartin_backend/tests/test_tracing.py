@@ -0,0 +1,141 @@
+"""
+Testes para o rastreamento por etapas do Kermartin 3.0
+"""
+
+import os
+import json
+import tempfile
+from types import SimpleNamespace
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from core.models import Usuario, Processo, Documento, SessaoAnalise
+from core.tracing import get_tracer, trace, span, current_trace_id
+from ai_engine.processor import KermartinProcessor
+from ai_engine.retrieval import make_response
+
+
+class TracingTestCase(TestCase):
+    """Tracing habilitado, exportando para um arquivo temporário"""
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'traces.jsonl')
+        self.settings_override = override_settings(KERMARTIN_SETTINGS={
+            **settings.KERMARTIN_SETTINGS,
+            'TRACING_ENABLED': True,
+            'TRACING_SAMPLE_RATE': 1.0,
+            'TRACING_EXPORT_PATH': self.path,
+            'OPENAI_CHUNK_SLEEP_SEC': 0,
+        })
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+    def exported_spans(self):
+        get_tracer().exporter.flush()
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+
+class TestSpans(TracingTestCase):
+    """Testes para spans, propagação e exportação"""
+
+    def test_spans_aninhados(self):
+        """Testa hierarquia, trace_id comum e formato OTLP"""
+        with trace('raiz') as root:
+            with span('etapa', paginas=3):
+                pass
+            trace_id = current_trace_id()
+
+        spans = {s['name']: s for s in self.exported_spans()}
+        self.assertEqual(spans['etapa']['traceId'], trace_id)
+        self.assertEqual(spans['etapa']['parentSpanId'], root.span_id)
+        self.assertEqual(spans['etapa']['attributes'], {'paginas': 3})
+        self.assertEqual(spans['raiz']['parentSpanId'], '')
+        self.assertGreaterEqual(spans['raiz']['endTimeUnixNano'], spans['raiz']['startTimeUnixNano'])
+        self.assertIsNone(current_trace_id())
+
+    def test_erro_marca_span(self):
+        """Testa status de erro no span que propagou a exceção"""
+        with self.assertRaises(ValueError):
+            with trace('raiz'):
+                raise ValueError('falhou')
+
+        spans = self.exported_spans()
+        self.assertEqual(spans[0]['status'], {'code': 'ERROR', 'message': 'ValueError: falhou'})
+
+    def test_make_response_usa_trace_atual(self):
+        """Testa trace_id da resposta de jurisprudência igual ao da requisição"""
+        with trace('raiz'):
+            self.assertEqual(make_response([], 'simple')['trace_id'], current_trace_id())
+
+    def test_sem_amostragem_nao_exporta(self):
+        """Testa que traces não amostrados não são gravados"""
+        with override_settings(KERMARTIN_SETTINGS={**settings.KERMARTIN_SETTINGS, 'TRACING_SAMPLE_RATE': 0.0}):
+            with trace('raiz'):
+                with span('etapa'):
+                    pass
+            self.assertEqual(get_tracer().exporter.flush(), 0)
+
+    def test_trace_id_da_requisicao(self):
+        """Testa traceparent recebido, cabeçalho X-Trace-Id e span raiz da requisição"""
+        trace_id = '4bf92f3577b34da6a3ce929d0e0e4736'
+        response = self.client.get(
+            '/metrics', HTTP_TRACEPARENT=f'00-{trace_id}-00f067aa0ba902b7-01'
+        )
+
+        self.assertEqual(response['X-Trace-Id'], trace_id)
+        spans = self.exported_spans()
+        self.assertEqual(spans[-1]['name'], 'http.request')
+        self.assertEqual(spans[-1]['traceId'], trace_id)
+        self.assertEqual(spans[-1]['attributes']['http.route'], 'metrics')
+
+
+class TestEtapasDaAnalise(TracingTestCase):
+    """Testes para a atribuição do tempo da análise por etapa"""
+
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user(username="trace@kermartin.com", password="senha123")
+        usuario = Usuario.objects.create(
+            user=user, nome_completo="Dr. Trace", oab_numero="333444", oab_estado="RS"
+        )
+        processo = Processo.objects.create(usuario=usuario, titulo="Processo Trace")
+        self.documento = Documento.objects.create(
+            processo=processo,
+            nome_arquivo="denuncia.pdf",
+            tipo_documento="denuncia",
+            texto_extraido="Denúncia oferecida pelo Ministério Público."
+        )
+        self.sessao = SessaoAnalise.objects.create(processo=processo, modo_analise='individual')
+        with patch('ai_engine.processor.OpenAI'):
+            self.processor = KermartinProcessor()
+        self.processor.client.chat.completions.create.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='ok'))],
+            usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15)
+        )
+
+    def test_spans_por_etapa(self):
+        """Testa validação, prompt, geração e gravação como filhos da análise"""
+        with trace('teste'):
+            self.processor.analyze_document(self.documento, 1, 1, self.sessao)
+
+        spans = self.exported_spans()
+        by_name = {s['name']: s for s in spans}
+        analise = by_name['analysis.document']
+        self.assertEqual(analise['attributes']['bloco'], 1)
+
+        for etapa in ('analysis.validate_document', 'analysis.cache_lookup', 'llm.generate', 'db.save_result'):
+            self.assertEqual(by_name[etapa]['parentSpanId'], analise['spanId'], etapa)
+        self.assertEqual(by_name['security.validate_document']['parentSpanId'], by_name['analysis.validate_document']['spanId'])
+        self.assertIn('security.validate_prompt', by_name)
+        self.assertIn('prompt.render', by_name)
+        self.assertEqual({s['traceId'] for s in spans}, {analise['traceId']})
@@ -91,8 +91,9 @@ def upload_documento(request, processo_id):
         from ai_engine.document_processor import DocumentProcessor
         try:
             processor = DocumentProcessor()
-            texto = processor.extract_text_from_pdf(doc.arquivo_original.path)
-            doc.texto_extraido = texto
+            extracao = processor.process_document(doc.arquivo_original.path)
+            doc.texto_extraido = extracao['texto']
+            doc.hash_arquivo = extracao['hash']
             doc.tamanho_arquivo = doc.arquivo_original.size or 0
             doc.save()
             messages.success(request, 'Documento enviado e processado com sucesso')
@@ -116,7 +117,7 @@ def iniciar_analise(request, processo_id):
         subetapa = int(request.POST.get('subetapa') or 1)
 
         # Verificar se há documentos com texto
-        if not processo.documentos.filter(texto_extraido__isnull=False).exists():
+        if not processo.documentos.processados().exists():
             messages.error(request, 'Nenhum documento processado neste processo')
             return redirect(request.path)
 
@@ -130,10 +131,10 @@ def iniciar_analise(request, processo_id):
         proc = KermartinProcessor()
         try:
             if modo == 'individual':
-                documento = processo.documentos.filter(texto_extraido__isnull=False).first()
+                documento = processo.documentos.processados().with_text().first()
                 proc.analyze_document(documento, bloco, subetapa, sessao)
             else:
-                docs = list(processo.documentos.filter(texto_extraido__isnull=False))
+                docs = list(processo.documentos.processados().with_text())
                 proc.analyze_complete_process(docs, sessao)
             messages.success(request, 'Análise iniciada com sucesso')
             return redirect('webui:ver_resultado', sessao_id=sessao.id)
@@ -158,7 +159,7 @@ def iniciar_analise(request, processo_id):
 @require_http_methods(["GET"])  # Ver resultado resumido
 def ver_resultado(request, sessao_id):
     sessao = get_object_or_404(SessaoAnalise, id=sessao_id, processo__usuario__user=request.user)
-    resultados = ResultadoAnalise.objects.filter(sessao=sessao).order_by('bloco', 'subetapa')
+    resultados = ResultadoAnalise.objects.filter(sessao=sessao).with_text('resposta_ia').order_by('bloco', 'subetapa')
 
     return render(request, 'webui/resultado.html', {
         'sessao': sessao,